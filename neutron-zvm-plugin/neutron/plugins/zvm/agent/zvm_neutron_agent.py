@@ -35,6 +35,7 @@ from neutron.openstack.common import loopingcall
 from neutron.openstack.common.gettextutils import _
 from neutron.plugins.zvm.common import exception
 from neutron.plugins.zvm.common import utils
+from neutron.plugins.zvm.common import xcatutils
 
 LOG = logging.getLogger(__name__)
 
@@ -91,6 +92,9 @@ class zvmNeutronAgent(n_rpc.RpcCallback):
             heartbeat.start(interval=report_interval)
 
     def _report_state(self):
+        pool_stats = xcatutils.get_xcat_conn_pool_stats()
+        self.agent_state['configurations']['xcat_connection_pool'] = pool_stats
+        LOG.debug(_("xCAT connection pool: %s"), pool_stats)
         try:
             self.state_rpc.report_state(self.context, self.agent_state)
             self.agent_state.pop('start_flag', None)
@@ -344,7 +348,10 @@ def main():
 
     agent = zvmNeutronAgent()
 
-    # Start to query xCAT DB
-    agent.xcatdb_daemon_loop()
-    LOG.info(_("z/VM agent initialized, now running... "))
+    try:
+        # Start to query xCAT DB
+        agent.xcatdb_daemon_loop()
+        LOG.info(_("z/VM agent initialized, now running... "))
+    finally:
+        xcatutils.close_xcat_conn_pools()
     sys.exit(0)
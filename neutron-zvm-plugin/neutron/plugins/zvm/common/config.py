@@ -40,6 +40,22 @@ agent_opts = [
     cfg.StrOpt(
         'zvm_xcat_server',
         help=_("xCat MN server address")),
+    cfg.ListOpt(
+        'zvm_xcat_standby_servers',
+        default=[],
+        help=_("Addresses of standby xCat MN servers. Reads go to the "
+        "least loaded available server, writes to zvm_xcat_server unless "
+        "it is unavailable")),
+    cfg.IntOpt(
+        'zvm_xcat_failover_threshold',
+        default=3,
+        help=_("The number of consecutive failed requests after which an "
+        "xCat MN server is considered unavailable, 0 to disable failover")),
+    cfg.IntOpt(
+        'zvm_xcat_failover_retry_interval',
+        default=30,
+        help=_("The number of seconds an unavailable xCat MN server is "
+        "skipped before requests are sent to it again")),
     cfg.IntOpt(
         'polling_interval',
         default=2,
@@ -50,6 +66,26 @@ agent_opts = [
         default=300,
         help=_("The number of seconds the agent will wait for "
         "xCAT MN response")),
+    cfg.IntOpt(
+        'zvm_xcat_connection_pool_size',
+        default=4,
+        help=_("The maximum number of kept-alive connections to the "
+        "xCAT MN")),
+    cfg.IntOpt(
+        'zvm_xcat_connection_idle_timeout',
+        default=60,
+        help=_("The number of seconds an idle connection to the xCAT MN "
+        "is kept open")),
+    cfg.StrOpt(
+        'zvm_xcat_metrics_file',
+        default=None,
+        help=_("Path of the file the xCAT request metrics are written to "
+        "in Prometheus text format, unset to not write it")),
+    cfg.IntOpt(
+        'zvm_xcat_metrics_interval',
+        default=60,
+        help=_("The number of seconds between writing the xCAT request "
+        "metrics file and logging a summary of the xCAT requests")),
     cfg.StrOpt(
         'xcat_mgt_ip',
         default=None,
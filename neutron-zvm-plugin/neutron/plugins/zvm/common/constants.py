@@ -15,3 +15,6 @@
 #    under the License.
 
 XCAT_RESPONSE_KEYS = ('info', 'data', 'node', 'errorcode', 'error')
+
+# Upper bounds(seconds) of the xCAT request latency histogram buckets
+XCAT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
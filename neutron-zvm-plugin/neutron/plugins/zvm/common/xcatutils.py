@@ -17,6 +17,11 @@
 
 import functools
 import httplib
+import os
+import socket
+import time
+
+from eventlet import semaphore
 
 from neutron.openstack.common import jsonutils
 from neutron.openstack.common.gettextutils import _
@@ -68,18 +73,227 @@ class xCatURL(object):
         return self.PREFIX + self.NODES + arg + self.XDSH + self.SUFFIX
 
 
+class xCatConnectionPool(object):
+    """Bounded pool of persistent https connections to one xCat server.
+
+    Connections are kept alive between requests and handed out LIFO, idle
+    connections older than the idle timeout are closed on the next access.
+    Usage statistics are collected for the agent state report.
+    """
+
+    def __init__(self, host, max_size, idle_timeout, timeout):
+        self.host = host
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._idle = []
+        self._lock = semaphore.Semaphore()
+        self._max_size = max_size
+        self._slots = semaphore.Semaphore(max_size)
+        self._stats = {'hits': 0,
+                       'misses': 0,
+                       'reconnects': 0,
+                       'wait_time': 0.0}
+
+    @property
+    def load(self):
+        """Number of connections in use and requests waiting for one."""
+        return self._max_size - self._slots.balance
+
+    def _evict_idle(self, now):
+        """Close connections that have been idle for too long."""
+        fresh = []
+        with self._lock:
+            for conn, last_used in self._idle:
+                if now - last_used < self._idle_timeout:
+                    fresh.append((conn, last_used))
+                else:
+                    conn.close()
+            self._idle = fresh
+
+    def get(self, new=False):
+        """Get a connection from the pool, wait if the pool is exhausted.
+
+        Returns a tuple of (connection, reused), reused is True if the
+        connection has been used by an earlier request. If new is True, a
+        new connection is always created and counted as a reconnect.
+        """
+        start = time.time()
+        self._slots.acquire()
+        now = time.time()
+        self._stats['wait_time'] += now - start
+        self._evict_idle(now)
+        if not new:
+            with self._lock:
+                if self._idle:
+                    self._stats['hits'] += 1
+                    return self._idle.pop()[0], True
+
+        try:
+            conn = httplib.HTTPSConnection(self.host, None, None, None,
+                                           True, self._timeout)
+        except Exception:
+            self._slots.release()
+            raise
+
+        if new:
+            self._stats['reconnects'] += 1
+        else:
+            self._stats['misses'] += 1
+        return conn, False
+
+    def put(self, conn):
+        """Return a healthy connection to the pool for reuse."""
+        with self._lock:
+            self._idle.append((conn, time.time()))
+        self._slots.release()
+
+    def discard(self, conn):
+        """Close a broken connection and free its slot."""
+        try:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        """Close all idle connections."""
+        with self._lock:
+            for conn, last_used in self._idle:
+                conn.close()
+            self._idle = []
+
+    def get_stats(self):
+        """Return a copy of the usage statistics of this pool."""
+        stats = dict(self._stats)
+        stats['wait_time'] = round(stats['wait_time'], 3)
+        stats['idle'] = len(self._idle)
+        return stats
+
+
+_XCAT_CONN_POOLS = {}
+
+
+def get_xcat_conn_pool(host):
+    """Return the connection pool of xCat server host, create if needed."""
+    pool = _XCAT_CONN_POOLS.get(host)
+    if pool is None:
+        pool = xCatConnectionPool(host,
+                                  CONF.AGENT.zvm_xcat_connection_pool_size,
+                                  CONF.AGENT.zvm_xcat_connection_idle_timeout,
+                                  CONF.AGENT.zvm_xcat_timeout)
+        _XCAT_CONN_POOLS[host] = pool
+    return pool
+
+
+def close_xcat_conn_pools():
+    """Close the idle connections of all xCat servers."""
+    for pool in _XCAT_CONN_POOLS.values():
+        pool.close_all()
+
+
+def get_xcat_conn_pool_stats():
+    """Return the statistics of the connection pool of the xCat server."""
+    return get_xcat_conn_pool(CONF.AGENT.zvm_xcat_server).get_stats()
+
+
+class xCatServerHealth(object):
+    """Health of one xCat server, tracked from the request results.
+
+    The server is unavailable after a number of consecutive failed
+    requests. Once the retry interval expires since the last failure it's
+    available again, and unavailable for another interval if the next
+    request fails too.
+    """
+
+    def __init__(self, host, threshold, retry_interval):
+        self.host = host
+        self._threshold = threshold
+        self._retry_interval = retry_interval
+        self._failures = 0
+        self._failed_at = 0
+
+    def is_available(self):
+        return (self._threshold <= 0 or self._failures < self._threshold or
+                time.time() - self._failed_at >= self._retry_interval)
+
+    def record_success(self):
+        if self._threshold > 0 and self._failures >= self._threshold:
+            LOG.info(_("xCat server %s is available again") % self.host)
+        self._failures = 0
+
+    def record_failure(self):
+        self._failures += 1
+        self._failed_at = time.time()
+        if self._threshold > 0 and self._failures == self._threshold:
+            LOG.warn(_("xCat server %(host)s failed %(num)d requests in a "
+                       "row, it's skipped for %(interval)ds") %
+                     {'host': self.host, 'num': self._failures,
+                      'interval': self._retry_interval})
+
+
+_XCAT_SERVER_HEALTH = {}
+
+
+def get_xcat_server_health(host):
+    """Return the health of xCat server host, create if needed."""
+    health = _XCAT_SERVER_HEALTH.get(host)
+    if health is None:
+        health = xCatServerHealth(host,
+                                  CONF.AGENT.zvm_xcat_failover_threshold,
+                                  CONF.AGENT.zvm_xcat_failover_retry_interval)
+        _XCAT_SERVER_HEALTH[host] = health
+    return health
+
+
+def select_xcat_server(method):
+    """Return the xCat server a request is sent to.
+
+    Writes are sent to the primary server and GETs to the available server
+    with the least loaded connection pool. Requests fail over to the first
+    available standby server when the primary server is unavailable, and
+    go to the primary server if no server is available.
+    """
+    servers = [CONF.AGENT.zvm_xcat_server] + [
+        host for host in CONF.AGENT.zvm_xcat_standby_servers if host]
+    available = [host for host in servers
+                 if get_xcat_server_health(host).is_available()]
+    if not available:
+        return servers[0]
+    elif method == "GET":
+        # min() returns the first of equally loaded servers
+        return min(available, key=lambda host: get_xcat_conn_pool(host).load)
+    return available[0]
+
+
 class xCatConnection():
     """Https requests to xCat web service."""
     def __init__(self):
-        """Initialize https connection to xCat service."""
+        """Initialize https connection to xCat service.
+
+        The underlying connections are shared through the connection pool
+        of the xCat server. Each request is sent to the server picked by
+        select_xcat_server.
+        """
         self.host = CONF.AGENT.zvm_xcat_server
-        self.xcat_timeout = CONF.AGENT.zvm_xcat_timeout
+
+    def _send(self, pool, conn, method, url, body, headers):
+        """Send the request on a pooled connection and release it.
+
+        Returns a tuple of (response, response body).
+        """
         try:
-            self.conn = httplib.HTTPSConnection(self.host, None, None, None,
-                                                True, self.xcat_timeout)
+            conn.request(method, url, body, headers)
+            res = conn.getresponse()
+            msg = res.read()
         except Exception:
-            LOG.error(_("Connect to xCat server %s failed") % self.host)
-            raise exception.zVMxCatConnectionFailed(xcatserver=self.host)
+            pool.discard(conn)
+            raise
+
+        if res.will_close:
+            pool.discard(conn)
+        else:
+            pool.put(conn)
+
+        return res, msg
 
     def request(self, method, url, body=None, headers={}):
         """Do http request to xCat server
@@ -91,16 +305,36 @@ class xCatConnection():
             headers = {'content-type': 'text/plain',
                        'content-length': len(body)}
 
+        self.host = select_xcat_server(method)
+        health = get_xcat_server_health(self.host)
+        pool = get_xcat_conn_pool(self.host)
         try:
-            self.conn.request(method, url, body, headers)
+            conn, reused = pool.get()
+        except Exception:
+            LOG.error(_("Connect to xCat server %s failed") % self.host)
+            health.record_failure()
+            raise exception.zVMxCatConnectionFailed(xcatserver=self.host)
+
+        try:
+            try:
+                res, msg = self._send(pool, conn, method, url, body, headers)
+            except (httplib.HTTPException, socket.error) as err:
+                if (not reused or isinstance(err, socket.gaierror) or
+                        isinstance(err, socket.timeout)):
+                    raise
+                # The kept-alive socket was closed by xCat, reconnect once
+                LOG.debug(_("Reconnecting to xCat server %(host)s: %(err)s") %
+                          {'host': self.host, 'err': err})
+                conn, reused = pool.get(new=True)
+                res, msg = self._send(pool, conn, method, url, body, headers)
         except Exception as err:
             LOG.error(_("Request to xCat server %(host)s failed: %(err)s") %
                       {'host': self.host, 'err': err})
+            health.record_failure()
             raise exception.zVMxCatRequestFailed(xcatserver=self.host,
                                                  err=err)
 
-        res = self.conn.getresponse()
-        msg = res.read()
+        health.record_success()
         resp = {
             'status': res.status,
             'reason': res.reason,
@@ -125,10 +359,132 @@ class xCatConnection():
         return resp
 
 
+def _get_endpoint_class(url):
+    """Return the endpoint class of an xCat url for the request metrics.
+
+    Node names and the query string, which contains the credentials, are
+    dropped, e.g. "/xcatws/nodes/zhcp/dsh?userName=.." becomes "nodes/dsh".
+    """
+    segs = url.partition('?')[0].split('/')[2:]
+    if not segs or not segs[0]:
+        return 'unknown'
+    elif segs[0] == 'nodes':
+        return '/'.join([segs[0]] + segs[2:])
+    return '/'.join(segs[:2])
+
+
+class xCatRequestStats(object):
+    """Call counters and latency histograms of xCat requests.
+
+    The requests are grouped by method and endpoint class. The metrics are
+    written to a file in Prometheus text format and summarized in the log
+    every zvm_xcat_metrics_interval seconds.
+    """
+
+    def __init__(self, prefix):
+        self._prefix = prefix
+        self._stats = {}
+        self._flushed_at = time.time()
+
+    def record(self, method, url, latency, nbytes, failed):
+        key = (method, _get_endpoint_class(url))
+        stat = self._stats.setdefault(key, {
+            'count': 0, 'errors': 0, 'bytes': 0, 'latency_sum': 0.0,
+            'buckets': [0] * len(constants.XCAT_LATENCY_BUCKETS)})
+
+        stat['count'] += 1
+        stat['errors'] += 1 if failed else 0
+        stat['bytes'] += nbytes
+        stat['latency_sum'] += latency
+        for i, bound in enumerate(constants.XCAT_LATENCY_BUCKETS):
+            if latency <= bound:
+                stat['buckets'][i] += 1
+
+    def get_summary(self):
+        """Return the metrics as a dict keyed by "method endpoint"."""
+        return dict((' '.join(key), {
+                        'count': stat['count'],
+                        'errors': stat['errors'],
+                        'bytes': stat['bytes'],
+                        'latency_avg': round(stat['latency_sum'] /
+                                             stat['count'], 3)})
+                    for key, stat in self._stats.iteritems())
+
+    def to_prometheus(self):
+        """Return the metrics in Prometheus text exposition format."""
+        keys = sorted(self._stats.keys())
+        lines = []
+        for name, field in (('requests_total', 'count'),
+                            ('request_errors_total', 'errors'),
+                            ('response_bytes_total', 'bytes')):
+            metric = '%s_%s' % (self._prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            for key in keys:
+                lines.append('%s{method="%s",endpoint="%s"} %d' %
+                             ((metric,) + key + (self._stats[key][field],)))
+
+        metric = '%s_request_duration_seconds' % self._prefix
+        lines.append('# TYPE %s histogram' % metric)
+        for key in keys:
+            stat = self._stats[key]
+            labels = 'method="%s",endpoint="%s"' % key
+            for bound, num in zip(constants.XCAT_LATENCY_BUCKETS,
+                                  stat['buckets']):
+                lines.append('%s_bucket{%s,le="%s"} %d' %
+                             (metric, labels, bound, num))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' %
+                         (metric, labels, stat['count']))
+            lines.append('%s_sum{%s} %.6f' %
+                         (metric, labels, stat['latency_sum']))
+            lines.append('%s_count{%s} %d' % (metric, labels, stat['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def maybe_flush(self):
+        """Write the metrics file and log a summary if the interval expired."""
+        now = time.time()
+        if now - self._flushed_at < CONF.AGENT.zvm_xcat_metrics_interval:
+            return
+        self._flushed_at = now
+
+        path = CONF.AGENT.zvm_xcat_metrics_file
+        if path:
+            tmp_path = path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(self.to_prometheus())
+                os.rename(tmp_path, path)
+            except (IOError, OSError) as err:
+                LOG.warn(_("Failed to write xCat metrics file %(path)s: "
+                           "%(err)s") % {'path': path, 'err': err})
+
+        LOG.info(_("xCat request summary: %s") %
+                 jsonutils.dumps(self.get_summary(), sort_keys=True))
+
+
+_XCAT_REQUEST_STATS = xCatRequestStats('neutron_zvm_xcat')
+
+
+def get_xcat_request_stats():
+    """Return the metrics of the xCat requests sent by this process."""
+    return _XCAT_REQUEST_STATS
+
+
 def xcat_request(method, url, body=None, headers={}):
     conn = xCatConnection()
-    resp = conn.request(method, url, body, headers)
-    return load_xcat_resp(resp['message'])
+    start = time.time()
+    nbytes = 0
+    failed = True
+    try:
+        resp = conn.request(method, url, body, headers)
+        nbytes = len(resp['message'])
+        result = load_xcat_resp(resp['message'])
+        failed = False
+        return result
+    finally:
+        stats = get_xcat_request_stats()
+        stats.record(method, url, time.time() - start, nbytes, failed)
+        stats.maybe_flush()
 
 
 def jsonloads(jsonstr):
@@ -172,17 +528,14 @@ def load_xcat_resp(message):
      'error': [error,]}
     """
     resp_list = jsonloads(message)['data']
-    keys = constants.XCAT_RESPONSE_KEYS
 
-    resp = {}
+    resp = dict((k, []) for k in constants.XCAT_RESPONSE_KEYS)
     try:
-        for k in keys:
-            resp[k] = []
-
+        # Bucket the entries in one pass
         for d in resp_list:
-            for k in keys:
-                if d.get(k) is not None:
-                    resp[k].append(d.get(k))
+            for k, v in d.iteritems():
+                if v is not None and k in resp:
+                    resp[k].append(v)
     except Exception:
         LOG.error(_("Invalid data returned from xCat: %s") % message)
         raise exception.zVMInvalidxCatResponseDataError(msg=message)
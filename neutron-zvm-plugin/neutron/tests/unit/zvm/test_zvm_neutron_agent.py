@@ -192,6 +192,8 @@ class TestZVMNeutronAgent(base.BaseTestCase):
             report_st.assert_called_with(self.agent.context,
                                          self.agent.agent_state)
             self.assertNotIn("start_flag", self.agent.agent_state)
+            self.assertIn("xcat_connection_pool",
+                          self.agent.agent_state['configurations'])
 
     def test_treat_vif_port(self):
         with mock.patch.object(self.agent, "port_bound") as bound:
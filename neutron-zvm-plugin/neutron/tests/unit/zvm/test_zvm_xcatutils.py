@@ -19,8 +19,10 @@ Unit tests for the z/VM xCAT utils.
 """
 
 import mock
+import time
 
 from oslo.config import cfg
+from neutron.plugins.zvm.common import exception
 from neutron.plugins.zvm.common import xcatutils
 from neutron.tests import base
 
@@ -39,3 +41,181 @@ class TestZVMXcatUtils(base.BaseTestCase):
         with mock.patch.multiple(xcatutils.httplib,
             HTTPSConnection=mock.MagicMock()):
             self._zvm_xcat_connection = xcatutils.xCatConnection()
+
+    def test_load_xcat_resp(self):
+        message = ('{"data": [{"info": ["info1"]}, {"data": ["data1"], '
+                   '"errorcode": ["0"]}, {"info": ["info2"]}]}')
+        resp = xcatutils.load_xcat_resp(message)
+        self.assertEqual({'info': [['info1'], ['info2']],
+                          'data': [['data1']],
+                          'node': [],
+                          'errorcode': [['0']],
+                          'error': []},
+                         resp)
+
+    def _fake_conn(self, will_close=False, request_error=None):
+        conn = mock.MagicMock()
+        if request_error is not None:
+            conn.request.side_effect = request_error
+        res = conn.getresponse.return_value
+        res.status = 200
+        res.reason = 'OK'
+        res.will_close = will_close
+        res.read.return_value = '{"data": []}'
+        return conn
+
+    def test_request_reuse_connection(self):
+        conn = self._fake_conn()
+        with mock.patch.dict(xcatutils._XCAT_CONN_POOLS, clear=True):
+            with mock.patch.object(xcatutils.httplib, 'HTTPSConnection',
+                                   return_value=conn) as https_conn:
+                xcatutils.xcat_request('GET', '/xcatws/fake')
+                xcatutils.xcat_request('GET', '/xcatws/fake')
+                self.assertEqual(1, https_conn.call_count)
+                self.assertEqual(2, conn.request.call_count)
+
+                stats = xcatutils.get_xcat_conn_pool_stats()
+                self.assertEqual(1, stats['hits'])
+                self.assertEqual(1, stats['misses'])
+                self.assertEqual(0, stats['reconnects'])
+                self.assertEqual(1, stats['idle'])
+
+    def test_request_connection_closed_by_server(self):
+        conn1 = self._fake_conn(will_close=True)
+        conn2 = self._fake_conn()
+        with mock.patch.dict(xcatutils._XCAT_CONN_POOLS, clear=True):
+            with mock.patch.object(xcatutils.httplib, 'HTTPSConnection',
+                                   side_effect=[conn1, conn2]):
+                xcatutils.xcat_request('GET', '/xcatws/fake')
+                xcatutils.xcat_request('GET', '/xcatws/fake')
+                self.assertTrue(conn1.close.called)
+                self.assertEqual(0, xcatutils.get_xcat_conn_pool_stats()[
+                                    'hits'])
+
+    def test_request_reconnect_stale_connection(self):
+        conn1 = self._fake_conn()
+        conn2 = self._fake_conn()
+        with mock.patch.dict(xcatutils._XCAT_CONN_POOLS, clear=True):
+            with mock.patch.object(xcatutils.httplib, 'HTTPSConnection',
+                                   side_effect=[conn1, conn2]):
+                xcatutils.xcat_request('GET', '/xcatws/fake')
+                conn1.request.side_effect = xcatutils.httplib.BadStatusLine(
+                                                '')
+                xcatutils.xcat_request('GET', '/xcatws/fake')
+                self.assertTrue(conn1.close.called)
+                self.assertTrue(conn2.request.called)
+
+                stats = xcatutils.get_xcat_conn_pool_stats()
+                self.assertEqual(1, stats['hits'])
+                self.assertEqual(1, stats['reconnects'])
+
+    def test_request_no_reconnect_new_connection(self):
+        conn = self._fake_conn(request_error=xcatutils.socket.error('err'))
+        with mock.patch.dict(xcatutils._XCAT_CONN_POOLS, clear=True):
+            with mock.patch.object(xcatutils.httplib, 'HTTPSConnection',
+                                   return_value=conn) as https_conn:
+                self.assertRaises(exception.zVMxCatRequestFailed,
+                                  xcatutils.xcat_request, 'GET',
+                                  '/xcatws/fake')
+                self.assertEqual(1, https_conn.call_count)
+                self.assertTrue(conn.close.called)
+
+    def test_select_xcat_server(self):
+        cfg.CONF.set_override('zvm_xcat_standby_servers', ['127.0.0.2'],
+                              'AGENT')
+        with mock.patch.dict(xcatutils._XCAT_CONN_POOLS, clear=True):
+            with mock.patch.dict(xcatutils._XCAT_SERVER_HEALTH, clear=True):
+                self.assertEqual(self._FAKE_XCAT_SERVER,
+                                 xcatutils.select_xcat_server('GET'))
+
+                xcatutils.get_xcat_conn_pool(
+                    self._FAKE_XCAT_SERVER)._slots.acquire()
+                self.assertEqual('127.0.0.2',
+                                 xcatutils.select_xcat_server('GET'))
+                self.assertEqual(self._FAKE_XCAT_SERVER,
+                                 xcatutils.select_xcat_server('PUT'))
+
+    def test_request_failover(self):
+        cfg.CONF.set_override('zvm_xcat_standby_servers', ['127.0.0.2'],
+                              'AGENT')
+        cfg.CONF.set_override('zvm_xcat_failover_threshold', 2, 'AGENT')
+        conn1 = self._fake_conn(request_error=xcatutils.socket.error('err'))
+        conn2 = self._fake_conn()
+        hosts = {self._FAKE_XCAT_SERVER: conn1, '127.0.0.2': conn2}
+        with mock.patch.dict(xcatutils._XCAT_CONN_POOLS, clear=True):
+            with mock.patch.dict(xcatutils._XCAT_SERVER_HEALTH, clear=True):
+                with mock.patch.object(xcatutils.httplib, 'HTTPSConnection',
+                        side_effect=lambda host, *args: hosts[host]):
+                    for i in range(2):
+                        self.assertRaises(exception.zVMxCatRequestFailed,
+                                          xcatutils.xcat_request, 'PUT',
+                                          '/xcatws/fake')
+                    xcatutils.xcat_request('PUT', '/xcatws/fake')
+                    self.assertEqual(2, conn1.request.call_count)
+                    self.assertEqual(1, conn2.request.call_count)
+
+                    with mock.patch.object(xcatutils.time, 'time',
+                                           return_value=time.time() + 60):
+                        self.assertEqual(self._FAKE_XCAT_SERVER,
+                                         xcatutils.select_xcat_server('PUT'))
+
+    def test_pool_idle_eviction(self):
+        pool = xcatutils.xCatConnectionPool(self._FAKE_XCAT_SERVER, 2, 60,
+                                            self._FAKE_XCAT_TIMEOUT)
+        conn = mock.MagicMock()
+        with mock.patch.object(xcatutils.time, 'time', return_value=100):
+            pool.put(conn)
+        pool._evict_idle(200)
+        self.assertTrue(conn.close.called)
+        self.assertEqual(0, pool.get_stats()['idle'])
+
+    def test_close_xcat_conn_pools(self):
+        pool = xcatutils.xCatConnectionPool(self._FAKE_XCAT_SERVER, 2, 60,
+                                            self._FAKE_XCAT_TIMEOUT)
+        conn = mock.MagicMock()
+        pool.put(conn)
+        with mock.patch.dict(xcatutils._XCAT_CONN_POOLS,
+                             {self._FAKE_XCAT_SERVER: pool}, clear=True):
+            xcatutils.close_xcat_conn_pools()
+        self.assertTrue(conn.close.called)
+        self.assertEqual(0, pool.get_stats()['idle'])
+
+    def test_xcat_request_stats(self):
+        cfg.CONF.set_override('zvm_xcat_password', 'fakepass', 'AGENT')
+        conn = self._fake_conn()
+        stats = xcatutils.xCatRequestStats('neutron_zvm_xcat')
+        with mock.patch.dict(xcatutils._XCAT_CONN_POOLS, clear=True):
+            with mock.patch.object(xcatutils, '_XCAT_REQUEST_STATS', stats):
+                with mock.patch.object(xcatutils.httplib, 'HTTPSConnection',
+                                       return_value=conn):
+                    url = xcatutils.xCatURL().xdsh('/fakezhcp')
+                    xcatutils.xcat_request('PUT', url, ['command=ls'])
+
+        summary = stats.get_summary()['PUT nodes/dsh']
+        self.assertEqual(1, summary['count'])
+        self.assertEqual(0, summary['errors'])
+        self.assertEqual(len('{"data": []}'), summary['bytes'])
+
+        metrics = stats.to_prometheus()
+        self.assertIn('neutron_zvm_xcat_requests_total{method="PUT",'
+                      'endpoint="nodes/dsh"} 1', metrics)
+        self.assertNotIn('fakepass', metrics)
+        self.assertNotIn('fakezhcp', metrics)
+
+    def test_xcat_request_stats_flush(self):
+        cfg.CONF.set_override('zvm_xcat_metrics_file', '/fake/xcat.prom',
+                              'AGENT')
+        cfg.CONF.set_override('zvm_xcat_metrics_interval', 0, 'AGENT')
+        stats = xcatutils.xCatRequestStats('neutron_zvm_xcat')
+        stats.record('GET', '/xcatws/tables/switch?format=json', 0.01, 10,
+                     False)
+        fake_open = mock.mock_open()
+        with mock.patch('__builtin__.open', fake_open, create=True):
+            with mock.patch.object(xcatutils.os, 'rename') as rename:
+                with mock.patch.object(xcatutils.LOG, 'info') as log_info:
+                    stats.maybe_flush()
+                    fake_open.assert_called_once_with('/fake/xcat.prom.tmp',
+                                                      'w')
+                    rename.assert_called_once_with('/fake/xcat.prom.tmp',
+                                                   '/fake/xcat.prom')
+                    self.assertTrue(log_info.called)
@@ -0,0 +1,681 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2014 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Local xCAT REST API emulator for offline performance testing.
+
+The emulator serves the subset of the xCAT REST API used by the z/VM nova
+driver and neutron agent over HTTPS, backed by in-memory node, nodetype,
+zvm, switch, mac, hosts, osimage and site tables. It only depends on the
+Python standard library, run it with:
+
+    python fake_xcat.py --port 8443 --instances 100 --latency 0.05
+
+and point zvm_xcat_server (or zvm_xcat_server in the [AGENT] section of the
+neutron agent) to localhost:8443, with the credentials given by --username
+and --password. The certificate is self-signed unless --certfile is given,
+so the clients must not verify it, e.g. by setting
+ssl._create_default_https_context to ssl._create_unverified_context.
+
+Latency, jitter and faults are set per endpoint class in a JSON profile:
+
+    {"default": {"latency": 0.05, "jitter": 0.02},
+     "nodes/power": {"latency": 0.5, "error_rate": 0.01},
+     "nodes/dsh": {"latency": 1, "drop_rate": 0.05}}
+
+The endpoint class is the same one the driver request metrics use, e.g.
+"nodes/power" or "tables/zvm". A class without a profile falls back to
+its first path segment, e.g. "nodes", and then to "default". The faults
+are an xCAT error in the response (error_rate), an HTTP 500 response
+(http_error_rate) and a connection closed without response (drop_rate).
+
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import os
+import random
+import re
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+
+TABLE_COLUMNS = {
+    'nodelist': ('node', 'groups', 'status', 'comments', 'disable'),
+    'nodetype': ('node', 'os', 'arch', 'profile', 'provmethod', 'comments',
+                 'disable'),
+    'zvm': ('node', 'hcp', 'userid', 'nodetype', 'parent', 'comments',
+            'disable'),
+    'switch': ('node', 'switch', 'port', 'vlan', 'interface', 'comments',
+               'disable'),
+    'mac': ('node', 'interface', 'mac', 'comments', 'disable'),
+    'hosts': ('node', 'ip', 'hostnames', 'otherinterfaces', 'comments',
+              'disable'),
+    'osimage': ('imagename', 'profile', 'imagetype', 'provmethod', 'osname',
+                'osvers', 'osarch', 'isdeletable', 'comments', 'disable'),
+    'site': ('key', 'value', 'comments', 'disable'),
+    }
+
+# Output of the SMAPI commands run on zHCP through xdsh, keyed by a
+# substring of the command
+DSH_OUTPUTS = {
+    'System_Info_Query': ('Timezone:            EDT\n'
+                          'Time:                21:50:01\n'
+                          'VM release:          6.3\n'
+                          'Running time:        10 days\n'
+                          'IPL Time: 2014-03-13 21:43:12 EDT'),
+    'Image_Query_Activate_Time': ('Image activated on 2014-03-13 '
+                                  '21:50:01'),
+    'random/boot_id': '8b1c4e6a-2f3d-4a5b-9c7e-0d1f2a3b4c5d',
+    'df -h /': ('Filesystem      Size  Used Avail Use% Mounted on\n'
+                '/dev/dasda1     6.8G  1.5G  5.0G  23% /'),
+    'Virtual_Network_Adapter_Query': ('Failed\n'
+                                      'Return Code: 212\n'
+                                      'Reason Code: 8\n'
+                                      'Description: Adapter does not exist'),
+    }
+
+FCP_DEVICES = ('1FB0', '1FB1', '1FB2', '1FB3')
+
+
+def get_endpoint_class(path):
+    """Return the endpoint class of a request path.
+
+    Node names are dropped, e.g. "/xcatws/nodes/os000001/power" is
+    classified as "nodes/power".
+
+    """
+    segs = [s for s in path.split('/') if s][1:]
+    if not segs:
+        return 'unknown'
+    elif segs[0] in ('nodes', 'vms', 'hypervisor'):
+        return '/'.join([segs[0]] + segs[2:])
+    elif segs[0] in ('tables', 'objects'):
+        return '/'.join(segs[:2])
+    elif segs[0] == 'images':
+        actions = ('capture', 'export', 'import')
+        return '/'.join([segs[0]] + [a for a in segs[1:] if a in actions])
+    return segs[0]
+
+
+class FakeInstance(dict):
+    """Instance with the attribute access and save() spawn relies on."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def save(self):
+        pass
+
+
+class FakeXCATDrop(Exception):
+    """The connection is closed without sending a response."""
+    pass
+
+
+class FakeXCAT(object):
+    """In-memory state and request handling of a fake xCAT MN."""
+
+    def __init__(self, username='admin', password='passw0rd',
+                 host='fakenode', zhcp='fakehcp.fake.com', master='xcat',
+                 diskpool='FAKEDP', instances=0, profile=None):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.zhcp = zhcp
+        self.master = master
+        self.diskpool = diskpool
+        self.profile = profile or {}
+        self.dsh_outputs = dict(DSH_OUTPUTS)
+        self.tables = dict((t, []) for t in TABLE_COLUMNS)
+        self.node_attrs = {}
+        self.power = {}
+        self.vms = set()
+        self.stats = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+        zhcp_node = zhcp.partition('.')[0]
+        self.add_row('site', key='master', value='10.0.0.1')
+        self.add_row('hosts', node=master, ip='10.0.0.1')
+        self.add_node(master, userid='XCAT')
+        self.add_node(host, hcp=zhcp)
+        self.add_node(zhcp_node, hcp=zhcp, userid='ZHCP', parent=host)
+        for i in range(instances):
+            node = 'os%06d' % (i + 1)
+            self.add_node(node, hcp=zhcp, userid=node.upper())
+            self.vms.add(node)
+            self.power[node] = 'on'
+
+    def add_row(self, table, **values):
+        row = dict((c, '') for c in TABLE_COLUMNS[table])
+        row.update(values)
+        self.tables[table].append(row)
+        return row
+
+    def delete_rows(self, table, **keys):
+        self.tables[table] = [r for r in self.tables[table]
+                              if any(r.get(k) != v for k, v in keys.items())]
+
+    def find_rows(self, table, **keys):
+        return [r for r in self.tables[table]
+                if all(r.get(k) == v for k, v in keys.items())]
+
+    def add_node(self, node, hcp='', userid='', groups='all', parent='',
+                 **attrs):
+        self.add_row('nodelist', node=node, groups=groups)
+        self.add_row('nodetype', node=node, arch='s390x')
+        self.add_row('zvm', node=node, hcp=hcp, userid=userid,
+                     parent=parent)
+        self.node_attrs[node] = dict(attrs, mgt='zvm')
+
+    def delete_node(self, node):
+        for table in ('nodelist', 'nodetype', 'zvm', 'switch', 'mac',
+                      'hosts'):
+            self.delete_rows(table, node=node)
+        self.node_attrs.pop(node, None)
+        self.power.pop(node, None)
+        self.vms.discard(node)
+
+    def add_image(self, profile, provmethod='netboot'):
+        name = 'rhel6.5-s390x-%s-%s' % (provmethod, profile)
+        self.add_row('osimage', imagename=name, profile=profile,
+                     imagetype='linux', provmethod=provmethod,
+                     osname='Linux', osvers='rhel6.5', osarch='s390x',
+                     isdeletable='auto:last_use_date:%s' %
+                                 time.strftime('%Y-%m-%d'))
+        return name
+
+    def _get_fault_profile(self, endpoint):
+        for name in (endpoint, endpoint.split('/')[0], 'default'):
+            if name in self.profile:
+                return self.profile[name]
+        return {}
+
+    def _wait(self, endpoint):
+        prof = self._get_fault_profile(endpoint)
+        delay = prof.get('latency', 0) + random.uniform(
+                    -prof.get('jitter', 0), prof.get('jitter', 0))
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < prof.get('drop_rate', 0):
+            raise FakeXCATDrop()
+        if random.random() < prof.get('http_error_rate', 0):
+            return 500, {'error': 'Fake internal server error'}
+        if random.random() < prof.get('error_rate', 0):
+            return 200, self._error('Fake xCAT error')
+
+    def handle(self, method, url, body=None):
+        """Handle a request, returns a tuple of (status, response)."""
+        parsed = urlparse.urlparse(url)
+        query = urlparse.parse_qs(parsed.query)
+        endpoint = get_endpoint_class(parsed.path)
+        with self._lock:
+            self.stats[' '.join((method, endpoint))] += 1
+
+        fault = self._wait(endpoint)
+        if fault is not None:
+            return fault
+
+        if (query.get('userName') != [self.username] or
+                query.get('password') != [self.password]):
+            return 401, {'error': 'Authentication failure'}
+
+        segs = [s for s in parsed.path.split('/') if s]
+        if len(segs) < 2 or segs[0] != 'xcatws':
+            return 404, {'error': 'Unknown resource %s' % parsed.path}
+
+        handler = getattr(self, '_' + segs[1], None)
+        if handler is None:
+            return 404, {'error': 'Unknown resource %s' % parsed.path}
+
+        with self._lock:
+            resp = handler(method, segs[2:], query, body or [])
+        return 201 if method == 'POST' else 200, resp
+
+    def _info(self, *info):
+        return {'data': [{'info': list(info)}]}
+
+    def _data(self, *data):
+        return {'data': [{'data': list(data)}]}
+
+    def _error(self, msg):
+        return {'data': [{'errorcode': ['1']}, {'error': [msg]}]}
+
+    def _noderange(self, segs):
+        return segs[0].split(',') if segs else []
+
+    def _unknown_nodes(self, nodes):
+        known = set(r['node'] for r in self.tables['nodelist'])
+        return [n for n in nodes if n not in known]
+
+    def _nodes(self, method, segs, query, body):
+        nodes = self._noderange(segs)
+        action = segs[1] if len(segs) > 1 else None
+        if method == 'POST' and action is None:
+            return self._mkdef(nodes, body)
+
+        unknown = self._unknown_nodes(nodes)
+        if unknown:
+            return self._error("Could not find an object named '%s' of "
+                               "type 'node'." % unknown[0])
+
+        if action is None:
+            if method == 'GET':
+                return self._lsdef(nodes)
+            elif method == 'PUT':
+                return self._chtab(nodes, body)
+            elif method == 'DELETE':
+                for node in nodes:
+                    self.delete_node(node)
+                return self._info()
+        elif action == 'power':
+            return self._rpower(nodes, body)
+        elif action == 'status':
+            return {'data': [{'node': [
+                    {'name': [n],
+                     'data': ['sshd' if self.power.get(n) == 'on'
+                              else 'noping']} for n in nodes]}]}
+        elif action == 'inventory':
+            return self._rinv(nodes[0], query.get('field', []))
+        elif action == 'dsh':
+            return self._xdsh(nodes[0], body)
+        elif action in ('bootstate', 'migrate'):
+            return self._info('%s: %s done' % (nodes[0], action))
+        return self._error('Unsupported action %s' % action)
+
+    def _mkdef(self, nodes, body):
+        for node in nodes:
+            attrs = dict(b.split('=', 1) for b in body if '=' in b)
+            self.delete_node(node)
+            self.add_node(node, hcp=attrs.pop('hcp', ''),
+                          userid=attrs.pop('userid', ''),
+                          groups=attrs.pop('groups', 'all'), **attrs)
+        return self._info('1 object definitions have been created or '
+                          'modified.')
+
+    def _lsdef(self, nodes):
+        lines = []
+        for node in nodes:
+            zvm = self.find_rows('zvm', node=node)[0]
+            attrs = dict(self.node_attrs.get(node, {}),
+                         hcp=zvm['hcp'], userid=zvm['userid'])
+            lines.append('Object name: %s' % node)
+            lines.extend('    %s=%s' % (k, v)
+                         for k, v in sorted(attrs.items()) if v)
+        return self._info(*lines)
+
+    def _chtab(self, nodes, body):
+        for node in nodes:
+            for b in body:
+                col, sep, value = b.partition('=')
+                table, sep, col = col.rpartition('.')
+                if table in self.tables:
+                    rows = self.find_rows(table, node=node) or \
+                           [self.add_row(table, node=node)]
+                    for row in rows:
+                        row[col] = value
+        return self._info()
+
+    def _rpower(self, nodes, body):
+        state = body[0] if body else 'stat'
+        lines = []
+        for node in nodes:
+            if state in ('on', 'reset', 'reboot'):
+                self.power[node] = 'on'
+            elif state in ('off', 'softoff'):
+                self.power[node] = 'off'
+            lines.append('%s: %s' % (node, self.power.get(node, 'off')))
+        return self._info('\n'.join(lines))
+
+    def _rinv(self, node, fields):
+        if '--freerepospace' in fields:
+            lines = ['/dev/dasdb1  50G  10G  40G  20% /install']
+        elif '--diskpoolspace' in fields:
+            lines = ['%s Total: 406105.3 G' % self.diskpool,
+                     '%s Used: 367262.6 G' % self.diskpool,
+                     '%s Free: 38842.7 G' % self.diskpool]
+        elif '--fcpdevices' in fields:
+            lines = []
+            for fcp in FCP_DEVICES:
+                lines.extend(['FCP device number: %s' % fcp,
+                              '  Status: Free',
+                              '  NPIV world wide port number: '
+                              '20076D8500005%s' % fcp[1:],
+                              '  Channel path ID: 16',
+                              '  Physical world wide port number: '
+                              '20076D8500005181'])
+        elif node == self.host:
+            vcpus_used = len(self.vms)
+            lines = ['z/VM Host: %s' % self.host.upper(),
+                     'zHCP: %s' % self.zhcp,
+                     'CEC Vendor: IBM',
+                     'CEC Model: 2817',
+                     'Hypervisor OS: z/VM 6.3.0',
+                     'Hypervisor Name: %s' % self.host,
+                     'Architecture: s390x',
+                     'LPAR CPU Total: 64',
+                     'LPAR CPU Used: %d' % min(vcpus_used, 64),
+                     'LPAR Memory Total: 256G',
+                     'LPAR Memory Offline: 0',
+                     'LPAR Memory Used: %d.0G' % min(vcpus_used, 256),
+                     'IPL Time: IPL at 03/13/14 21:43:12 EDT']
+        else:
+            lines = ['Uptime: 4 days 20 hr 00 min',
+                     'CPU Used Time: 330528353',
+                     'Total Memory: 512M',
+                     'Max Memory: 2G',
+                     '',
+                     'Processors: ',
+                     '    CPU 00  ID  FF00EBBE20978000 (BASE) CP  CPUAFF ON',
+                     '']
+        return self._info('\n'.join('%s: %s' % (node, line) for line in lines))
+
+    def _xdsh(self, node, body):
+        command = ' '.join(b.partition('=')[2] for b in body
+                           if b.startswith('command='))
+        output = ''
+        for key, out in self.dsh_outputs.items():
+            if key in command:
+                output = out
+                break
+        return self._data('\n'.join('%s: %s' % (node, line)
+                                    for line in output.split('\n')))
+
+    def _vms(self, method, segs, query, body):
+        nodes = self._noderange(segs)
+        unknown = self._unknown_nodes(nodes)
+        if unknown:
+            return self._error("Could not find an object named '%s' of "
+                               "type 'node'." % unknown[0])
+
+        node = nodes[0]
+        if method == 'POST':
+            self.vms.add(node)
+            self.power[node] = 'off'
+            return self._info('%s: Done' % node)
+        elif node not in self.vms:
+            return self._error('%s: (Error) Image %s not defined' %
+                               (node, node.upper()))
+        elif method == 'DELETE':
+            # rmvm removes the xCAT node too
+            self.delete_node(node)
+        elif method == 'GET':
+            return self._info('\n'.join([
+                '%s: USER %s PASSW0RD 512M 2G G' % (node, node.upper()),
+                '%s: NICDEF 1000 TYPE QDIO LAN SYSTEM XCATVSW2' % node]))
+        return self._info('%s: Done' % node)
+
+    def _hypervisor(self, method, segs, query, body):
+        return self._info('%s: Done' % (segs[0] if segs else self.host))
+
+    def _networks(self, method, segs, query, body):
+        return self._data()
+
+    def _version(self, method, segs, query, body):
+        return self._data('Version 2.8.4')
+
+    def _tables(self, method, segs, query, body):
+        table = segs[0] if segs else None
+        if table not in self.tables:
+            return self._error('Table %s does not exist' % table)
+
+        if method == 'PUT':
+            self._tabch(table, ' '.join(body).split())
+            return self._data()
+        elif 'col' in query:
+            return self._gettab(table, query)
+
+        columns = TABLE_COLUMNS[table]
+        lines = ['#' + ','.join(columns)]
+        for row in self._tabdump_rows(table, query.get('field', [])):
+            lines.append(','.join('"%s"' % row[c] if row[c] else ''
+                                  for c in columns))
+        return self._data(*lines)
+
+    def _tabdump_rows(self, table, fields):
+        rows = self.tables[table]
+        for flag, where in zip(fields, fields[1:]):
+            if flag != '-w':
+                continue
+            if '=~' in where:
+                col, value = where.split('=~', 1)
+                rows = [r for r in rows if re.search(value, r.get(col, ''))]
+            else:
+                col, sep, value = where.partition('==')
+                rows = [r for r in rows if r.get(col) == value]
+        return rows
+
+    def _gettab(self, table, query):
+        col = query['col'][0]
+        if '=' in col:
+            col, sep, value = col.partition('=')
+        else:
+            value = query.get('value', [''])[0]
+        values = []
+        for row in self.find_rows(table, **{col: value}):
+            values.extend(row.get(a, '') for a in query.get('attribute', []))
+        return self._data(*values)
+
+    def _tabch(self, table, tokens):
+        delete = tokens and tokens[0] == '-d'
+        keys, values = {}, {}
+        for token in tokens[1:-1] if delete else tokens:
+            col, sep, value = token.partition('=')
+            if '.' in col:
+                values[col.partition('.')[2]] = value
+            else:
+                keys[col] = value
+
+        if delete:
+            self.delete_rows(table, **keys)
+            return
+
+        rows = self.find_rows(table, **keys) if keys else []
+        if not rows:
+            rows = [self.add_row(table, **keys)]
+        for row in rows:
+            row.update(values)
+
+    def _images(self, method, segs, query, body):
+        params = dict(b.split('=', 1) for b in body if '=' in b)
+        if 'import' in segs:
+            name = self.add_image(params.get('profile', 'fake'))
+            return self._info('Image import completed (%s)' % name)
+        elif 'capture' in segs:
+            name = self.add_image(params.get('profile', 'fake'))
+            return self._info('%s: Completed capturing the image(%s)' %
+                              (params.get('nodename'), name))
+        elif 'export' in segs:
+            return self._info('Exported %s' % params.get('osimage'))
+        elif method == 'DELETE':
+            self.delete_rows('osimage', imagename=segs[0])
+            return self._info()
+        return self._lsdef_image(query)
+
+    def _objects(self, method, segs, query, body):
+        if method == 'DELETE' and len(segs) > 1:
+            self.delete_rows('osimage', imagename=segs[1])
+        return self._info()
+
+    def _lsdef_image(self, query):
+        images = self.tables['osimage']
+        for criteria in query.get('criteria', []):
+            if '=~' in criteria:
+                col, value = criteria.split('=~', 1)
+                images = [i for i in images
+                          if re.search(value, i.get(col, ''))]
+            else:
+                col, sep, value = criteria.partition('=')
+                images = [i for i in images if i.get(col) == value]
+
+        fields = query.get('field')
+        if not fields:
+            return self._info(*['%s  (osimage)' % i['imagename']
+                                for i in images])
+
+        lines = []
+        for image in images:
+            lines.append('Object name: %s' % image['imagename'])
+            lines.extend('    %s=%s' % (f, image.get(f, '')) for f in fields)
+        return self._info(*lines)
+
+
+class FakeXCATHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP request handler dispatching to the FakeXCAT of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        try:
+            status, resp = self.server.xcat.handle(self.command, self.path,
+                                                   body)
+        except FakeXCATDrop:
+            self.close_connection = 1
+            return
+
+        message = json.dumps(resp)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+
+class FakeXCATServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTPS server of a FakeXCAT.
+
+    The server can run in the background of a test or benchmark process:
+
+        server = FakeXCATServer(('localhost', 0), FakeXCAT(), certfile)
+        server.start()
+        ...
+        server.stop()
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, xcat, certfile=None, keyfile=None,
+                 verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeXCATHandler)
+        self.xcat = xcat
+        self.verbose = verbose
+        self._tmp_dir = None
+        if certfile is None:
+            self._tmp_dir = tempfile.mkdtemp()
+            certfile = keyfile = generate_cert(self._tmp_dir)
+        self.socket = ssl.wrap_socket(self.socket, certfile=certfile,
+                                      keyfile=keyfile, server_side=True)
+        self._thread = None
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+def generate_cert(path):
+    """Generate a self-signed certificate, returns the pem file path."""
+    pem = os.path.join(path, 'fake_xcat.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-nodes', '-newkey',
+                           'rsa:2048', '-days', '1', '-subj', '/CN=localhost',
+                           '-keyout', pem, '-out', pem],
+                          stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT)
+    return pem
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='passw0rd')
+    parser.add_argument('--zvm-host', default='fakenode',
+                        help='node name of the z/VM hypervisor')
+    parser.add_argument('--zhcp', default='fakehcp.fake.com',
+                        help='host name of zHCP')
+    parser.add_argument('--instances', type=int, default=0,
+                        help='number of running instances to create')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='default latency(seconds) of the responses')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='default jitter(seconds) of the latency')
+    parser.add_argument('--profile',
+                        help='JSON file of latency and faults per endpoint')
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    profile = {'default': {'latency': args.latency, 'jitter': args.jitter}}
+    if args.profile:
+        with open(args.profile) as f:
+            profile.update(json.load(f))
+
+    xcat = FakeXCAT(username=args.username, password=args.password,
+                    host=args.zvm_host, zhcp=args.zhcp,
+                    instances=args.instances, profile=profile)
+    server = FakeXCATServer((args.host, args.port), xcat, args.certfile,
+                            args.keyfile, args.verbose)
+    print('Fake xCAT listening on https://%s' % server.address)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for key, count in sorted(xcat.stats.items()):
+            print('%-30s %d' % (key, count))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,28 +17,43 @@
 """Test suite for ZVMDriver."""
 
 import __builtin__
+import contextlib
 import httplib
 import mock
 import mox
 import os
+import shutil
 import socket
+import ssl
+import tempfile
+import time
+
+from eventlet import greenpool
+from eventlet import greenthread
+from eventlet import timeout as eventlet_timeout
 
 from nova.compute import power_state
 from nova import context
 from nova import db
 from nova import exception as nova_exception
 from nova.image import glance
+from nova.network import model as network_model
 from nova.openstack.common.gettextutils import _
 from nova.openstack.common import fileutils
 from nova.openstack.common import jsonutils
+from nova.openstack.common import loopingcall
 from nova import test
+from nova.tests import fake_xcat
+from nova.virt import event as virtevent
 from nova.virt import fake
 from nova.virt.zvm import configdrive
+from nova.virt.zvm import const
 from nova.virt.zvm import driver
 from nova.virt.zvm import exception
 from nova.virt.zvm import imageop
 from nova.virt.zvm import instance
 from nova.virt.zvm import networkop
+from nova.virt.zvm import phaselog
 from nova.virt.zvm import utils as zvmutils
 from nova.virt.zvm import volumeop
 from oslo.config import cfg
@@ -58,10 +73,12 @@ class FakeXCATConn(object):
 
 class FakeHTTPResponse(object):
 
-    def __init__(self, status=None, reason=None, data=None):
+    def __init__(self, status=None, reason=None, data=None,
+                 will_close=False):
         self.status = status
         self.reason = reason
         self.data = data
+        self.will_close = will_close
 
     def read(self):
         return self.data
@@ -93,6 +110,11 @@ class ZVMTestCase(test.TestCase):
 
     def setUp(self):
         super(ZVMTestCase, self).setUp()
+        self.stubs.Set(zvmutils, '_XCAT_CACHE', None)
+        self.stubs.Set(zvmutils, '_DISKPOOL_LEDGER', None)
+        self.stubs.Set(zvmutils, '_INSTANCE_INDEX', None)
+        self.stubs.Set(zvmutils, '_REACHABILITY_POLLER', None)
+        self.stubs.Set(zvmutils, '_MN_PUB_KEY_CACHE', None)
         self.context = context.get_admin_context()
         self.instance = db.instance_create(self.context,
                                  {'user_id': 'fake',
@@ -252,6 +274,11 @@ class ZVMDriverTestCases(ZVMTestCase):
         self._setup_fake_inst_obj()
         self.driver = driver.ZVMDriver(fake.FakeVirtAPI())
         self.mox.UnsetStubs()
+        # Start with a cold cache and disk pool ledger, not with the
+        # responses read by __init__
+        self.stubs.Set(zvmutils, '_XCAT_CACHE', None)
+        self.stubs.Set(zvmutils, '_DISKPOOL_LEDGER', None)
+        self.stubs.Set(zvmutils, '_INSTANCE_INDEX', None)
 
     def test_init_driver(self):
         self.assertTrue(isinstance(self.driver._xcat_url, zvmutils.XCATUrl))
@@ -268,6 +295,17 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.assertEqual(host_info['hypervisor_hostname'], 'fakenode')
         self.assertEqual(host_info['host_memory_total'], 16 * 1024)
 
+    def test_update_host_info_diskpool_ledger(self):
+        self._set_fake_xcat_responses([self._fake_host_rinv_info(),
+                                       self._fake_disk_info(),
+                                       self._fake_host_rinv_info()])
+        self.driver.update_host_status()
+        zvmutils.get_diskpool_ledger().allocate('os000001', '10g')
+        host_info = self.driver.update_host_status()[0]
+        self.mox.VerifyAll()
+        self.assertEqual(367273, host_info['disk_used'])
+        self.assertEqual(38833, host_info['disk_available'])
+
     def _fake_instance_list_data(self):
         return {'data': [{'data': self._fake_instances_list()}]}
 
@@ -275,14 +313,17 @@ class ZVMDriverTestCases(ZVMTestCase):
         inst_list = ['#node,hcp,userid,nodetype,parent,comments,disable',
                      '"fakehcp","fakehcp.fake.com","HCP","vm","fakenode"',
                      '"fakenode","fakehcp.fake.com",,,,,',
-                     '"os000001","fakehcp.fake.com","OS000001",,,,']
+                     '"os000001","fakehcp.fake.com","OS000001",,,,',
+                     '"os000002","FAKEHCP.FAKE.COM","OS000002",,,,',
+                     '"os000003","otherhcp.fake.com","OS000003",,,,']
         return inst_list
 
     def test_list_instances(self):
         self._set_fake_xcat_responses([self._fake_instance_list_data()])
         inst_list = self.driver.list_instances()
         self.mox.VerifyAll()
-        self.assertTrue("os000001" in inst_list)
+        # The zHCP of the nodes is compared case insensitively
+        self.assertEqual(['os000001', 'os000002'], inst_list)
 
     def test_list_instances_exclude_xcat_master(self):
         self.flags(zvm_xcat_master='xcat')
@@ -296,6 +337,8 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.assertTrue("xcat" not in inst_list)
 
     def test_get_available_resource(self):
+        # The host stats read by __init__ are too old
+        self.driver._host_stats_time = 0
         self._set_fake_xcat_responses([self._fake_host_rinv_info(),
                                        self._fake_disk_info()])
         res = self.driver.get_available_resource('fakenode')
@@ -303,6 +346,137 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.assertEqual(res['vcpus'], 10)
         self.assertEqual(res['memory_mb_used'], 16 * 1024)
         self.assertEqual(res['disk_available_least'], 38843)
+        self.assertTrue(time.time() - self.driver._host_stats_time < 60)
+
+    def test_get_available_resource_recent_stats(self):
+        self.mox.StubOutWithMock(self.driver, 'update_host_status')
+        self.mox.ReplayAll()
+
+        res = self.driver.get_available_resource('fakenode')
+        self.mox.VerifyAll()
+        self.assertEqual(res['vcpus'], 10)
+
+    def test_refresh_host_stats_failed(self):
+        host_stats = self.driver._host_stats
+        self.mox.StubOutWithMock(self.driver, 'update_host_status')
+        self.driver.update_host_status().AndRaise(
+            exception.ZVMXCATRequestFailed(xcatserver='fake', msg='fake'))
+        self.mox.ReplayAll()
+
+        self.driver._refresh_host_stats()
+        self.mox.VerifyAll()
+        self.assertEqual(host_stats, self.driver._host_stats)
+
+    def test_start_host_stats_refresher(self):
+        self.flags(zvm_host_stats_refresh_interval=10)
+        timer = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(loopingcall, 'FixedIntervalLoopingCall')
+        loopingcall.FixedIntervalLoopingCall(
+            self.driver._refresh_host_stats).AndReturn(timer)
+        timer.start(10, initial_delay=10)
+        self.mox.ReplayAll()
+
+        self.driver._start_host_stats_refresher()
+        self.driver._start_host_stats_refresher()
+        self.mox.VerifyAll()
+
+    def _record_lifecycle_events(self):
+        events = []
+        self.driver.register_event_listener(events.append)
+        return events
+
+    def test_sweep_power_states(self):
+        events = self._record_lifecycle_events()
+        self.driver._instance_uuids['os000001'] = self.instance['uuid']
+        self._set_fake_xcat_responses([
+            self._fake_instance_list_data(),
+            self._generate_xcat_resp(['os000001: on\n']),
+            self._generate_xcat_resp(['os000001: off\n']),
+            self._generate_xcat_resp(['os000001: off\n'])])
+        self.driver._sweep_power_states()
+        self.driver._sweep_power_states()
+        self.driver._sweep_power_states()
+        self.mox.VerifyAll()
+        self.assertEqual([], events)
+
+        # The events are emitted by their own green thread
+        greenthread.sleep(0)
+        self.assertEqual(1, len(events))
+        self.assertEqual(self.instance['uuid'], events[0].get_instance_uuid())
+        self.assertEqual(virtevent.EVENT_LIFECYCLE_STOPPED,
+                         events[0].get_transition())
+        self.assertEqual(power_state.SHUTDOWN,
+                         self.driver._get_power_stat('os000001'))
+
+    def test_sweep_power_states_failed(self):
+        self.mox.StubOutWithMock(self.driver, 'list_instances')
+        self.mox.StubOutWithMock(self.driver, 'get_power_states')
+        self.driver.list_instances().AndReturn(['os000001'])
+        self.driver.get_power_states(['os000001']).AndRaise(
+            exception.ZVMXCATRequestFailed(xcatserver='fake', msg='fake'))
+        self.mox.ReplayAll()
+
+        self.driver._last_power_stats['os000001'] = power_state.RUNNING
+        self.driver._power_stats = {'os000001': power_state.RUNNING}
+        self.driver._power_stats_time = 100
+        self.driver._sweep_power_states()
+        self.mox.VerifyAll()
+        self.assertEqual({'os000001': power_state.RUNNING},
+                         self.driver._last_power_stats)
+        # The last result is kept, and queried again on the next call
+        self.assertEqual({'os000001': power_state.RUNNING},
+                         self.driver._power_stats)
+        self.assertEqual(100, self.driver._power_stats_time)
+
+    def test_handle_power_state_change(self):
+        events = self._record_lifecycle_events()
+        self.driver._instance_uuids['os000001'] = 'fakeuuid'
+        self.driver.handle_power_state_change('os000001',
+                                              power_state.SHUTDOWN)
+        self.driver.handle_power_state_change('os000001', power_state.RUNNING)
+        self.driver.handle_power_state_change('os000001', power_state.RUNNING)
+        self.driver.handle_power_state_change('os000002',
+                                              power_state.SHUTDOWN)
+        self.driver.handle_power_state_change('os000002', power_state.RUNNING)
+
+        greenthread.sleep(0)
+        self.assertEqual(1, len(events))
+        self.assertEqual('fakeuuid', events[0].get_instance_uuid())
+        self.assertEqual(virtevent.EVENT_LIFECYCLE_STARTED,
+                         events[0].get_transition())
+
+    def test_power_action_emits_no_lifecycle_events(self):
+        events = self._record_lifecycle_events()
+        self.driver._instance_uuids['os000001'] = 'fakeuuid'
+        self.driver._last_power_stats['os000001'] = power_state.RUNNING
+        stopped = self._gen_resp(info=['os000001: Stopping OS000001... Done'])
+        self._set_fake_xcat_responses([self._gen_resp(info=['os000001: on']),
+                                       self._gen_resp(info=['os000001: on']),
+                                       self._set_reachable('sshd'),
+                                       stopped])
+        self.driver.pause(self.instance)
+        self.driver.unpause(self.instance)
+        self.driver.power_off(self.instance)
+        self.mox.VerifyAll()
+
+        # Compute started the transitions, the driver doesn't report them
+        greenthread.sleep(0)
+        self.assertEqual([], events)
+        self.assertEqual(power_state.SHUTDOWN,
+                         self.driver._last_power_stats['os000001'])
+
+    def test_start_power_state_sweeper(self):
+        self.flags(zvm_power_state_sweep_interval=5)
+        timer = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(loopingcall, 'FixedIntervalLoopingCall')
+        loopingcall.FixedIntervalLoopingCall(
+            self.driver._sweep_power_states).AndReturn(timer)
+        timer.start(5, initial_delay=5)
+        self.mox.ReplayAll()
+
+        self.driver._start_power_state_sweeper()
+        self.driver._start_power_state_sweeper()
+        self.mox.VerifyAll()
 
     def _fake_instance_info(self):
         inst_inv_info = [
@@ -325,7 +499,8 @@ class ZVMDriverTestCases(ZVMTestCase):
 
     def test_get_info(self):
         power_stat = self._generate_xcat_resp(['os000001: on\n'])
-        self._set_fake_xcat_responses([power_stat,
+        self._set_fake_xcat_responses([self._fake_instance_list_data(),
+                                       power_stat,
                                        self._fake_reachable_data('sshd'),
                                        self._fake_instance_info()])
         inst_info = self.driver.get_info(self.instance)
@@ -346,9 +521,10 @@ class ZVMDriverTestCases(ZVMTestCase):
                           self.driver.get_info, self.instance2)
 
     def test_get_info_from_down(self):
+        # nodestat is not queried for an instance that is off
         power_stat = self._generate_xcat_resp(['os000001: off\n'])
-        self._set_fake_xcat_responses([power_stat,
-                                       self._fake_reachable_data('noping')])
+        self._set_fake_xcat_responses([self._fake_instance_list_data(),
+                                       power_stat])
         inst_info = self.driver.get_info(self.instance)
         self.mox.VerifyAll()
         self.assertEqual(0x04, inst_info['state'])
@@ -357,7 +533,8 @@ class ZVMDriverTestCases(ZVMTestCase):
 
     def test_get_info_from_paused(self):
         power_stat = self._generate_xcat_resp(['os000001: on\n'])
-        self._set_fake_xcat_responses([power_stat,
+        self._set_fake_xcat_responses([self._fake_instance_list_data(),
+                                       power_stat,
                                        self._fake_reachable_data('noping')])
         self.instance['power_state'] = power_state.PAUSED
         inst_info = self.driver.get_info(self.instance)
@@ -366,6 +543,85 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.assertEqual(1048576, inst_info['mem'])
         self.assertEqual(2, inst_info['num_cpu'])
 
+    def test_get_info_power_stat_cached(self):
+        power_stat = self._generate_xcat_resp(['os000001: off\n'])
+        self._set_fake_xcat_responses([self._fake_instance_list_data(),
+                                       power_stat])
+        self.driver.get_info(self.instance)
+        inst_info = self.driver.get_info(self.instance)
+        self.mox.VerifyAll()
+        self.assertEqual(0x04, inst_info['state'])
+
+    def test_get_info_after_power_off(self):
+        self._set_fake_xcat_responses([self._gen_resp(info=['os000001: off'])])
+        self.driver.power_off(self.instance)
+        inst_info = self.driver.get_info(self.instance)
+        self.mox.VerifyAll()
+        self.assertEqual(power_state.SHUTDOWN, inst_info['state'])
+        self.assertEqual(0, inst_info['mem'])
+
+    def test_get_info_after_pause(self):
+        self._set_fake_xcat_responses([self._gen_resp(info=['os000001: on'])])
+        self.driver.pause(self.instance)
+        self.instance['power_state'] = power_state.PAUSED
+        inst_info = self.driver.get_info(self.instance)
+        self.mox.VerifyAll()
+        self.assertEqual(power_state.PAUSED, inst_info['state'])
+
+    def test_get_info_instance_state_expired(self):
+        self.flags(zvm_power_stat_cache_ttl=0)
+        self.driver._instance_states['os000001'] = (power_state.SHUTDOWN,
+                                                    False, 0)
+        power_stat = self._generate_xcat_resp(['os000001: off\n'])
+        self._set_fake_xcat_responses([power_stat,
+                                       self._fake_reachable_data('noping')])
+        inst_info = self.driver.get_info(self.instance)
+        self.mox.VerifyAll()
+        self.assertEqual(power_state.SHUTDOWN, inst_info['state'])
+        self.assertNotIn('os000001', self.driver._instance_states)
+
+    def test_get_info_power_stat_cache_disabled(self):
+        self.flags(zvm_power_stat_cache_ttl=0)
+        power_stat = self._generate_xcat_resp(['os000001: off\n'])
+        self._set_fake_xcat_responses([power_stat,
+                                       self._fake_reachable_data('noping')])
+        inst_info = self.driver.get_info(self.instance)
+        self.mox.VerifyAll()
+        self.assertEqual(0x04, inst_info['state'])
+
+    def test_get_info_power_stat_not_cached(self):
+        power_stat = self._generate_xcat_resp(['os000001: off\n'])
+        self._set_fake_xcat_responses([self._fake_instance_list_data(),
+                                       self._generate_xcat_resp([]),
+                                       power_stat,
+                                       self._fake_reachable_data('noping')])
+        inst_info = self.driver.get_info(self.instance)
+        self.mox.VerifyAll()
+        self.assertEqual(0x04, inst_info['state'])
+
+    def test_get_power_states(self):
+        self.stubs.Set(const, 'XCAT_BULK_NODERANGE_SIZE', 2)
+        url1 = self._app_auth('/xcatws/nodes/os000001,os000002/power')
+        url2 = self._app_auth('/xcatws/nodes/os000003/power')
+        fake_resp_list = [
+            ("GET", url1, ['stat'], self._gen_resp(
+                info=['os000001: on\nos000002: off\n'])),
+            ("GET", url2, ['stat'], self._gen_resp(
+                info=['os000003: unknown']))]
+        self._set_fake_xcat_resp(fake_resp_list)
+        power_stats = self.driver.get_power_states(
+                            ['os000001', 'os000002', 'os000003'])
+        self.mox.VerifyAll()
+        self.assertEqual({'os000001': power_state.RUNNING,
+                          'os000002': power_state.SHUTDOWN,
+                          'os000003': power_state.NOSTATE}, power_stats)
+
+    def test_power_off_invalidate_power_stat(self):
+        self.driver._power_stats = {'os000001': power_state.RUNNING}
+        self.stubs.Set(instance.ZVMInstance, 'power_off', self._fake_fun())
+        self.driver.power_off(self.instance)
+        self.assertNotIn('os000001', self.driver._power_stats)
+
     def test_destroy(self):
         rmvm_info = ["os000001: Deleting virtual server OS000001... Done"]
         fake_resp_list = [
@@ -387,10 +643,23 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.mox.VerifyAll()
 
     def test_destroy_non_exist(self):
-        self._set_fake_xcat_responses([self._fake_instance_list_data()])
+        # A node missing from the instance list is looked up in xCAT
+        self._set_fake_xcat_responses([self._fake_instance_list_data(),
+                                       {'data': [{'data': []}]}])
         self.driver.destroy({}, self.instance2, {}, {})
         self.mox.VerifyAll()
 
+    def test_instance_exists_not_indexed(self):
+        self._set_fake_xcat_responses([
+            self._fake_instance_list_data(),
+            {'data': [{'data': ['FAKEHCP.fake.com']}]},
+            {'data': [{'data': ['otherhcp.fake.com']}]}])
+        # Created by another process since the instances were listed
+        self.assertTrue(self.driver.instance_exists('os000004'))
+        self.assertTrue(self.driver.instance_exists('os000004'))
+        self.assertFalse(self.driver.instance_exists('os000003'))
+        self.mox.VerifyAll()
+
     def _fake_image_meta(self):
         return {'checksum': '1a2bbbdbcc9c536a2688fc6278685dfb',
                 'container_format': 'bare',
@@ -638,6 +907,129 @@ class ZVMDriverTestCases(ZVMTestCase):
                           'fakepass', self._fake_network_info(), {})
         self.mox.VerifyAll()
 
+    def test_spawn_image_error_after_userid(self):
+        self.stubs.Set(self.driver._pathutils, 'get_instance_path',
+                       self._fake_fun('/temp/os000001'))
+        self.stubs.Set(self.driver, '_create_config_drive',
+                       self._fake_fun('/temp/os000001/configdrive.tgz'))
+        self.stubs.Set(instance.ZVMInstance, 'create_xcat_node',
+                       self._fake_fun())
+        self.stubs.Set(self.driver, '_preset_instance_network',
+                       self._fake_fun())
+        self.stubs.Set(self.driver._networkutils,
+                       "create_network_configuration_files",
+                       self._fake_fun(('/tmp/fakefile', 'fakecmd')))
+        self.stubs.Set(self.driver._zvm_images, 'image_exist_xcat',
+                       self._fake_fun(False))
+        self.stubs.Set(instance.ZVMInstance, 'create_userid',
+                       self._fake_fun())
+        self.stubs.Set(instance.ZVMInstance, 'update_node_info',
+                       self._fake_fun())
+        self.stubs.Set(self.driver._networkop, 'create_nic', self._fake_fun())
+        self.stubs.Set(self.driver._pathutils, 'clean_temp_folder',
+                       self._fake_fun())
+
+        def _import_image_to_xcat(*args):
+            # Fails once the userid has been created
+            greenthread.sleep(0.01)
+            raise exception.ZVMImageError(msg='fake')
+
+        self.stubs.Set(self.driver, '_import_image_to_xcat',
+                       _import_image_to_xcat)
+        self.mox.StubOutWithMock(self.driver, 'destroy')
+        self.mox.StubOutWithMock(instance.ZVMInstance, 'delete_xcat_node')
+        self.driver.destroy({}, self.instance, mox.IgnoreArg(), {})
+        self.mox.ReplayAll()
+
+        self.assertRaises(exception.ZVMImageError, self.driver.spawn, {},
+                          self.instance, self._fake_image_meta(), [],
+                          'fakepass', self._fake_network_info(), {})
+        self.mox.VerifyAll()
+
+    def _set_fake_vif_events(self, exc=None, failed_event=None):
+        waited = []
+
+        @contextlib.contextmanager
+        def _wait_for_instance_event(instance, event_names, deadline=300,
+                                     error_callback=None):
+            yield
+            waited.extend(event_names)
+            if failed_event is not None:
+                error_callback(failed_event, instance)
+            if exc is not None:
+                raise exc
+
+        self.stubs.Set(self.driver.virtapi, 'wait_for_instance_event',
+                       _wait_for_instance_event)
+        return waited
+
+    def _inactive_network_info(self):
+        network_info = self._fake_network_info()
+        for vif in network_info:
+            vif['active'] = False
+        return network_info
+
+    def test_wait_for_vif_plugged(self):
+        waited = self._set_fake_vif_events()
+        self.mox.StubOutWithMock(self.driver, '_wait_for_addnic')
+        self.mox.StubOutWithMock(self.driver, '_is_nic_granted')
+        self.mox.ReplayAll()
+
+        network_info = self._inactive_network_info()
+        with self.driver._wait_for_vif_plugged(self.instance, network_info):
+            pass
+        self.mox.VerifyAll()
+        self.assertEqual([('network-vif-plugged', network_info[0]['id'])],
+                         waited)
+
+    def test_wait_for_vif_plugged_active_ports(self):
+        waited = self._set_fake_vif_events()
+        self.mox.StubOutWithMock(self.driver, '_wait_for_addnic')
+        self.mox.StubOutWithMock(self.driver, '_is_nic_granted')
+        self.driver._wait_for_addnic('os000001')
+        self.driver._is_nic_granted('os000001').AndReturn(True)
+        self.mox.ReplayAll()
+
+        with self.driver._wait_for_vif_plugged(self.instance,
+                                               self._fake_network_info()):
+            pass
+        self.mox.VerifyAll()
+        self.assertEqual([], waited)
+
+    def test_wait_for_vif_plugged_timeout(self):
+        self._set_fake_vif_events(exc=eventlet_timeout.Timeout())
+        self.mox.StubOutWithMock(self.driver, '_wait_for_addnic')
+        self.mox.StubOutWithMock(self.driver, '_is_nic_granted')
+        self.driver._wait_for_addnic('os000001')
+        self.driver._is_nic_granted('os000001').AndReturn(False)
+        self.mox.ReplayAll()
+
+        def _wait():
+            with self.driver._wait_for_vif_plugged(
+                    self.instance, self._inactive_network_info()):
+                pass
+        self.assertRaises(exception.ZVMNetworkError, _wait)
+        self.mox.VerifyAll()
+
+    def test_wait_for_vif_plugged_failed(self):
+        self._set_fake_vif_events(failed_event='network-vif-plugged-fake')
+
+        def _wait():
+            with self.driver._wait_for_vif_plugged(
+                    self.instance, self._inactive_network_info()):
+                pass
+        self.assertRaises(nova_exception.VirtualInterfaceCreateException,
+                          _wait)
+
+        self.flags(vif_plugging_is_fatal=False)
+        self.mox.StubOutWithMock(self.driver, '_wait_for_addnic')
+        self.mox.StubOutWithMock(self.driver, '_is_nic_granted')
+        self.driver._wait_for_addnic('os000001')
+        self.driver._is_nic_granted('os000001').AndReturn(True)
+        self.mox.ReplayAll()
+        _wait()
+        self.mox.VerifyAll()
+
     def test_spawn_deploy_failed(self):
         self.stubs.Set(self.driver._pathutils, 'get_instance_path',
                        self._fake_fun('/temp/os000001'))
@@ -1459,6 +1851,8 @@ class ZVMInstanceTestCases(ZVMTestCase):
             ])
         self._instance.add_mdisk('fakedp', '0101', '1g', 'ext3')
         self.mox.VerifyAll()
+        self.assertEqual({'os000001': 1},
+                         dict(zvmutils.get_diskpool_ledger()._disks))
 
     def test_set_ipl(self):
         info = ["os000001: Adding IPL statement to OS000001's "
@@ -1640,6 +2034,9 @@ class ZVMXCATConnectionTestCases(test.TestCase):
         self.flags(zvm_xcat_server='10.10.10.10',
                    zvm_xcat_username='fake',
                    zvm_xcat_password='fake')
+        self.stubs.Set(zvmutils, '_XCAT_CONN_POOLS', {})
+        self.stubs.Set(zvmutils, '_XCAT_BREAKERS', {})
+        self.stubs.Set(zvmutils, '_XCAT_CACHE', None)
 
     def _set_fake_response(self, response):
         self.mox.StubOutWithMock(httplib.HTTPSConnection, 'request')
@@ -1684,6 +2081,498 @@ class ZVMXCATConnectionTestCases(test.TestCase):
         self.assertRaises(exception.ZVMXCATRequestFailed,
                           conn.request, "GET", 'fakeurl')
 
+    def _fake_https_conn(self):
+        conn = self.mox.CreateMockAnything()
+        httplib.HTTPSConnection('10.10.10.10', timeout=3600).AndReturn(conn)
+        return conn
+
+    def test_connection_reused(self):
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        fake_conn = self._fake_https_conn()
+        for i in range(2):
+            fake_conn.request("GET", 'fakeurl', None, {})
+            fake_conn.getresponse().AndReturn(
+                FakeHTTPResponse(200, 'OK', 'fake'))
+        self.mox.ReplayAll()
+
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        self.mox.VerifyAll()
+
+    def test_connection_closed_by_server(self):
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        fake_conn = self._fake_https_conn()
+        fake_conn.request("GET", 'fakeurl', None, {})
+        fake_conn.getresponse().AndReturn(
+            FakeHTTPResponse(200, 'OK', 'fake', will_close=True))
+        fake_conn.close()
+        new_conn = self._fake_https_conn()
+        new_conn.request("GET", 'fakeurl', None, {})
+        new_conn.getresponse().AndReturn(FakeHTTPResponse(200, 'OK', 'fake'))
+        self.mox.ReplayAll()
+
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        self.mox.VerifyAll()
+
+    def test_reconnect_stale_connection(self):
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        stale_conn = self._fake_https_conn()
+        stale_conn.request("GET", 'fakeurl', None, {})
+        stale_conn.getresponse().AndReturn(
+            FakeHTTPResponse(200, 'OK', 'fake'))
+        stale_conn.request("GET", 'fakeurl', None, {})
+        stale_conn.getresponse().AndRaise(httplib.BadStatusLine(''))
+        stale_conn.close()
+        new_conn = self._fake_https_conn()
+        new_conn.request("GET", 'fakeurl', None, {})
+        new_conn.getresponse().AndReturn(FakeHTTPResponse(200, 'OK', 'fake'))
+        self.mox.ReplayAll()
+
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        self.mox.VerifyAll()
+
+    def test_no_resend_post_received(self):
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        stale_conn = self._fake_https_conn()
+        stale_conn.request("GET", 'fakeurl', None, {})
+        stale_conn.getresponse().AndReturn(
+            FakeHTTPResponse(200, 'OK', 'fake'))
+        # xCAT may have run the request before the response was lost
+        stale_conn.request("POST", 'fakeurl', None, {})
+        stale_conn.getresponse().AndRaise(httplib.BadStatusLine(''))
+        stale_conn.close()
+        self.mox.ReplayAll()
+
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        self.assertRaises(exception.ZVMXCATRequestFailed,
+                          zvmutils.XCATConnection().request, "POST",
+                          'fakeurl')
+        self.mox.VerifyAll()
+
+    def test_resend_post_not_sent(self):
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        stale_conn = self._fake_https_conn()
+        stale_conn.request("GET", 'fakeurl', None, {})
+        stale_conn.getresponse().AndReturn(
+            FakeHTTPResponse(200, 'OK', 'fake'))
+        stale_conn.request("POST", 'fakeurl', None, {}).AndRaise(
+            socket.error('Broken pipe'))
+        stale_conn.close()
+        new_conn = self._fake_https_conn()
+        new_conn.request("POST", 'fakeurl', None, {})
+        new_conn.getresponse().AndReturn(
+            FakeHTTPResponse(201, 'Created', 'fake'))
+        self.mox.ReplayAll()
+
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        zvmutils.XCATConnection().request("POST", 'fakeurl')
+        self.mox.VerifyAll()
+
+    def test_no_reconnect_new_connection(self):
+        self.flags(zvm_xcat_request_retries=0)
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        fake_conn = self._fake_https_conn()
+        fake_conn.request("GET", 'fakeurl', None, {})
+        fake_conn.getresponse().AndRaise(httplib.BadStatusLine(''))
+        fake_conn.close()
+        self.mox.ReplayAll()
+
+        self.assertRaises(exception.ZVMXCATRequestFailed,
+                          zvmutils.XCATConnection().request, "GET", 'fakeurl')
+        self.mox.VerifyAll()
+
+    def test_get_retry_on_communication_error(self):
+        self.flags(zvm_xcat_request_retries=1)
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        self.mox.StubOutWithMock(time, 'sleep')
+        fake_conn = self._fake_https_conn()
+        fake_conn.request("GET", 'fakeurl', None, {}).AndRaise(
+            socket.error('Connection refused'))
+        fake_conn.close()
+        time.sleep(mox.IsA(float))
+        new_conn = self._fake_https_conn()
+        new_conn.request("GET", 'fakeurl', None, {})
+        new_conn.getresponse().AndReturn(FakeHTTPResponse(200, 'OK', 'fake'))
+        self.mox.ReplayAll()
+
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        self.mox.VerifyAll()
+
+    def test_post_no_retry(self):
+        self.flags(zvm_xcat_request_retries=1)
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        fake_conn = self._fake_https_conn()
+        fake_conn.request("POST", 'fakeurl', None, {}).AndRaise(
+            socket.error('Connection refused'))
+        fake_conn.close()
+        self.mox.ReplayAll()
+
+        self.assertRaises(exception.ZVMXCATRequestFailed,
+                          zvmutils.XCATConnection().request, "POST",
+                          'fakeurl')
+        self.mox.VerifyAll()
+
+    def test_retry_interval(self):
+        self.flags(zvm_xcat_retry_interval=2)
+        for attempt, ceiling in ((1, 2), (2, 4), (3, 8), (10, 30)):
+            interval = zvmutils._get_retry_interval(attempt)
+            self.assertTrue(ceiling / 2.0 <= interval <= ceiling)
+
+    def test_breaker_fail_fast(self):
+        self.flags(zvm_xcat_request_retries=0,
+                   zvm_xcat_breaker_threshold=2)
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        for i in range(2):
+            fake_conn = self._fake_https_conn()
+            fake_conn.request("GET", 'fakeurl', None, {}).AndRaise(
+                socket.error('Connection refused'))
+            fake_conn.close()
+        self.mox.ReplayAll()
+
+        for i in range(3):
+            self.assertRaises(exception.ZVMXCATRequestFailed,
+                              zvmutils.XCATConnection().request, "GET",
+                              'fakeurl')
+        self.assertTrue(zvmutils.get_xcat_breaker('10.10.10.10').is_open)
+        self.mox.VerifyAll()
+
+    def test_get_timeout_opens_breaker(self):
+        self.flags(zvm_xcat_read_timeout=1)
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        self.mox.StubOutWithMock(time, 'sleep')
+        hung_conn = self._fake_https_conn()
+        hung_conn.request("GET", 'fakeurl', None, {})
+        # xCAT doesn't respond within the connection timeout
+        hung_conn.getresponse().WithSideEffects(
+            lambda: greenthread.sleep(3600))
+        hung_conn.close()
+        time.sleep(mox.IsA(float))
+        self.mox.ReplayAll()
+
+        start = time.time()
+        self.assertRaises(exception.ZVMXCATRequestFailed,
+                          zvmutils.XCATConnection().request, "GET",
+                          'fakeurl')
+        self.assertTrue(time.time() - start < 10)
+        # The retry fails fast, the breaker is open after one timeout
+        self.assertTrue(zvmutils.get_xcat_breaker('10.10.10.10').is_open)
+        self.mox.VerifyAll()
+
+    def test_breaker_probe_succeeded(self):
+        breaker = zvmutils.get_xcat_breaker('10.10.10.10')
+        breaker._opened_at = time.time() - 3600
+        self.mox.StubOutWithMock(breaker, '_probe')
+        breaker._probe().AndReturn(True)
+        self.mox.ReplayAll()
+
+        breaker.check()
+        self.assertFalse(breaker.is_open)
+        self.mox.VerifyAll()
+
+    def test_breaker_probe_failed(self):
+        breaker = zvmutils.get_xcat_breaker('10.10.10.10')
+        breaker._opened_at = time.time() - 3600
+        self.mox.StubOutWithMock(breaker, '_probe')
+        breaker._probe().AndReturn(False)
+        self.mox.ReplayAll()
+
+        self.assertRaises(exception.ZVMXCATRequestFailed, breaker.check)
+        self.assertTrue(breaker.is_open)
+        self.assertTrue(time.time() - breaker._opened_at < 60)
+        self.mox.VerifyAll()
+
+    def test_select_xcat_server(self):
+        self.flags(zvm_xcat_standby_servers=['10.10.10.11'])
+        self.assertEqual('10.10.10.10', zvmutils.select_xcat_server("GET"))
+
+        zvmutils.get_xcat_conn_pool('10.10.10.10')._slots.acquire()
+        self.assertEqual('10.10.10.11', zvmutils.select_xcat_server("GET"))
+        self.assertEqual('10.10.10.10', zvmutils.select_xcat_server("PUT"))
+
+        zvmutils.get_xcat_breaker('10.10.10.10')._opened_at = time.time()
+        self.assertEqual('10.10.10.11', zvmutils.select_xcat_server("PUT"))
+
+        zvmutils.get_xcat_breaker('10.10.10.11')._opened_at = time.time()
+        self.assertRaises(exception.ZVMXCATRequestFailed,
+                          zvmutils.select_xcat_server, "PUT")
+
+    def test_get_failover(self):
+        self.flags(zvm_xcat_standby_servers=['10.10.10.11'],
+                   zvm_xcat_request_retries=1,
+                   zvm_xcat_breaker_threshold=1)
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        self.mox.StubOutWithMock(time, 'sleep')
+        fake_conn = self._fake_https_conn()
+        fake_conn.request("GET", 'fakeurl', None, {}).AndRaise(
+            socket.error('Connection refused'))
+        fake_conn.close()
+        time.sleep(mox.IsA(float))
+        standby_conn = self.mox.CreateMockAnything()
+        httplib.HTTPSConnection('10.10.10.11', timeout=3600).AndReturn(
+            standby_conn)
+        standby_conn.request("GET", 'fakeurl', None, {})
+        standby_conn.getresponse().AndReturn(
+            FakeHTTPResponse(200, 'OK', 'fake'))
+        self.mox.ReplayAll()
+
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        self.assertTrue(zvmutils.get_xcat_breaker('10.10.10.10').is_open)
+        self.mox.VerifyAll()
+
+    def test_failover_rate_limited_per_server(self):
+        self.flags(zvm_xcat_standby_servers=['10.10.10.11'],
+                   zvm_xcat_request_rate=100)
+        self.stubs.Set(zvmutils, '_XCAT_RATE_LIMITERS', {})
+        self.mox.StubOutWithMock(httplib, 'HTTPSConnection',
+                                 use_mock_anything=True)
+        zvmutils.get_xcat_breaker('10.10.10.10')._opened_at = time.time()
+        standby_conn = self.mox.CreateMockAnything()
+        httplib.HTTPSConnection('10.10.10.11', timeout=3600).AndReturn(
+            standby_conn)
+        standby_conn.request("GET", 'fakeurl', None, {})
+        standby_conn.getresponse().AndReturn(
+            FakeHTTPResponse(200, 'OK', 'fake'))
+        self.mox.ReplayAll()
+
+        zvmutils.XCATConnection().request("GET", 'fakeurl')
+        self.mox.VerifyAll()
+
+        # The request is admitted by the limiter of the standby server
+        def _admitted(host):
+            stats = zvmutils.get_xcat_rate_limiter(host).get_stats()
+            return sum(stat['admitted'] for stat in stats.values())
+        self.assertEqual(0, _admitted('10.10.10.10'))
+        self.assertEqual(1, _admitted('10.10.10.11'))
+
+    def test_pool_idle_eviction(self):
+        pool = zvmutils.XCATConnectionPool('10.10.10.10', 2, 60, 3600)
+        fake_conn = self.mox.CreateMockAnything()
+        fake_conn.close()
+        self.mox.ReplayAll()
+
+        pool._idle.append((fake_conn, 0))
+        conn, reused = pool.get()
+        self.assertFalse(reused)
+        self.assertNotEqual(conn, fake_conn)
+        self.mox.VerifyAll()
+
+
+class ZVMFakeXCATTestCases(ZVMTestCase):
+    """Driver requests served by the local xCAT emulator."""
+
+    def setUp(self):
+        super(ZVMFakeXCATTestCases, self).setUp()
+        self.xcat = fake_xcat.FakeXCAT(username='fake', password='fake',
+                                       master='fakemn', instances=3)
+        self.stubs.Set(zvmutils, 'XCATConnection', FakeXCATConn)
+        self.stubs.Set(zvmutils.XCATConnection, 'request',
+                       lambda conn, method, url, body=None, headers={}:
+                           self._fake_request(method, url, body))
+        self.driver = driver.ZVMDriver(fake.FakeVirtAPI())
+
+    def _fake_request(self, method, url, body):
+        status, resp = self.xcat.handle(method, url, body)
+        return {'status': status, 'reason': 'OK',
+                'message': jsonutils.dumps(resp)}
+
+    def test_list_instances(self):
+        self.assertEqual(['os000001', 'os000002', 'os000003'],
+                         self.driver.list_instances())
+
+    def test_list_instances_filtered_by_hcp(self):
+        self.xcat.add_node('os000004', hcp='FAKEHCP.FAKE.COM')
+        self.xcat.add_node('os000005', hcp='otherhcp.fake.com')
+        self.xcat.add_node('os000006', hcp='fakehcpxfake.com')
+        self.assertEqual(['os000001', 'os000002', 'os000003', 'os000004'],
+                         self.driver.list_instances())
+
+        # xCAT dumps only the rows of the host's zHCP
+        dumps = []
+        handle = self.xcat.handle
+
+        def _handle(method, url, body=None):
+            status, resp = handle(method, url, body)
+            if '/tables/zvm' in url:
+                dumps.append(resp['data'][0]['data'][1:])
+            return status, resp
+
+        self.stubs.Set(self.xcat, 'handle', _handle)
+        self.driver._query_instances('fakehcp.fake.com')
+        self.assertEqual(['fakehcp.fake.com'] * 5 + ['FAKEHCP.FAKE.COM'],
+                         [row.split(',')[1].strip('"') for row in dumps[0]])
+
+    def test_get_power_states(self):
+        zvm_inst = instance.ZVMInstance({'name': 'os000002'})
+        zvm_inst.power_off()
+        self.assertEqual({'os000001': power_state.RUNNING,
+                          'os000002': power_state.SHUTDOWN,
+                          'os000003': power_state.RUNNING},
+                         self.driver.get_power_states(
+                             self.driver.list_instances()))
+
+    def test_host_stats(self):
+        stats = self.driver.get_host_stats()[0]
+        self.assertEqual('fakehcp', stats['zhcp']['nodename'])
+        self.assertEqual('ZHCP', stats['zhcp']['userid'])
+        self.assertEqual(3, stats['vcpus_used'])
+
+    def test_error_injection(self):
+        self.xcat.profile = {'tables/zvm': {'error_rate': 1}}
+        self.assertRaises(exception.ZVMXCATInternalError,
+                          self.driver.list_instances)
+        self.assertEqual(1, self.xcat.stats['GET tables/zvm'])
+
+    def test_reachability_poller(self):
+        self.stubs.Set(const, 'ZVM_REACHABLE_POLL_TICK', 0)
+        zvm_inst = instance.ZVMInstance({'name': 'os000002'})
+        zvm_inst.power_off()
+        poller = zvmutils.get_reachability_poller()
+        pool = greenpool.GreenPool()
+        waiters = [pool.spawn(poller.wait, 'os00000%d' % i, 0.5)
+                   for i in range(1, 4)]
+        self.assertEqual([True, False, True], [w.wait() for w in waiters])
+        # All nodes are polled by one bulk nodestat
+        self.assertEqual(1, self.xcat.stats['GET nodes/status'])
+
+    def test_xcat_call_budget(self):
+        with zvmutils.xcat_call_accounting('test') as calls:
+            self.driver.list_instances()
+        self.assertEqual(1, calls.calls)
+
+        with zvmutils.xcat_call_accounting('test') as calls:
+            self.driver.get_info({'name': 'os000001', 'uuid': 'fakeuuid',
+                                  'memory_mb': 1024, 'vcpus': 1,
+                                  'power_state': 1})
+        # The instance index read by list_instances is used
+        self.assertEqual({'GET nodes/power': 1, 'GET nodes/status': 1,
+                          'GET nodes/inventory': 1},
+                         dict(calls.endpoints))
+        self.assertTrue(calls.time >= 0)
+
+    def _fake_spawn_args(self, name):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.flags(instances_path=tmp_dir, zvm_image_tmp_path=tmp_dir)
+        self.stubs.Set(const, 'ZVM_REACHABLE_POLL_TICK', 0)
+        image_id = '0c1d7b2e-3a5f-4c8e-9d6b-7e2f1a4b5c6d'
+        # The image is already imported, so no local image file is needed
+        self.xcat.add_image(image_id.replace('-', '_'))
+
+        inst = fake_xcat.FakeInstance({
+                    'name': name, 'uuid': 'fakeuuid', 'image_ref': image_id,
+                    'memory_mb': 512, 'vcpus': 1, 'root_gb': 0,
+                    'ephemeral_gb': 0, 'config_drive': None,
+                    'power_state': 1, 'system_metadata': {}})
+        image_meta = {'id': image_id, 'name': 'fakeimg',
+                      'properties': {'image_file_name': 'fake.img',
+                                     'image_type_xcat': 'linux',
+                                     'architecture': 's390x',
+                                     'os_name': 'Linux',
+                                     'os_version': 'rhel6.5',
+                                     'provisioning_method': 'netboot',
+                                     'root_disk_units': '3338'}}
+        subnet = network_model.Subnet(
+                    cidr='10.1.0.0/16',
+                    gateway=network_model.IP(address='10.1.0.1',
+                                             type='gateway'),
+                    ips=[network_model.FixedIP(address='10.1.11.51')])
+        network = network_model.Network(id='fakenetid',
+                                        label='xcat_management',
+                                        subnets=[subnet])
+        network_info = network_model.NetworkInfo([network_model.VIF(
+                    id='fakevifid', address='02:00:00:ee:ae:51',
+                    network=network)])
+        return inst, image_meta, network_info
+
+    def test_spawn_xcat_call_budget(self):
+        inst, image_meta, network_info = self._fake_spawn_args('os000004')
+        self.driver.list_instances()
+        with zvmutils.xcat_call_accounting('spawn') as calls:
+            self.driver.spawn(self.context, inst, image_meta, [], 'pass',
+                              network_info, {})
+        self.assertTrue(calls.calls <= 20, dict(calls.endpoints))
+        # The image is looked up and the userid is created once
+        self.assertEqual(1, calls.endpoints['GET images'])
+        self.assertEqual(1, calls.endpoints['POST vms'])
+        self.assertTrue(self.driver.instance_exists('os000004'))
+
+    def test_destroy_xcat_call_budget(self):
+        self.driver.list_instances()
+        with zvmutils.xcat_call_accounting('destroy') as calls:
+            self.driver.destroy(self.context, {'name': 'os000001',
+                                               'power_state': 1}, [], {})
+        self.assertTrue(calls.calls <= 1, dict(calls.endpoints))
+        self.assertFalse(self.driver.instance_exists('os000001'))
+
+    def test_instance_index_write_through(self):
+        self.assertEqual(['os000001', 'os000002', 'os000003'],
+                         self.driver.list_instances())
+        instance.ZVMInstance({'name': 'os000004'}).create_xcat_node(
+                                                        'fakehcp.fake.com')
+        instance.ZVMInstance({'name': 'os000001'}).delete_userid('fakehcp')
+        self.assertEqual(['os000002', 'os000003', 'os000004'],
+                         self.driver.list_instances())
+        self.assertTrue(self.driver.instance_exists('os000004'))
+        self.assertEqual(1, self.xcat.stats['GET tables/zvm'])
+
+        # The resize node copied from an instance is indexed
+        instance.ZVMInstance({'name': 'rszos000002'}).copy_xcat_node(
+                                                        'os000002')
+        self.assertTrue(self.driver.instance_exists('rszos000002'))
+        self.assertEqual(1, self.xcat.stats['GET tables/zvm'])
+
+    def test_instance_exists_not_indexed(self):
+        self.assertEqual(['os000001', 'os000002', 'os000003'],
+                         self.driver.list_instances())
+        # Defined by another process, e.g. a live migration source host
+        self.xcat.add_node('os000005', hcp='FAKEHCP.fake.com',
+                           userid='OS000005')
+        self.assertTrue(self.driver.instance_exists('os000005'))
+        self.assertFalse(self.driver.instance_exists('os000006'))
+        self.assertEqual(['os000001', 'os000002', 'os000003', 'os000005'],
+                         self.driver.list_instances())
+
+    def test_post_live_migration_at_destination_indexed(self):
+        self.assertEqual(['os000001', 'os000002', 'os000003'],
+                         self.driver.list_instances())
+        self.xcat.add_node('os000005', hcp='fakehcp.fake.com',
+                           userid='OS000005')
+        self.driver.post_live_migration_at_destination(
+                                self.context, {'name': 'os000005'}, [])
+        self.assertIn('os000005', zvmutils.get_instance_index())
+        self.assertEqual(1, self.xcat.stats['GET tables/zvm'])
+
+    def test_https_round_trip(self):
+        try:
+            server = fake_xcat.FakeXCATServer(('localhost', 0), self.xcat)
+        except OSError:
+            self.skipTest('openssl is not available')
+        server.start()
+        self.addCleanup(server.stop)
+        self.stubs.UnsetAll()
+        self.stubs.Set(ssl, '_create_default_https_context',
+                       ssl._create_unverified_context)
+        self.stubs.Set(zvmutils, '_XCAT_CONN_POOLS', {})
+        self.stubs.Set(zvmutils, '_XCAT_CACHE', None)
+        self.flags(zvm_xcat_server=server.address)
+
+        url = zvmutils.XCATUrl().lsdef_node('/os000001')
+        info = zvmutils.xcat_request("GET", url)['info'][0]
+        self.assertIn('    userid=OS000001', info)
+
 
 class ZVMNetworkTestCases(ZVMTestCase):
     """Test cases for network operator."""
@@ -1766,6 +2655,911 @@ class ZVMUtilsTestCases(ZVMTestCase):
         zvmutils._log_warnings(resp)
         self.mox.VerifyAll()
 
+    def test__log_warnings_nested(self):
+        resp = {'info': [],
+                'data': [['#node,hcp', '"fakenode","fakehcp"'],
+                         ['fakenode: WARNING: disk is full']],
+                'node': [],
+                'error': []}
+        self.mox.StubOutWithMock(zvmutils.LOG, 'warn')
+        zvmutils.LOG.warn(_("Warning from xCAT: %s") % str(resp['data']))
+        self.mox.ReplayAll()
+
+        zvmutils._log_warnings(resp)
+        self.mox.VerifyAll()
+
+    def test__log_warnings_no_warning(self):
+        resp = {'info': [['fakenode: on']],
+                'data': [['#node,hcp', '"fakenode","fakehcp"']],
+                'node': [[{'name': ['fakenode'], 'data': ['sshd']}]],
+                'error': []}
+        self.mox.StubOutWithMock(zvmutils.LOG, 'warn')
+        self.mox.ReplayAll()
+
+        zvmutils._log_warnings(resp)
+        self.mox.VerifyAll()
+
+    def test_load_xcat_resp(self):
+        message = jsonutils.dumps({'data': [
+            {'info': ['info1']},
+            {'data': ['data1'], 'errorcode': ['0']},
+            {'info': ['info2'], 'unknown': ['ignored']},
+            {'error': ['Warning: Permanently added fakenode']}]})
+        resp = zvmutils.load_xcat_resp(message)
+        self.assertEqual({'info': [['info1'], ['info2']],
+                          'data': [['data1']],
+                          'node': [],
+                          'errorcode': [['0']],
+                          'error': [['Warning: Permanently added fakenode']]},
+                         resp)
+
+    def test_load_xcat_resp_error(self):
+        message = jsonutils.dumps({'data': [{'error': ['fake error']}]})
+        self.assertRaises(exception.ZVMXCATInternalError,
+                          zvmutils.load_xcat_resp, message)
+
+    def _fake_slow_xcat_request(self, calls, result=None, error=None):
+        def _fake_request(method, url, body=None, headers={}):
+            calls.append((method, url))
+            greenthread.sleep(0.01)
+            if error is not None:
+                raise error
+            return result
+        self.stubs.Set(zvmutils, '_xcat_request', _fake_request)
+
+    def test_xcat_request_coalesced(self):
+        self.stubs.Set(zvmutils, '_XCAT_COALESCER',
+                       zvmutils.XCATRequestCoalescer())
+        calls = []
+        self._fake_slow_xcat_request(calls, {'data': [['fake']]})
+
+        threads = [greenthread.spawn(zvmutils.xcat_request, "GET", 'fakeurl')
+                   for i in range(3)]
+        results = [t.wait() for t in threads]
+
+        self.assertEqual([("GET", 'fakeurl')], calls)
+        self.assertEqual([{'data': [['fake']]}] * 3, results)
+        self.assertFalse(results[0] is results[1])
+        stats = zvmutils.get_xcat_coalesce_stats()
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(2, stats['coalesced'])
+
+    def test_xcat_request_coalesced_error(self):
+        self.stubs.Set(zvmutils, '_XCAT_COALESCER',
+                       zvmutils.XCATRequestCoalescer())
+        calls = []
+        err = exception.ZVMXCATRequestFailed(xcatserver='fakemn', msg='err')
+        self._fake_slow_xcat_request(calls, error=err)
+
+        threads = [greenthread.spawn(zvmutils.xcat_request, "GET", 'fakeurl')
+                   for i in range(2)]
+        for t in threads:
+            self.assertRaises(exception.ZVMXCATRequestFailed, t.wait)
+        self.assertEqual(1, len(calls))
+
+    def test_xcat_request_not_coalesced(self):
+        self.stubs.Set(zvmutils, '_XCAT_COALESCER',
+                       zvmutils.XCATRequestCoalescer())
+        calls = []
+        self._fake_slow_xcat_request(calls, {'data': []})
+
+        threads = [greenthread.spawn(zvmutils.xcat_request, "PUT", 'fakeurl'),
+                   greenthread.spawn(zvmutils.xcat_request, "PUT", 'fakeurl'),
+                   greenthread.spawn(zvmutils.xcat_request, "GET", 'otherurl')]
+        for t in threads:
+            t.wait()
+        self.assertEqual(3, len(calls))
+        self.assertEqual(0, zvmutils.get_xcat_coalesce_stats()['coalesced'])
+
+    def test_xcat_request_not_coalesced_after_write(self):
+        self.stubs.Set(zvmutils, '_XCAT_COALESCER',
+                       zvmutils.XCATRequestCoalescer())
+        calls = []
+
+        def _fake_request(method, url, body=None, headers={}):
+            calls.append(method)
+            num = len(calls)
+            # The first GET is still in flight after the write
+            greenthread.sleep(0.05 if num == 1 else 0)
+            return {'data': [[str(num)]]}
+
+        self.stubs.Set(zvmutils, '_xcat_request', _fake_request)
+        xurl = zvmutils.XCATUrl()
+        url = xurl.gettab('/zvm', '&col=node=os000001&attribute=hcp')
+
+        first = greenthread.spawn(zvmutils.xcat_request, "GET", url)
+        greenthread.sleep(0)
+        # The GET issued after the write doesn't join the flight before it
+        zvmutils.xcat_request("PUT", xurl.chtab('/os000001'), ['zvm.hcp=h'])
+        self.assertEqual({'data': [['3']]}, zvmutils.xcat_request("GET", url))
+        self.assertEqual({'data': [['1']]}, first.wait())
+        self.assertEqual(["GET", "PUT", "GET"], calls)
+        self.assertEqual(0, zvmutils.get_xcat_coalesce_stats()['coalesced'])
+
+    def _fake_counted_xcat_request(self, calls):
+        def _fake_request(method, url, body=None, headers={}):
+            calls.append((method, url))
+            return {'info': [['userid=%s' % len(calls)]]}
+        self.stubs.Set(zvmutils, '_xcat_request', _fake_request)
+
+    def test_xcat_request_cached(self):
+        calls = []
+        self._fake_counted_xcat_request(calls)
+        url = zvmutils.XCATUrl().lsdef_node('/os000001')
+
+        res1 = zvmutils.xcat_request("GET", url)
+        res1['info'].append('modified')
+        res2 = zvmutils.xcat_request("GET", url)
+        self.assertEqual(1, len(calls))
+        self.assertEqual({'info': [['userid=1']]}, res2)
+
+        stats = zvmutils.get_xcat_cache().get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_xcat_request_not_cached(self):
+        calls = []
+        self._fake_counted_xcat_request(calls)
+        url = zvmutils.XCATUrl().rpower('/os000001')
+
+        zvmutils.xcat_request("GET", url, ['stat'])
+        zvmutils.xcat_request("GET", url, ['stat'])
+        self.assertEqual(2, len(calls))
+
+        # Images may be deleted by other hosts sharing the xCAT MN
+        url = zvmutils.XCATUrl().lsdef_image(addp='&criteria=profile=~fake')
+        zvmutils.xcat_request("GET", url)
+        zvmutils.xcat_request("GET", url)
+        self.assertEqual(4, len(calls))
+
+    def test_xcat_request_cache_expired(self):
+        calls = []
+        self._fake_counted_xcat_request(calls)
+        url = zvmutils.XCATUrl().rinv('/fakenode', '&field=--diskpoolspace')
+
+        now = [1000]
+        self.stubs.Set(time, 'time', lambda: now[0])
+
+        zvmutils.xcat_request("GET", url)
+        now[0] = 1059
+        zvmutils.xcat_request("GET", url)
+        self.assertEqual(1, len(calls))
+        now[0] = 1060
+        zvmutils.xcat_request("GET", url)
+        self.assertEqual(2, len(calls))
+
+    def test_xcat_request_cache_invalidated(self):
+        calls = []
+        self._fake_counted_xcat_request(calls)
+        xurl = zvmutils.XCATUrl()
+        node_url = xurl.lsdef_node('/os000001')
+        other_url = xurl.lsdef_node('/os000002')
+        provmethod_url = xurl.gettab('/nodetype',
+                                     '&col=node=os000001&attribute=provmethod')
+
+        for url in (node_url, other_url, provmethod_url):
+            zvmutils.xcat_request("GET", url)
+        zvmutils.xcat_request("PUT", xurl.xdsh('/os000001'), ['command=ls'])
+        zvmutils.xcat_request("PUT", xurl.chtab('/os000001'),
+                              ['nodetype.provmethod=netboot'])
+        for url in (node_url, other_url, provmethod_url):
+            zvmutils.xcat_request("GET", url)
+
+        self.assertEqual([node_url, other_url, provmethod_url, node_url,
+                          provmethod_url],
+                         [c[1] for c in calls if c[0] == "GET"])
+        self.assertEqual(2, zvmutils.get_xcat_cache().get_stats()[
+                            'invalidations'])
+
+    def test_xcat_request_cache_invalidated_by_tabch(self):
+        calls = []
+        self._fake_counted_xcat_request(calls)
+        xurl = zvmutils.XCATUrl()
+        node_url = xurl.lsdef_node('/os000001')
+
+        zvmutils.xcat_request("GET", node_url)
+        zvmutils.xcat_request("PUT", xurl.tabch('/mac'),
+                              ['node=os000001 mac.mac=02:00:00:12:34:56'])
+        self.assertEqual({'info': [['userid=3']]},
+                         zvmutils.xcat_request("GET", node_url))
+        self.assertEqual([node_url, node_url],
+                         [c[1] for c in calls if c[0] == "GET"])
+
+    def test_get_endpoint_class(self):
+        xurl = zvmutils.XCATUrl()
+        urls = {xurl.rpower('/os000001'): 'nodes/power',
+                xurl.lsdef_node('/os000001'): 'nodes',
+                xurl.rinv('/fakenode', '&field=--diskpoolspace'):
+                    'nodes/inventory',
+                xurl.tabdump('/zvm'): 'tables/zvm',
+                xurl.chvm('/os000001'): 'vms',
+                xurl.imgcapture('/os000001'): 'images/capture',
+                xurl.lsdef_image(addp='&criteria=profile=~fake'): 'images',
+                xurl.rmobject('/fakeimg'): 'objects/osimage',
+                'fakeurl': 'unknown'}
+        for url, endpoint in urls.items():
+            self.assertEqual(endpoint, zvmutils._get_endpoint_class(url))
+
+    def test_xcat_request_stats(self):
+        self.stubs.Set(zvmutils, '_XCAT_REQUEST_STATS',
+                       zvmutils.XCATRequestStats('nova_zvm_xcat'))
+        self.flags(zvm_xcat_password='fakepass')
+        self._set_fake_xcat_responses([self._gen_resp(info=['on']),
+                                       self._gen_resp(error=['error'])])
+        url = zvmutils.XCATUrl().rpower('/os000001')
+        zvmutils.xcat_request("GET", url, ['stat'])
+        self.assertRaises(exception.ZVMXCATInternalError,
+                          zvmutils.xcat_request, "GET", url, ['stat'])
+
+        stats = zvmutils.get_xcat_request_stats()
+        summary = stats.get_summary()['GET nodes/power']
+        self.assertEqual(2, summary['count'])
+        self.assertEqual(1, summary['errors'])
+        self.assertTrue(summary['bytes'] > 0)
+
+        metrics = stats.to_prometheus()
+        self.assertIn('nova_zvm_xcat_requests_total{method="GET",'
+                      'endpoint="nodes/power"} 2', metrics)
+        self.assertIn('nova_zvm_xcat_request_duration_seconds_count{'
+                      'method="GET",endpoint="nodes/power"} 2', metrics)
+        self.assertNotIn('fakepass', metrics)
+        self.assertNotIn('os000001', metrics)
+
+    def test_xcat_request_stats_flush(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        metrics_file = os.path.join(tmp_dir, 'xcat.prom')
+        self.flags(zvm_xcat_metrics_file=metrics_file,
+                   zvm_xcat_metrics_interval=0)
+        stats = zvmutils.XCATRequestStats('nova_zvm_xcat')
+        stats.record("PUT", zvmutils.XCATUrl().xdsh('/os000001'), 0.2, 10,
+                     False)
+        self.mox.StubOutWithMock(zvmutils.LOG, 'info')
+        zvmutils.LOG.info(mox.IgnoreArg())
+        self.mox.ReplayAll()
+
+        stats.maybe_flush()
+        self.mox.VerifyAll()
+        with open(metrics_file) as f:
+            metrics = f.read()
+        self.assertIn('nova_zvm_xcat_request_duration_seconds_bucket{'
+                      'method="PUT",endpoint="nodes/dsh",le="0.25"} 1',
+                      metrics)
+        self.assertIn('nova_zvm_xcat_request_duration_seconds_bucket{'
+                      'method="PUT",endpoint="nodes/dsh",le="0.1"} 0',
+                      metrics)
+
+    def test_xcat_request_cache_lru(self):
+        self.flags(zvm_xcat_cache_size=2)
+        calls = []
+        self._fake_counted_xcat_request(calls)
+        urls = [zvmutils.XCATUrl().lsdef_node('/os00000%d' % i)
+                for i in range(3)]
+
+        for url in (urls[0], urls[1], urls[0], urls[2], urls[0], urls[1]):
+            zvmutils.xcat_request("GET", url)
+        self.assertEqual([urls[0], urls[1], urls[2], urls[1]],
+                         [c[1] for c in calls])
+
+    def _fake_concurrent_xcat_request(self, in_flight):
+        def _fake_request(method, url, body=None):
+            in_flight.append(url)
+            in_flight_max[0] = max(in_flight_max[0], len(in_flight))
+            # Let later requests finish first
+            greenthread.sleep(0.01 * (10 - int(url[-1])))
+            in_flight.remove(url)
+            if url.endswith('9'):
+                raise exception.ZVMXCATInternalError(msg=url)
+            return {'info': [[url]]}
+        in_flight_max = [0]
+        self.stubs.Set(zvmutils, 'xcat_request', _fake_request)
+        return in_flight_max
+
+    def test_xcat_request_many(self):
+        in_flight_max = self._fake_concurrent_xcat_request([])
+        urls = ['/fakeurl%d' % i for i in range(5)]
+        results = zvmutils.xcat_request_many([("GET", u) for u in urls],
+                                             concurrency=3)
+        self.assertEqual([[[u]] for u in urls],
+                         [r['info'] for r in results])
+        self.assertEqual(3, in_flight_max[0])
+
+    def test_xcat_request_many_sequential(self):
+        in_flight_max = self._fake_concurrent_xcat_request([])
+        urls = ['/fakeurl%d' % i for i in range(3)]
+        results = zvmutils.xcat_request_many([("GET", u) for u in urls],
+                                             concurrency=1)
+        self.assertEqual(3, len(results))
+        self.assertEqual(1, in_flight_max[0])
+
+    def test_xcat_request_many_error(self):
+        in_flight = []
+        self._fake_concurrent_xcat_request(in_flight)
+        urls = ['/fakeurl1', '/fakeurl9', '/fakeurl2']
+        self.assertRaises(exception.ZVMXCATInternalError,
+                          zvmutils.xcat_request_many,
+                          [("GET", u) for u in urls])
+        self.assertEqual([], in_flight)
+
+    def test_xcat_rate_limiter_priority(self):
+        limiter = zvmutils.XCATRateLimiter('fakehost', 20, 1)
+        limiter.acquire(const.XCAT_PRIORITY_BACKGROUND)
+        admitted = []
+
+        def _acquire(priority):
+            limiter.acquire(priority)
+            admitted.append(const.XCAT_PRIORITY_NAMES[priority])
+
+        pool = greenpool.GreenPool()
+        pool.spawn(_acquire, const.XCAT_PRIORITY_BACKGROUND)
+        pool.spawn(_acquire, const.XCAT_PRIORITY_BACKGROUND)
+        pool.spawn(_acquire, const.XCAT_PRIORITY_INTERACTIVE)
+        greenthread.sleep(0)
+        stats = limiter.get_stats()
+        self.assertEqual(2, stats['background']['queued'])
+        self.assertEqual(1, stats['interactive']['queued'])
+
+        pool.waitall()
+        self.assertEqual(['interactive', 'background', 'background'],
+                         admitted)
+        stats = limiter.get_stats()
+        self.assertEqual(0, stats['background']['queued'])
+        self.assertEqual(2, stats['background']['max_queued'])
+        self.assertEqual(3, stats['background']['admitted'])
+        self.assertEqual(1, stats['interactive']['admitted'])
+        self.assertEqual(0, stats['provisioning']['admitted'])
+
+    def test_xcat_rate_limiter_disabled(self):
+        limiter = zvmutils.XCATRateLimiter('fakehost', 0, 1)
+        for i in range(100):
+            limiter.acquire(const.XCAT_PRIORITY_BACKGROUND)
+        self.assertEqual(0, limiter.get_stats()['background']['admitted'])
+
+    def test_get_request_priority(self):
+        xurl = zvmutils.XCATUrl()
+        self.assertEqual(const.XCAT_PRIORITY_INTERACTIVE,
+                         zvmutils._get_request_priority(
+                             "PUT", xurl.rpower('/os000001')))
+        self.assertEqual(const.XCAT_PRIORITY_PROVISIONING,
+                         zvmutils._get_request_priority(
+                             "GET", xurl.lsdef_node('/os000001')))
+        with zvmutils.xcat_request_priority(const.XCAT_PRIORITY_BACKGROUND):
+            self.assertEqual(const.XCAT_PRIORITY_BACKGROUND,
+                             zvmutils._get_request_priority(
+                                 "PUT", xurl.rpower('/os000001')))
+        self.assertEqual(const.XCAT_PRIORITY_INTERACTIVE,
+                         zvmutils._get_request_priority(
+                             "PUT", xurl.rpower('/os000001')))
+
+    def test_get_request_priority_vms(self):
+        xurl = zvmutils.XCATUrl()
+        url = xurl.chvm('/os000001')
+        self.assertEqual(const.XCAT_PRIORITY_INTERACTIVE,
+                         zvmutils._get_request_priority("PUT", url,
+                             ['--dedicatedevice 5000 5000 0']))
+        self.assertEqual(const.XCAT_PRIORITY_INTERACTIVE,
+                         zvmutils._get_request_priority("PUT", url,
+                             ['--removezfcp 5000 fakewwpn fakelun 1']))
+        # mkvm, punch, rmvm and lsvm requests are provisioning
+        self.assertEqual(const.XCAT_PRIORITY_PROVISIONING,
+                         zvmutils._get_request_priority("POST",
+                             xurl.mkvm('/os000001'), ['profile=fakeprof']))
+        self.assertEqual(const.XCAT_PRIORITY_PROVISIONING,
+                         zvmutils._get_request_priority("PUT", url,
+                             ['--punchfile /tmp/fakefile X fakehost']))
+        self.assertEqual(const.XCAT_PRIORITY_PROVISIONING,
+                         zvmutils._get_request_priority("DELETE",
+                             xurl.rmvm('/os000001')))
+        self.assertEqual(const.XCAT_PRIORITY_PROVISIONING,
+                         zvmutils._get_request_priority("GET",
+                             xurl.lsvm('/os000001')))
+
+    def test_xcat_request_many_priority(self):
+        priorities = []
+
+        def _fake_request(method, url, body=None):
+            priorities.append(zvmutils._get_request_priority(method, url))
+        self.stubs.Set(zvmutils, 'xcat_request', _fake_request)
+
+        with zvmutils.xcat_request_priority(const.XCAT_PRIORITY_BACKGROUND):
+            zvmutils.xcat_request_many([("GET", '/fakeurl1'),
+                                        ("GET", '/fakeurl2')])
+        self.assertEqual([const.XCAT_PRIORITY_BACKGROUND] * 2, priorities)
+
+    def test_xcat_call_accounting(self):
+        self.stubs.Set(zvmutils, '_XCAT_CACHE', None)
+        self.stubs.Set(zvmutils, 'XCATConnection', FakeXCATConn)
+        self.stubs.Set(zvmutils.XCATConnection, 'request',
+                       lambda conn, method, url, body=None, headers={}:
+                           {'message': ''})
+        self.stubs.Set(zvmutils, 'load_xcat_resp', lambda message: {})
+
+        @zvmutils.account_xcat_calls
+        def _operation(nested):
+            zvmutils.xcat_request("GET", '/fakeurl1')
+            if nested:
+                _operation(False)
+            return zvmutils.get_xcat_call_accounting()
+
+        accounting = _operation(True)
+        self.assertEqual('_operation', accounting.operation)
+        self.assertEqual(2, accounting.calls)
+        self.assertIsNone(zvmutils.get_xcat_call_accounting())
+
+        with zvmutils.xcat_call_accounting('fakeop') as accounting:
+            zvmutils.xcat_request_many([("GET", '/fakeurl1'),
+                                        ("PUT", '/fakeurl2')])
+        self.assertEqual(2, accounting.calls)
+
+    def test_get_disk_size_gb(self):
+        self.assertEqual(2, zvmutils.get_disk_size_gb('2g'))
+        self.assertEqual(0.5, zvmutils.get_disk_size_gb('512M'))
+        self.assertEqual(1, zvmutils.get_disk_size_gb(2097152))
+        self.flags(zvm_diskpool_type='ECKD')
+        self.assertAlmostEqual(2.64, zvmutils.get_disk_size_gb('3338'), 2)
+        self.assertRaises(exception.ZVMDriverError,
+                          zvmutils.get_disk_size_gb, '1t')
+
+    def test_diskpool_ledger(self):
+        ledger = zvmutils.DiskPoolLedger(600)
+        self.assertTrue(ledger.needs_inventory())
+        ledger.update({'disk_total': 100, 'disk_used': 60,
+                       'disk_available': 40})
+        self.assertFalse(ledger.needs_inventory())
+
+        ledger.allocate('os000001', '10g')
+        ledger.allocate('os000001', '5g')
+        ledger.allocate('os000002', '1g')
+        self.assertEqual({'disk_total': 100, 'disk_used': 76,
+                          'disk_available': 24}, ledger.get_info())
+        ledger.free('os000001')
+        self.assertEqual(61, ledger.get_info()['disk_used'])
+        self.assertFalse(ledger.needs_inventory())
+
+        # The minidisks of os000003 were not added by the ledger
+        ledger.free('os000003')
+        self.assertTrue(ledger.needs_inventory())
+        ledger.update({'disk_total': 100, 'disk_used': 50,
+                       'disk_available': 50})
+        self.assertFalse(ledger.needs_inventory())
+        ledger.free('os000002')
+        self.assertEqual(49, ledger.get_info()['disk_used'])
+
+    def test_diskpool_ledger_inventory_in_flight(self):
+        ledger = zvmutils.DiskPoolLedger(600)
+        ledger.update({'disk_total': 100, 'disk_used': 60,
+                       'disk_available': 40})
+        ledger.allocate('os000001', '10g')
+        inventory = ledger.start_inventory()
+        # Allocated while the inventory is queried, so not counted by it
+        ledger.allocate('os000002', '5g')
+        ledger.update({'disk_total': 100, 'disk_used': 70,
+                       'disk_available': 30}, inventory)
+        self.assertEqual({'disk_total': 100, 'disk_used': 75,
+                          'disk_available': 25}, ledger.get_info())
+        self.assertFalse(ledger.needs_inventory())
+
+    def test_diskpool_ledger_inventories_overlapped(self):
+        ledger = zvmutils.DiskPoolLedger(600)
+        ledger.update({'disk_total': 100, 'disk_used': 60,
+                       'disk_available': 40})
+        ledger.allocate('os000001', '10g')
+        # A forced refresh starts while the background one is in flight
+        first = ledger.start_inventory()
+        second = ledger.start_inventory()
+        ledger.update({'disk_total': 100, 'disk_used': 70,
+                       'disk_available': 30}, second)
+        ledger.update({'disk_total': 100, 'disk_used': 70,
+                       'disk_available': 30}, first)
+        self.assertEqual({'disk_total': 100, 'disk_used': 70,
+                          'disk_available': 30}, ledger.get_info())
+
+        # The earlier inventory finishing last doesn't reconcile either
+        ledger.allocate('os000002', '5g')
+        first = ledger.start_inventory()
+        second = ledger.start_inventory()
+        ledger.update({'disk_total': 100, 'disk_used': 75,
+                       'disk_available': 25}, first)
+        self.assertEqual(75, ledger.get_info()['disk_used'])
+        ledger.update({'disk_total': 100, 'disk_used': 75,
+                       'disk_available': 25}, second)
+        self.assertEqual(75, ledger.get_info()['disk_used'])
+        self.assertFalse(ledger.needs_inventory())
+
+    def test_diskpool_ledger_drift(self):
+        ledger = zvmutils.DiskPoolLedger(600)
+        ledger.update({'disk_total': 100, 'disk_used': 60,
+                       'disk_available': 40})
+        ledger.allocate('os000001', '10g')
+        # 5G were used outside of the driver
+        ledger.update({'disk_total': 100, 'disk_used': 75,
+                       'disk_available': 25}, ledger.start_inventory())
+        self.assertEqual(75, ledger.get_info()['disk_used'])
+        self.assertTrue(ledger.needs_inventory())
+
+        ledger.update({'disk_total': 100, 'disk_used': 80,
+                       'disk_available': 20}, ledger.start_inventory())
+        self.assertFalse(ledger.needs_inventory())
+
+    def test_instance_index(self):
+        index = zvmutils.InstanceIndex(300)
+        self.assertTrue(index.needs_reconcile('fakehcp'))
+        started_at = time.time()
+        # Changes made while the zvm table is read
+        index.add('os000003', 'FAKEHCP')
+        index.remove('os000001')
+        index.add('os000004', 'otherhcp')
+        index.reconcile('fakehcp', ['os000001', 'os000002'], started_at)
+        self.assertFalse(index.needs_reconcile('fakehcp'))
+        self.assertTrue(index.needs_reconcile('otherhcp'))
+        self.assertEqual(['os000002', 'os000003'], index.get_nodes())
+
+        index.add('os000005', 'fakehcp')
+        index.remove('os000002')
+        self.assertIn('os000005', index)
+        self.assertNotIn('os000002', index)
+
+        # Older changes are dropped by the next reconcile
+        index.reconcile('fakehcp', ['os000001'], time.time() + 1)
+        self.assertEqual(['os000001'], index.get_nodes())
+        index.invalidate()
+        self.assertTrue(index.needs_reconcile('fakehcp'))
+
+    def test_step_graph(self):
+        events = []
+
+        def _step(name, delay=0):
+            def _run():
+                events.append(name + ' start')
+                greenthread.sleep(delay)
+                events.append(name + ' end')
+            return _run
+
+        steps = zvmutils.StepGraph()
+        steps.add('node', _step('node', 0.01))
+        steps.add('image', _step('image', 0.05))
+        steps.add('userid', _step('userid', 0.01), ['node'])
+        steps.add('deploy', _step('deploy'), ['userid', 'image'])
+        steps.run()
+
+        # The image step runs alongside node and userid
+        self.assertEqual(['node start', 'image start', 'node end',
+                          'userid start', 'userid end', 'image end',
+                          'deploy start', 'deploy end'], events)
+
+    def test_step_graph_failed(self):
+        events = []
+
+        def _fail():
+            raise exception.ZVMXCATCreateNodeFailed(node='os000001',
+                                                    msg='fake')
+
+        def _import():
+            greenthread.sleep(0.01)
+            events.append('image')
+
+        steps = zvmutils.StepGraph()
+        steps.add('node', _fail)
+        steps.add('image', _import)
+        steps.add('userid', lambda: events.append('userid'), ['node'])
+        self.assertRaises(exception.ZVMXCATCreateNodeFailed, steps.run)
+        # The running step is waited for, the dependent one is not run
+        self.assertEqual(['image'], events)
+
+        steps = zvmutils.StepGraph()
+        steps.add('userid', lambda: None, ['unknown'])
+        self.assertRaises(exception.ZVMDriverError, steps.run)
+
+    def test_step_graph_completed(self):
+        def _fail():
+            greenthread.sleep(0.01)
+            raise exception.ZVMImageError(msg='fake')
+
+        steps = zvmutils.StepGraph()
+        steps.add('image', _fail)
+        steps.add('userid', lambda: None)
+        steps.add('nics', lambda: None, ['userid', 'image'])
+        self.assertRaises(exception.ZVMImageError, steps.run)
+        self.assertEqual(set(['userid']), steps.completed)
+        self.assertEqual(set(['image']), steps.failed)
+
+    def test_reachability_poller(self):
+        self.stubs.Set(const, 'ZVM_REACHABLE_POLL_TICK', 0)
+        polls = []
+        booted = set()
+
+        def _query_reachable(nodes):
+            polls.append(nodes)
+            booted.update(['os000001', 'os000002'][:len(polls)])
+            return booted.intersection(nodes)
+
+        poller = zvmutils.ReachabilityPoller(intervals=((None, 0),))
+        self.stubs.Set(poller, '_query_reachable', _query_reachable)
+        pool = greenpool.GreenPool()
+        waiters = [pool.spawn(poller.wait, node, 0)
+                   for node in ('os000002', 'os000001')]
+        self.assertEqual([True, True], [w.wait() for w in waiters])
+        self.assertEqual([['os000001', 'os000002'], ['os000002']], polls)
+        self.assertIsNone(poller._poller)
+
+    def test_reachability_poller_timeout(self):
+        self.stubs.Set(const, 'ZVM_REACHABLE_POLL_TICK', 0.01)
+        poller = zvmutils.ReachabilityPoller(intervals=((None, 0),))
+        self.stubs.Set(poller, '_query_reachable', lambda nodes: set())
+        self.assertFalse(poller.wait('os000001', 0.05))
+        self.assertEqual([], poller._waiters)
+
+    def test_reachability_poller_poll_failed(self):
+        self.stubs.Set(const, 'ZVM_REACHABLE_POLL_TICK', 0.01)
+        polls = []
+
+        def _get_reachable(nodes):
+            polls.append(nodes)
+            if len(polls) == 1:
+                raise exception.ZVMXCATInternalError(msg='fake')
+            return set(nodes)
+
+        poller = zvmutils.ReachabilityPoller(intervals=((None, 0),))
+        self.stubs.Set(poller, '_get_reachable', _get_reachable)
+        # The poller keeps polling after an error
+        self.assertTrue(poller.wait('os000001', 0))
+        self.assertEqual(2, len(polls))
+
+        def _bad_response(nodes):
+            raise KeyError('node')
+
+        # The waiters still expire when every poll fails
+        self.stubs.Set(poller, '_get_reachable', _bad_response)
+        self.assertFalse(poller.wait('os000001', 0.05))
+        greenthread.sleep(0.02)
+        self.assertIsNone(poller._poller)
+
+    def test_reachability_poller_fatal_error(self):
+        poller = zvmutils.ReachabilityPoller()
+        self.stubs.Set(poller, '_get_reachable', lambda nodes: set())
+
+        def _expire_waiters():
+            raise greenthread.greenlet.GreenletExit()
+
+        self.stubs.Set(poller, '_expire_waiters', _expire_waiters)
+        pool = greenpool.GreenPool()
+        waiters = [pool.spawn(poller.wait, node, 0)
+                   for node in ('os000001', 'os000002')]
+        self.assertEqual([False, False], [w.wait() for w in waiters])
+        self.assertEqual([], poller._waiters)
+
+    def test_reachability_poller_query_failed(self):
+        polls = []
+
+        def _query_reachable(nodes):
+            polls.append(nodes)
+            if 'os000002' in nodes:
+                raise exception.ZVMXCATInternalError(msg='Invalid nodes')
+            return set(nodes)
+
+        poller = zvmutils.ReachabilityPoller()
+        self.stubs.Set(poller, '_query_reachable', _query_reachable)
+        self.assertEqual(set(['os000001', 'os000003']),
+                         poller._get_reachable(['os000001', 'os000002',
+                                                'os000003']))
+        self.assertEqual(4, len(polls))
+
+    def test_mn_pub_key_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.flags(zvm_image_tmp_path=os.path.join(tmp_dir, 'images'))
+        queries = []
+
+        def _query_mn_pub_key():
+            queries.append(CONF.zvm_xcat_master)
+            return 'ssh-rsa key%d' % len(queries)
+
+        self.stubs.Set(zvmutils, '_query_mn_pub_key', _query_mn_pub_key)
+        self.stubs.Set(zvmutils, '_query_mn_boot_id', lambda: 'boot1')
+        self.assertEqual('ssh-rsa key1', zvmutils.get_mn_pub_key())
+        self.assertEqual('ssh-rsa key1', zvmutils.get_mn_pub_key())
+        self.assertEqual(1, len(queries))
+
+        # The key is kept in the file across restarts
+        key_file = os.path.join(tmp_dir, 'images', const.XCAT_MN_KEYS_FILE)
+        self.stubs.Set(zvmutils, '_MN_PUB_KEY_CACHE', None)
+        self.assertEqual('ssh-rsa key1', zvmutils.get_mn_pub_key())
+        self.assertEqual(1, len(queries))
+
+        # Keyed by MN
+        self.flags(zvm_xcat_master='fakemn2')
+        self.assertEqual('ssh-rsa key2', zvmutils.get_mn_pub_key())
+        self.flags(zvm_xcat_master='fakemn')
+        self.assertEqual('ssh-rsa key1', zvmutils.get_mn_pub_key())
+        with open(key_file) as f:
+            self.assertEqual(['10.10.10.10/fakemn', '10.10.10.10/fakemn2'],
+                             sorted(jsonutils.loads(f.read())))
+
+    def test_mn_pub_key_cache_mn_changed(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.flags(zvm_image_tmp_path=tmp_dir)
+        mn = {'key': 'ssh-rsa key1', 'boot_id': 'boot1'}
+        self.stubs.Set(zvmutils, '_query_mn_pub_key', lambda: mn['key'])
+        self.stubs.Set(zvmutils, '_query_mn_boot_id', lambda: mn['boot_id'])
+        self.assertEqual('ssh-rsa key1', zvmutils.get_mn_pub_key())
+        zvmutils.check_mn_pub_key()
+        self.assertEqual('ssh-rsa key1', zvmutils.get_mn_pub_key())
+
+        # The MN is restarted with a new key, the xCAT server stays up
+        mn.update(key='ssh-rsa key2', boot_id='boot2')
+        zvmutils.check_mn_pub_key()
+        self.assertEqual('ssh-rsa key2', zvmutils.get_mn_pub_key())
+        self.assertFalse(zvmutils.get_xcat_breaker('10.10.10.10').is_open)
+
+        # The key is changed without a restart, and rejected by a node
+        mn['key'] = 'ssh-rsa key3'
+        self.assertEqual('ssh-rsa key2', zvmutils.get_mn_pub_key())
+
+        def _fake_request(method, url, body=None):
+            raise exception.ZVMXCATInternalError(msg='os000001: '
+                'Permission denied (publickey,password).')
+        self.stubs.Set(zvmutils, 'xcat_request', _fake_request)
+        self.assertRaises(exception.ZVMXCATXdshFailed, zvmutils.xdsh,
+                          'os000001', 'ls')
+        self.assertEqual('ssh-rsa key3', zvmutils.get_mn_pub_key())
+
+    def test_mn_pub_key_cache_expired(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.flags(zvm_image_tmp_path=tmp_dir)
+        with open(os.path.join(tmp_dir, const.XCAT_MN_KEYS_FILE), 'w') as f:
+            f.write(jsonutils.dumps({'10.10.10.10/fakemn': {
+                        'key': 'ssh-rsa old', 'time': time.time() - 3600}}))
+        self.stubs.Set(zvmutils, '_query_mn_pub_key', lambda: 'ssh-rsa new')
+        self.stubs.Set(zvmutils, '_query_mn_boot_id', lambda: 'boot1')
+        self.assertEqual('ssh-rsa new', zvmutils.get_mn_pub_key())
+
+        # Not cached without a check interval
+        queries = []
+        self.flags(zvm_xcat_mn_key_check_interval=0)
+        self.stubs.Set(zvmutils, '_query_mn_pub_key',
+                       lambda: queries.append(1) or 'ssh-rsa new')
+        zvmutils.get_mn_pub_key()
+        zvmutils.get_mn_pub_key()
+        self.assertEqual(2, len(queries))
+
+    def test_guest_init_punch(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.flags(zvm_image_batched_punch=True,
+                   default_ephemeral_format=None)
+        punched = []
+
+        def _punch_file(node, fn, fclass):
+            with open(fn) as f:
+                punched.append((node, os.path.basename(fn), fclass,
+                                f.read()))
+
+        self.stubs.Set(zvmutils, 'get_mn_pub_key', lambda: 'ssh-rsa fake')
+        self.stubs.Set(zvmutils, 'punch_file', _punch_file)
+        guest_init = zvmutils.GuestInitPunch(tmp_dir, 'os000001')
+        guest_init.add_adminpass('pass')
+        guest_init.add_xcat_auth()
+        guest_init.add_eph_info()
+        guest_init.add_eph_info('0102', 'ext4', '/mnt/eph1')
+        guest_init.punch()
+        guest_init.punch()
+
+        self.assertEqual([('os000001', 'xcatinit.disk', 'X',
+                           '# xCAT Init\n'
+                           'action=setPassword\npassword=pass\n\n'
+                           'action=addAuthKey\nkey=ssh-rsa fake\n\n'
+                           'action=addMdisk\nvaddr=0101\nfilesys=ext3\n'
+                           'mntdir=/mnt/ephemeral\n\n'
+                           'action=addMdisk\nvaddr=0102\nfilesys=ext4\n'
+                           'mntdir=/mnt/eph1\n')], punched)
+
+    def test_guest_init_punch_not_batched(self):
+        self.mox.StubOutWithMock(zvmutils, 'punch_adminpass_file')
+        self.mox.StubOutWithMock(zvmutils, 'punch_xcat_auth_file')
+        self.mox.StubOutWithMock(zvmutils, 'punch_eph_info_file')
+        zvmutils.punch_adminpass_file('/fp', 'os000001', 'pass')
+        zvmutils.punch_xcat_auth_file('/fp', 'os000001')
+        zvmutils.punch_eph_info_file('/fp', 'os000001', '0102', None, None)
+        self.mox.ReplayAll()
+
+        guest_init = zvmutils.GuestInitPunch('/fp', 'os000001')
+        guest_init.add_adminpass('pass')
+        guest_init.add_xcat_auth()
+        guest_init.add_eph_info('0102')
+        guest_init.punch()
+        self.mox.VerifyAll()
+
+    def test_phase_timings(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_file = os.path.join(tmp_dir, 'phases.log')
+        self.flags(zvm_phase_log_file=log_file)
+
+        @zvmutils.time_phase('nodeset')
+        def _deploy():
+            pass
+
+        class _Driver(object):
+            @zvmutils.time_phases
+            def spawn(self, context, instance):
+                with zvmutils.timed_phase('bundle'):
+                    self.finish_migration(context, instance)
+                steps = zvmutils.StepGraph()
+                steps.add('deploy', _deploy)
+                steps.run()
+
+            @zvmutils.time_phases
+            def finish_migration(self, context, instance):
+                _deploy()
+
+        _Driver().spawn(None, {'name': 'os000001', 'uuid': 'fake-uuid'})
+        self.assertIsNone(zvmutils.get_phase_timings())
+
+        with open(log_file) as f:
+            records = [jsonutils.loads(line) for line in f]
+        # Nested operations and steps are timed as part of the spawn
+        self.assertEqual(['nodeset', 'bundle', 'nodeset', 'total'],
+                         [r['phase'] for r in records])
+        for r in records:
+            self.assertEqual(('spawn', 'os000001', 'fake-uuid', True),
+                             (r['operation'], r['instance'], r['uuid'],
+                              r['ok']))
+            self.assertEqual(records[0]['started'], r['started'])
+
+    def test_phase_timings_disabled(self):
+        @zvmutils.time_phases
+        def spawn(context, instance):
+            return zvmutils.get_phase_timings()
+
+        self.assertIsNone(spawn(None, {'name': 'os000001'}))
+
+    def test_phase_timings_failed(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log_file = os.path.join(tmp_dir, 'phases.log')
+        self.flags(zvm_phase_log_file=log_file)
+
+        @zvmutils.time_phases
+        def snapshot(context, instance):
+            with zvmutils.timed_phase('capture'):
+                raise exception.ZVMImageError(msg='fake')
+
+        self.assertRaises(exception.ZVMImageError, snapshot, None,
+                          {'name': 'os000001', 'uuid': 'fake-uuid'})
+        with open(log_file) as f:
+            records = [jsonutils.loads(line) for line in f]
+        self.assertEqual([('capture', False), ('total', False)],
+                         [(r['phase'], r['ok']) for r in records])
+
+    def test_phaselog_summarize(self):
+        now = time.time()
+
+        def _rec(uuid, phase, duration, started=now, ok=True):
+            return jsonutils.dumps({'time': started, 'started': started,
+                                    'instance': uuid, 'uuid': uuid,
+                                    'operation': 'spawn', 'phase': phase,
+                                    'duration': duration, 'ok': ok})
+
+        lines = [_rec('uuid%d' % i, 'nodeset', i) for i in range(1, 101)]
+        # The punch of each file is summed per spawn
+        lines += [_rec('uuid1', 'punch', 1), _rec('uuid1', 'punch', 2),
+                  _rec('uuid2', 'punch', 4, ok=False),
+                  _rec('uuid3', 'punch', 100, started=now - 7200),
+                  'not json']
+
+        records = phaselog.read_records(lines, since=now - 3600)
+        summary = phaselog.summarize(records)
+        self.assertEqual({'count': 100, 'failed': 0, 'p50': 50,
+                          'p95': 95, 'p99': 99, 'max': 100},
+                         summary[('spawn', 'nodeset')])
+        self.assertEqual({'count': 2, 'failed': 1, 'p50': 3,
+                          'p95': 4, 'p99': 4, 'max': 4},
+                         summary[('spawn', 'punch')])
+        self.assertEqual(86400, phaselog.parse_window('1d'))
+        self.assertEqual(1800, phaselog.parse_window('30m'))
+
     def test_parse_os_version(self):
         fake_os = {'rhel': ['rhelx.y', 'redhatx.y', 'red hatx.y'],
                    'sles': ['susex.y', 'slesx.y']}
@@ -2068,13 +3862,13 @@ class SVCDriverTestCase(ZVMTestCase):
         self.mox.VerifyAll()
 
     def test_get_wwpn_get_none(self):
-        self.mox.StubOutWithMock(self.driver, '_list_fcp_details')
+        self.mox.StubOutWithMock(self.driver, '_list_fcp_details_many')
         self.mox.StubOutWithMock(self.driver, '_extract_wwpn_from_fcp_info')
 
         farg = mox.IgnoreArg()
-        self.driver._list_fcp_details(farg).AndReturn('fake_active')
+        self.driver._list_fcp_details_many(['active', 'free']).AndReturn(
+                ['fake_active', 'fake_free'])
         self.driver._extract_wwpn_from_fcp_info(farg, farg).AndReturn(None)
-        self.driver._list_fcp_details(farg).AndReturn('fake_free')
         self.driver._extract_wwpn_from_fcp_info(farg, farg).AndReturn(None)
         self.mox.ReplayAll()
 
@@ -2082,13 +3876,13 @@ class SVCDriverTestCase(ZVMTestCase):
         self.mox.VerifyAll()
 
     def test_get_wwpn(self):
-        self.mox.StubOutWithMock(self.driver, '_list_fcp_details')
+        self.mox.StubOutWithMock(self.driver, '_list_fcp_details_many')
         self.mox.StubOutWithMock(self.driver, '_extract_wwpn_from_fcp_info')
 
         farg = mox.IgnoreArg()
-        self.driver._list_fcp_details(farg).AndReturn('fake_active')
+        self.driver._list_fcp_details_many(['active', 'free']).AndReturn(
+                ['fake_active', 'fake_free'])
         self.driver._extract_wwpn_from_fcp_info(farg, farg).AndReturn(None)
-        self.driver._list_fcp_details(farg).AndReturn('fake_free')
         self.driver._extract_wwpn_from_fcp_info(farg, farg).AndReturn(
                 '20076D8500003C11')
         self.mox.ReplayAll()
@@ -2114,6 +3908,18 @@ class SVCDriverTestCase(ZVMTestCase):
         self.assertTrue(target == self.driver._list_fcp_details('active'))
         self.mox.VerifyAll()
 
+    def test_list_fcp_details_many(self):
+        fake_rsp = {'info': [['line1\nline2\n']]}
+        self.mox.StubOutWithMock(zvmutils, 'xcat_request_many')
+        zvmutils.xcat_request_many(mox.IgnoreArg()).AndReturn(
+                [fake_rsp, {'info': None}])
+        self.mox.ReplayAll()
+
+        self.assertEqual([['line1', 'line2'], None],
+                         self.driver._list_fcp_details_many(['active',
+                                                             'free']))
+        self.mox.VerifyAll()
+
     def test_extract_wwpn_from_fcp_info_get_none(self):
         line1 = 'opnstk1: FCP device number: 1FAC'
         line2 = 'opnstk1:   Status: Active'
@@ -0,0 +1,329 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2014 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""End-to-end benchmark of the z/VM driver against an xCAT server.
+
+The benchmark runs spawn, get_info, list_instances, get_available_resource,
+reboot, snapshot and destroy of ZVMDriver, one operation after the other,
+each with the given number of parallel operations. By default the
+requests are served by the local xCAT emulator in fake_xcat.py, started
+in process:
+
+    python -m nova.tests.zvm_benchmark --instances 50 --concurrency 1,10,50
+
+Only the xCAT side of the operations is measured: the glance image
+service, the image bundle handling of snapshot and the config drive are
+replaced by no-op fakes. The result is printed as JSON with, for each
+concurrency and operation, the throughput, p50/p95/p99 latency, and the
+xCAT requests and response bytes per operation taken from the driver's
+xCAT request metrics.
+
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import httplib
+import json
+import os
+import shutil
+import ssl
+import sys
+import tempfile
+import time
+import uuid
+
+from eventlet import greenpool
+from oslo.config import cfg
+
+from nova import context as nova_context
+from nova.image import glance
+from nova.network import model as network_model
+from nova.tests import fake_xcat
+from nova.virt import fake
+from nova.virt.zvm import driver
+from nova.virt.zvm import phaselog
+from nova.virt.zvm import utils as zvmutils
+
+
+CONF = cfg.CONF
+
+OPERATIONS = ('spawn', 'get_info', 'list_instances', 'get_available_resource',
+              'reboot', 'snapshot', 'destroy')
+
+MAX_CONCURRENCY = 200
+
+IMAGE_ID = '0c1d7b2e-3a5f-4c8e-9d6b-7e2f1a4b5c6d'
+
+
+class UnverifiedConnectionPool(zvmutils.XCATConnectionPool):
+    """xCAT connection pool that doesn't verify the server certificate."""
+
+    def _connect(self):
+        return httplib.HTTPSConnection(
+                    self.host, timeout=self._timeout,
+                    context=ssl._create_unverified_context())
+
+
+class FakeImageService(object):
+    """Glance image service accepting the snapshot uploads."""
+
+    def show(self, context, image_id):
+        return {'id': image_id, 'name': 'benchsnap', 'size': 0}
+
+    def update(self, context, image_id, image_meta, data=None):
+        return image_meta
+
+    def delete(self, context, image_id):
+        pass
+
+
+class ZVMBenchmark(object):
+
+    def __init__(self, xcat_server, instances, workdir):
+        self._instances = [
+            fake_xcat.FakeInstance(self._instance_values(i))
+            for i in range(instances)]
+        self._workdir = workdir
+        self._context = nova_context.get_admin_context()
+        self._network_info = self._fake_network_info()
+        self._image_meta = {
+            'id': IMAGE_ID,
+            'name': 'benchimg',
+            'properties': {'image_file_name': 'bench.img',
+                           'image_type_xcat': 'linux',
+                           'architecture': 's390x',
+                           'os_name': 'Linux',
+                           'os_version': 'rhel6.5',
+                           'provisioning_method': 'netboot',
+                           'root_disk_units': '3338'}}
+
+        CONF.set_override('zvm_xcat_server', xcat_server)
+        CONF.set_override('instances_path', workdir)
+        CONF.set_override('zvm_image_tmp_path', workdir)
+        CONF.set_override('zvm_reachable_timeout', 30)
+        # The emulator certificate is self-signed, only the connections
+        # of the benchmarked driver skip its verification
+        zvmutils._XCAT_CONN_POOLS[xcat_server] = UnverifiedConnectionPool(
+                                    xcat_server,
+                                    CONF.zvm_xcat_connection_pool_size,
+                                    CONF.zvm_xcat_connection_idle_timeout,
+                                    CONF.zvm_xcat_connection_timeout)
+
+        self.driver = driver.ZVMDriver(fake.FakeVirtAPI())
+        self._stub_local_image_handling()
+
+    def _instance_values(self, i):
+        return {'name': 'bench%04d' % i,
+                'uuid': str(uuid.uuid4()),
+                'image_ref': IMAGE_ID,
+                'user_id': 'bench',
+                'project_id': 'bench',
+                'memory_mb': 512,
+                'vcpus': 1,
+                'root_gb': 0,
+                'ephemeral_gb': 0,
+                'config_drive': None,
+                'power_state': 1,
+                'system_metadata': {}}
+
+    def _fake_network_info(self):
+        subnet = network_model.Subnet(
+                    cidr='10.1.0.0/16',
+                    gateway=network_model.IP(address='10.1.0.1',
+                                             type='gateway'),
+                    ips=[network_model.FixedIP(address='10.1.11.51')])
+        network = network_model.Network(id=str(uuid.uuid4()),
+                                        label='xcat_management',
+                                        subnets=[subnet])
+        return network_model.NetworkInfo([network_model.VIF(
+                    id=str(uuid.uuid4()), address='02:00:00:ee:ae:51',
+                    network=network)])
+
+    def _stub_local_image_handling(self):
+        """Replace the snapshot steps working on local image files."""
+        images = self.driver._zvm_images
+        glance.get_remote_image_service = \
+            lambda context, image_href: (FakeImageService(), image_href)
+        images.untar_image_bundle = lambda path, bundle: None
+        images.parse_manifest_xml = lambda path: {
+            'imagetype': 'linux', 'osarch': 's390x', 'osname': 'Linux',
+            'osvers': 'rhel6.5', 'profile': 'bench', 'provmethod': 'netboot'}
+        images.get_root_disk_units = lambda path: '3338'
+
+        def _get_image_file_name(path):
+            if not os.path.exists(path):
+                os.makedirs(path)
+            open(os.path.join(path, 'bench.img'), 'w').close()
+            return 'bench.img'
+        images.get_image_file_name = _get_image_file_name
+
+    def _operation(self, name):
+        ctxt = self._context
+        net = self._network_info
+        if name == 'spawn':
+            return lambda inst: self.driver.spawn(
+                ctxt, inst, self._image_meta, [], 'pass', net, {})
+        elif name == 'get_info':
+            return self.driver.get_info
+        elif name == 'list_instances':
+            return lambda inst: self.driver.list_instances()
+        elif name == 'get_available_resource':
+            return lambda inst: self.driver.get_available_resource()
+        elif name == 'reboot':
+            return lambda inst: self.driver.reboot(ctxt, inst, net, 'SOFT')
+        elif name == 'snapshot':
+            return lambda inst: self.driver.snapshot(
+                ctxt, inst, str(uuid.uuid4()), lambda **kw: None)
+        elif name == 'destroy':
+            return lambda inst: self.driver.destroy(ctxt, inst, net)
+
+    def _xcat_totals(self):
+        summary = zvmutils.get_xcat_request_stats().get_summary().values()
+        return (sum(s['count'] for s in summary),
+                sum(s['bytes'] for s in summary))
+
+    def run_operation(self, name, concurrency):
+        func = self._operation(name)
+        latencies = []
+        errors = []
+
+        def _run(inst):
+            start = time.time()
+            try:
+                func(inst)
+            except Exception as err:
+                errors.append('%s: %s' % (type(err).__name__, err))
+            else:
+                latencies.append(time.time() - start)
+
+        calls, nbytes = self._xcat_totals()
+        pool = greenpool.GreenPool(concurrency)
+        start = time.time()
+        for inst in self._instances:
+            pool.spawn_n(_run, inst)
+        pool.waitall()
+        duration = time.time() - start
+        calls_after, nbytes_after = self._xcat_totals()
+
+        count = len(self._instances)
+        latencies.sort()
+        return {'count': count,
+                'errors': len(errors),
+                'first_error': errors[0] if errors else None,
+                'duration': round(duration, 3),
+                'throughput': round(len(latencies) / duration, 3),
+                'latency': {
+                    'p50': phaselog.percentile(latencies, 50),
+                    'p95': phaselog.percentile(latencies, 95),
+                    'p99': phaselog.percentile(latencies, 99),
+                    'max': max(latencies) if latencies else None},
+                'xcat_calls_per_op': round(float(calls_after - calls) /
+                                           count, 2),
+                'xcat_bytes_per_op': int((nbytes_after - nbytes) / count)}
+
+    def run(self, concurrency, operations=OPERATIONS):
+        results = {}
+        for name in operations:
+            results[name] = self.run_operation(name, concurrency)
+        return results
+
+
+def _parse_concurrency(value):
+    levels = [int(v) for v in value.split(',')]
+    for level in levels:
+        if not 1 <= level <= MAX_CONCURRENCY:
+            raise argparse.ArgumentTypeError(
+                'concurrency must be between 1 and %d' % MAX_CONCURRENCY)
+    return levels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config-file', action='append', default=[],
+                        help='nova config file with the zvm options')
+    parser.add_argument('--xcat-server',
+                        help='host:port of the xCAT server, a local '
+                             'emulator is started if not set')
+    parser.add_argument('--xcat-profile',
+                        help='latency and fault profile of the emulator')
+    parser.add_argument('--instances', type=int, default=20,
+                        help='number of instances of each run')
+    parser.add_argument('--concurrency', type=_parse_concurrency,
+                        default=[1, 10],
+                        help='comma separated parallel operations, 1-%d' %
+                             MAX_CONCURRENCY)
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help='comma separated operations to run')
+    parser.add_argument('--output', help='file to write the JSON result to')
+    args = parser.parse_args(argv)
+
+    CONF([], project='nova', default_config_files=args.config_file)
+    # Options left unset are given the emulator defaults
+    for opt, value in (('zvm_xcat_username', 'admin'),
+                       ('zvm_xcat_password', 'passw0rd'),
+                       ('zvm_host', 'fakenode'),
+                       ('zvm_xcat_master', 'xcat'),
+                       ('zvm_diskpool', 'FAKEDP')):
+        if getattr(CONF, opt) is None:
+            CONF.set_override(opt, value)
+    operations = args.operations.split(',')
+    for name in operations:
+        if name not in OPERATIONS:
+            parser.error('unknown operation %s' % name)
+
+    server = None
+    xcat_server = args.xcat_server
+    if xcat_server is None:
+        profile = None
+        if args.xcat_profile:
+            with open(args.xcat_profile) as f:
+                profile = json.load(f)
+        xcat = fake_xcat.FakeXCAT(username=CONF.zvm_xcat_username,
+                                  password=CONF.zvm_xcat_password,
+                                  host=CONF.zvm_host,
+                                  master=CONF.zvm_xcat_master,
+                                  profile=profile)
+        xcat.add_image(IMAGE_ID.replace('-', '_'))
+        server = fake_xcat.FakeXCATServer(('localhost', 0), xcat)
+        server.start()
+        xcat_server = server.address
+
+    workdir = tempfile.mkdtemp(prefix='zvm_benchmark')
+    result = {'xcat_server': xcat_server,
+              'instances': args.instances,
+              'runs': []}
+    try:
+        for level in args.concurrency:
+            bench = ZVMBenchmark(xcat_server, args.instances, workdir)
+            result['runs'].append({'concurrency': level,
+                                   'operations': bench.run(level,
+                                                           operations)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if server is not None:
+            server.stop()
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
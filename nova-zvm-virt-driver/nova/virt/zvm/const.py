@@ -45,8 +45,67 @@ XCAT_DISKPOOL_KEYWORDS = {
     "disk_available": "Free:",
     }
 
+# Bytes of the allocation units of minidisks without a size suffix
+ZVM_DISK_UNIT_BYTES = {
+    'ECKD': 849960,
+    'FBA': 512,
+    }
+
 XCAT_RESPONSE_KEYS = ('info', 'data', 'node', 'errorcode', 'error')
 
+# Max number of nodes in one noderange of a bulk xCAT request
+XCAT_BULK_NODERANGE_SIZE = 100
+
+# Intervals(seconds) between the nodestat polls of an instance waiting to
+# be reachable, by the time(seconds) it has waited so far
+ZVM_REACHABLE_POLL_INTERVALS = ((30, 2), (120, 5), (None, 10))
+
+# Interval(seconds) the reachability poller checks for due polls
+ZVM_REACHABLE_POLL_TICK = 1
+
+# File in zvm_image_tmp_path the public keys of xCAT MNs are cached in
+XCAT_MN_KEYS_FILE = 'xcat_mn_keys.json'
+
+# Error of xCAT failing to ssh to a node with the public key of the MN
+XCAT_SSH_KEY_REJECTED = 'Permission denied (publickey'
+
+# Drift(GB) between a disk pool inventory and the space accounted by the
+# driver since the previous one, over which the disk pool is queried again
+ZVM_DISKPOOL_DRIFT_THRESHOLD = 1
+
+# Time(seconds) the responses of read-only xCAT endpoints are cached
+XCAT_CACHE_TTL = {
+    'lsdef_node': 300,
+    'gettab_nodetype': 300,
+    'diskpoolspace': 60,
+    }
+
+# Upper bounds(seconds) of the xCAT request latency histogram buckets
+XCAT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Methods of the xCAT requests that may be sent again once xCAT got them
+XCAT_IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+# Upper bound(seconds) of the backoff interval between xCAT request retries
+XCAT_RETRY_MAX_INTERVAL = 30
+
+# Timeout(seconds) of the health probe sent to an unavailable xCAT server
+XCAT_HEALTH_PROBE_TIMEOUT = 10
+
+# Priority classes of xCAT requests, a lower value is admitted first
+XCAT_PRIORITY_INTERACTIVE = 0
+XCAT_PRIORITY_PROVISIONING = 1
+XCAT_PRIORITY_BACKGROUND = 2
+XCAT_PRIORITY_NAMES = ('interactive', 'provisioning', 'background')
+
+# Endpoint classes of the latency-sensitive power and status operations
+XCAT_INTERACTIVE_ENDPOINTS = ('nodes/power', 'nodes/status')
+
+# chvm options of the latency-sensitive device attach and detach operations
+XCAT_INTERACTIVE_CHVM_OPTIONS = ('--dedicatedevice', '--undedicatedevice',
+                                 '--addzfcp', '--removezfcp',
+                                 '--createfilesysnode', '--removefilesysnode')
+
 ZVM_POWER_STAT = {
     'on': power_state.RUNNING,
     'off': power_state.SHUTDOWN,
@@ -17,9 +17,12 @@
 import contextlib
 import datetime
 import os
+import re
 import time
+import urllib
 import uuid
 
+import eventlet
 from oslo.config import cfg
 
 from nova.api.metadata import base as instance_metadata
@@ -37,6 +40,7 @@ from nova.openstack.common import timeutils
 from nova import utils
 from nova.virt import configdrive
 from nova.virt import driver
+from nova.virt import event as virtevent
 from nova.virt.zvm import configdrive as zvmconfigdrive
 from nova.virt.zvm import const
 from nova.virt.zvm import exception
@@ -53,6 +57,13 @@ zvm_opts = [
     cfg.StrOpt('zvm_xcat_server',
                default=None,
                help='Host name or IP address of xCAT management_node'),
+    cfg.ListOpt('zvm_xcat_standby_servers',
+                default=[],
+                help='Host names or IP addresses of standby xCAT management '
+                     'nodes. Reads go to the least loaded available xCAT '
+                     'server, writes to zvm_xcat_server unless it is '
+                     'unavailable after zvm_xcat_breaker_threshold '
+                     'consecutive failures'),
     cfg.StrOpt('zvm_xcat_username',
                default=None,
                help='xCAT username'),
@@ -80,6 +91,12 @@ zvm_opts = [
     cfg.StrOpt('zvm_diskpool_type',
                default='ECKD',
                help='Default disk type for root disk, can be ECKD/FBA'),
+    cfg.IntOpt('zvm_diskpool_inventory_interval',
+               default=600,
+               help='Interval(seconds) to query the disk pool space from '
+                    'xCAT, in between it is accounted from the minidisks '
+                    'added and removed by the driver, 0 to query it on '
+                    'each host stats refresh'),
     cfg.BoolOpt('zvm_config_drive_inject_password',
                 default=False,
                 help='Sets the admin password in the config drive'),
@@ -112,6 +129,100 @@ zvm_opts = [
     cfg.IntOpt('zvm_xcat_connection_timeout',
                default=3600,
                help='xCAT connection read timeout(seconds)'),
+    cfg.IntOpt('zvm_xcat_read_timeout',
+               default=120,
+               help='Timeout(seconds) of a GET request to xCAT, a timed '
+                    'out request makes the xCAT server unavailable at '
+                    'once'),
+    cfg.IntOpt('zvm_xcat_connection_pool_size',
+               default=10,
+               help='Max number of concurrent https connections kept to '
+                    'the xCAT server'),
+    cfg.IntOpt('zvm_xcat_connection_idle_timeout',
+               default=60,
+               help='Idle time(seconds) after which a kept-alive xCAT '
+                    'connection is closed'),
+    cfg.IntOpt('zvm_xcat_request_retries',
+               default=2,
+               help='Number of retries of a GET request to xCAT that '
+                    'failed with a communication error'),
+    cfg.IntOpt('zvm_xcat_retry_interval',
+               default=1,
+               help='Base interval(seconds) of the jittered exponential '
+                    'backoff between xCAT request retries'),
+    cfg.IntOpt('zvm_xcat_mn_key_check_interval',
+               default=3600,
+               help='Time(seconds) the public key of xCAT MN is cached '
+                    'before it is queried again, it is also queried again '
+                    'once the MN was restarted or rejected the key. 0 to '
+                    'query it for every spawn'),
+    cfg.IntOpt('zvm_xcat_breaker_threshold',
+               default=5,
+               help='Number of consecutive communication failures after '
+                    'which requests to the xCAT server fail fast, '
+                    '0 to disable'),
+    cfg.IntOpt('zvm_xcat_breaker_reset_timeout',
+               default=30,
+               help='Time(seconds) requests to an unavailable xCAT server '
+                    'fail fast before it is probed again'),
+    cfg.IntOpt('zvm_xcat_cache_size',
+               default=256,
+               help='Max number of cached responses of read-only xCAT '
+                    'requests, 0 to disable the cache'),
+    cfg.StrOpt('zvm_xcat_metrics_file',
+               default=None,
+               help='Path of the file the xCAT request metrics are written '
+                    'to in Prometheus text format, unset to not write it'),
+    cfg.IntOpt('zvm_xcat_metrics_interval',
+               default=60,
+               help='Interval(seconds) to write the xCAT request metrics '
+                    'file and log a summary of the xCAT requests'),
+    cfg.StrOpt('zvm_phase_log_file',
+               default=None,
+               help='Path of the file the phase timings of spawn, snapshot '
+                    'and resize are appended to as JSON lines, unset to '
+                    'not write them'),
+    cfg.FloatOpt('zvm_xcat_request_rate',
+                 default=0,
+                 help='Max number of requests per second sent to each '
+                      'xCAT server, requests over the rate are queued and '
+                      'admitted by priority, 0 to not limit the rate'),
+    cfg.IntOpt('zvm_xcat_request_burst',
+               default=10,
+               help='Max number of requests sent to xCAT server in a burst '
+                    'when zvm_xcat_request_rate is set'),
+    cfg.IntOpt('zvm_power_stat_cache_ttl',
+               default=30,
+               help='Time(seconds) the power state of instances queried by '
+                    'one bulk xCAT request is reused by get_info, '
+                    '0 to query each instance separately'),
+    cfg.IntOpt('zvm_instance_state_cache_ttl',
+               default=10,
+               help='Time(seconds) the state of an instance set by a power '
+                    'action of the driver is reused by get_info, 0 to '
+                    'query it from xCAT'),
+    cfg.IntOpt('zvm_power_state_sweep_interval',
+               default=10,
+               help='Interval(seconds) to query the power state of all '
+                    'instances by bulk xCAT requests and emit lifecycle '
+                    'events for the changed ones, 0 to only detect the '
+                    'changes when the power state is queried by get_info'),
+    cfg.IntOpt('zvm_host_stats_refresh_interval',
+               default=60,
+               help='Interval(seconds) to refresh the host stats in the '
+                    'background, 0 to refresh them on each '
+                    'get_available_resource call'),
+    cfg.IntOpt('zvm_host_stats_max_age',
+               default=300,
+               help='Max age(seconds) of the host stats used by '
+                    'get_available_resource, older stats are refreshed '
+                    'before they are used'),
+    cfg.IntOpt('zvm_instance_index_reconcile_interval',
+               default=300,
+               help='Interval(seconds) to reread the instances of the host '
+                    'from xCAT, in between they are tracked from the nodes '
+                    'created and deleted by the driver, 0 to reread them '
+                    'on each use'),
     cfg.IntOpt('zvm_console_log_size',
                default=100,
                help='Max console log size(kilobyte) get from xCAT'),
@@ -164,6 +275,11 @@ zvm_image_opts = [
     cfg.StrOpt('zvm_image_compression_level',
                default=None,
                help='The level of gzip compression used when capturing disk'),
+    cfg.BoolOpt('zvm_image_batched_punch',
+                default=False,
+                help='Punch all the guest init actions of a spawn to the '
+                     'instance in one file. The xCAT init script of the '
+                     'images must handle several actions in one file'),
     ]
 
 CONF = cfg.CONF
@@ -173,6 +289,8 @@ CONF.register_opts(zvm_image_opts)
 CONF.import_opt('host', 'nova.netconf')
 CONF.import_opt('my_ip', 'nova.netconf')
 CONF.import_opt('default_ephemeral_format', 'nova.virt.driver')
+CONF.import_opt('vif_plugging_timeout', 'nova.compute.manager')
+CONF.import_opt('vif_plugging_is_fatal', 'nova.compute.manager')
 
 ZVMInstance = zvminstance.ZVMInstance
 
@@ -189,6 +307,14 @@ class ZVMDriver(driver.ComputeDriver):
         self._xcat_url = zvmutils.XCATUrl()
 
         self._host_stats = []
+        self._host_stats_time = 0
+        self._host_stats_timer = None
+        self._power_stats = {}
+        self._power_stats_time = 0
+        self._instance_states = {}
+        self._power_state_timer = None
+        self._last_power_stats = {}
+        self._instance_uuids = {}
         try:
             self._host_stats = self.get_host_stats(refresh=True)
             self._networkop = networkop.NetworkOperator()
@@ -212,6 +338,10 @@ class ZVMDriver(driver.ComputeDriver):
             LOG.warn(_("Exception raised while initializing z/VM driver: %s")
                      % e)
 
+        self._start_host_stats_refresher()
+        self._start_power_state_sweeper()
+
+    @zvmutils.account_xcat_calls
     def get_info(self, instance):
         """Get the current status of an instance, by name (not ID!)
 
@@ -225,9 +355,10 @@ class ZVMDriver(driver.ComputeDriver):
         """
         inst_name = instance['name']
         zvm_inst = ZVMInstance(instance)
+        self._instance_uuids[inst_name] = instance['uuid']
 
         try:
-            return zvm_inst.get_info()
+            return zvm_inst.get_info(*self._get_instance_state(inst_name))
         except exception.ZVMXCATRequestFailed as err:
             emsg = err.format_message()
             if (emsg.__contains__("Invalid nodes and/or groups") and
@@ -238,14 +369,29 @@ class ZVMDriver(driver.ComputeDriver):
             else:
                 raise err
 
+    @zvmutils.account_xcat_calls
     def list_instances(self):
         """Return the names of all the instances known to the virtualization
         layer, as a list.
         """
-        zvm_host = CONF.zvm_host
-        hcp_base = self._get_hcp_info()['hostname']
+        return self._get_instance_index().get_nodes()
 
-        url = self._xcat_url.tabdump("/zvm")
+    def _get_instance_index(self):
+        """Return the instance index, reconcile it first if it's due."""
+        index = zvmutils.get_instance_index()
+        hcp_base = self._get_hcp_info()['hostname']
+        if index.needs_reconcile(hcp_base):
+            started_at = time.time()
+            index.reconcile(hcp_base, self._query_instances(hcp_base),
+                            started_at)
+        return index
+
+    def _query_instances(self, hcp_base):
+        """Query the xCAT nodes of the instances managed by hcp_base."""
+        # Let xCAT filter the rows by hcp, the hostname may be in any case
+        hcp_regex = urllib.quote('(?i)^%s$' % re.escape(hcp_base))
+        addp = '&field=-w&field=hcp=~%s' % hcp_regex
+        url = self._xcat_url.tabdump("/zvm", addp)
         res_dict = zvmutils.xcat_request("GET", url)
 
         instances = []
@@ -255,20 +401,198 @@ class ZVMDriver(driver.ComputeDriver):
             for data in data_entries:
                 l = data.split(",")
                 node, hcp = l[0].strip("\""), l[1].strip("\"")
-                hcp_short = hcp_base.partition('.')[0]
-
-                # zvm host and zhcp are not included in the list
                 if (hcp.upper() == hcp_base.upper() and
-                        node.upper() not in (zvm_host.upper(),
-                        hcp_short.upper(), CONF.zvm_xcat_master.upper())):
+                        not self._is_excluded_node(node, hcp_base)):
                     instances.append(node)
 
         return instances
 
+    def _is_excluded_node(self, node, hcp_base):
+        # zvm host, zhcp and xCAT MN are not included in the list
+        hcp_short = hcp_base.partition('.')[0]
+        return node.upper() in (CONF.zvm_host.upper(), hcp_short.upper(),
+                                CONF.zvm_xcat_master.upper())
+
+    def _query_instance_hcp(self, instance_name):
+        """Query the zHCP of an xCAT node, None if it's not defined."""
+        addp = "&col=node=%s&attribute=hcp" % instance_name
+        url = self._xcat_url.gettab("/zvm", addp)
+        res_dict = zvmutils.xcat_request("GET", url)
+
+        with zvmutils.expect_invalid_xcat_resp_data():
+            hcps = res_dict['data'][0] if res_dict['data'] else []
+            return hcps[0].strip() if hcps and hcps[0].strip() else None
+
+    def get_power_states(self, instance_names):
+        """Query power state of instances by bulk xCAT requests.
+
+        One rpower request is sent for each noderange of at most
+        XCAT_BULK_NODERANGE_SIZE instances. Returns a dict that maps
+        instance name to its power state.
+
+        """
+        power_stats = {}
+        chunk_size = const.XCAT_BULK_NODERANGE_SIZE
+        for i in range(0, len(instance_names), chunk_size):
+            noderange = ','.join(instance_names[i:i + chunk_size])
+            url = self._xcat_url.rpower('/' + noderange)
+            res_dict = zvmutils.xcat_request("GET", url, ['stat'])
+
+            with zvmutils.expect_invalid_xcat_resp_data():
+                for info in res_dict['info']:
+                    for line in '\n'.join(info).split('\n'):
+                        node, sep, stat = line.partition(':')
+                        if sep:
+                            power_stats[node.strip()] = \
+                                zvmutils.mapping_power_stat(stat.strip())
+
+        return power_stats
+
+    def _get_power_stat(self, inst_name):
+        """Get power state of an instance from the bulk query cache.
+
+        The power states of all instances on the host are queried together
+        once the cache expires. Returns None if the power state is not
+        known, the instance should be queried separately in this case.
+
+        """
+        ttl = CONF.zvm_power_stat_cache_ttl
+        if ttl <= 0:
+            return None
+
+        if time.time() - self._power_stats_time >= ttl:
+            self._refresh_power_stats()
+
+        return self._power_stats.get(inst_name)
+
+    def _refresh_power_stats(self):
+        """Query the power state of all instances on the host.
+
+        The result replaces the bulk query cache and the instances whose
+        power state changed since the last query get lifecycle events.
+
+        """
+        queried_at = time.time()
+        try:
+            power_stats = self.get_power_states(self.list_instances())
+        except Exception as err:
+            # Keep the last result, it's queried again on the next call
+            LOG.warn(_("Failed to query power state of instances: %s") % err)
+            return
+
+        self._power_stats = power_stats
+        self._power_stats_time = queried_at
+
+        for inst_name in (set(self._last_power_stats) -
+                          set(self._power_stats)):
+            del self._last_power_stats[inst_name]
+        for inst_name, power_stat in self._power_stats.items():
+            self.handle_power_state_change(inst_name, power_stat)
+
+    def handle_power_state_change(self, inst_name, power_stat):
+        """Emit a lifecycle event if the power state of an instance changed.
+
+        Called with the power states found by the bulk queries, and may be
+        called by a relay of z/VM state change events as well. The first
+        power state seen for an instance is only recorded.
+
+        """
+        last_stat = self._last_power_stats.get(inst_name)
+        self._last_power_stats[inst_name] = power_stat
+        if last_stat is None or last_stat == power_stat:
+            return
+
+        if power_stat == power_state.RUNNING:
+            transition = virtevent.EVENT_LIFECYCLE_STARTED
+        elif power_stat == power_state.SHUTDOWN:
+            transition = virtevent.EVENT_LIFECYCLE_STOPPED
+        else:
+            return
+        self._emit_lifecycle_event(inst_name, transition)
+
+    def _emit_lifecycle_event(self, inst_name, transition):
+        inst_uuid = self._instance_uuids.get(inst_name)
+        if inst_uuid is None:
+            LOG.debug(_("No lifecycle event for instance %s of unknown "
+                        "uuid") % inst_name)
+            return
+
+        # Compute handles the event out of the caller's green thread
+        eventlet.spawn_n(self.emit_event,
+                         virtevent.LifecycleEvent(inst_uuid, transition))
+
+    def _sweep_power_states(self):
+        priority = const.XCAT_PRIORITY_BACKGROUND
+        try:
+            with zvmutils.xcat_request_priority(priority):
+                self._refresh_power_stats()
+        except Exception as err:
+            # Keep the looping call running
+            LOG.warn(_("Failed to sweep power state of instances: %s") % err)
+
+    def _start_power_state_sweeper(self):
+        """Start the periodic bulk query of the instance power states."""
+        interval = CONF.zvm_power_state_sweep_interval
+        if interval <= 0 or self._power_state_timer is not None:
+            return
+
+        self._power_state_timer = loopingcall.FixedIntervalLoopingCall(
+                                                self._sweep_power_states)
+        self._power_state_timer.start(interval, initial_delay=interval)
+
+    def _get_instance_state(self, inst_name):
+        """Return (power state, reachable) of an instance from the caches.
+
+        The state set by the last power action of the driver is used while
+        it's fresh, otherwise the power state of the bulk query cache.
+        Either value is None if it's not known.
+
+        """
+        state = self._instance_states.get(inst_name)
+        if state is not None:
+            power_stat, reachable, updated_at = state
+            if time.time() - updated_at < CONF.zvm_instance_state_cache_ttl:
+                return power_stat, reachable
+            del self._instance_states[inst_name]
+
+        return self._get_power_stat(inst_name), None
+
+    def _set_instance_state(self, inst_name, power_stat, reachable=None):
+        """Write through the state of an instance after a power action.
+
+        The power state is recorded without a lifecycle event, compute
+        knows of the transitions it started itself.
+
+        """
+        self._invalidate_power_stat(inst_name)
+        self._last_power_stats[inst_name] = power_stat
+        if CONF.zvm_instance_state_cache_ttl > 0:
+            self._instance_states[inst_name] = (power_stat, reachable,
+                                                time.time())
+
+    def _invalidate_power_stat(self, inst_name):
+        """Drop the cached power state of an instance after changing it."""
+        self._power_stats.pop(inst_name, None)
+        self._instance_states.pop(inst_name, None)
+
     def instance_exists(self, instance_name):
         """Overwrite this to using instance name as input parameter."""
-        return instance_name in self.list_instances()
+        index = self._get_instance_index()
+        if instance_name in index:
+            return True
 
+        # The index only knows the nodes this process created since the
+        # last reconcile, confirm a miss with xCAT
+        hcp_base = self._get_hcp_info()['hostname']
+        hcp = self._query_instance_hcp(instance_name)
+        if (hcp is None or hcp.upper() != hcp_base.upper() or
+                self._is_excluded_node(instance_name, hcp_base)):
+            return False
+        index.add(instance_name, hcp)
+        return True
+
+    @zvmutils.account_xcat_calls
+    @zvmutils.time_phases
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info=None, block_device_info=None):
         """Create a new instance/VM/domain on the virtualization platform.
@@ -313,6 +637,8 @@ class ZVMDriver(driver.ComputeDriver):
         zhcp = self._get_hcp_info()['hostname']
 
         zvm_inst = ZVMInstance(instance)
+        self._invalidate_power_stat(zvm_inst._name)
+        self._instance_uuids[zvm_inst._name] = instance['uuid']
         instance_path = self._pathutils.get_instance_path(compute_node,
                                                           zvm_inst._name)
         # Create network configuration files
@@ -330,45 +656,47 @@ class ZVMDriver(driver.ComputeDriver):
         if len(net_conf_files) > 0:
             injected_files.extend(net_conf_files)
 
-        # Create configure drive
         if not CONF.zvm_config_drive_inject_password:
             admin_password = CONF.zvm_image_default_password
-        transportfiles = None
-        if configdrive.required_by(instance):
-            transportfiles = self._create_config_drive(instance_path,
-                instance, injected_files, admin_password, net_conf_cmds)
 
         LOG.info(_("The instance %(name)s is spawning at %(node)s") %
                  {'name': zvm_inst._name, 'node': compute_node},
                  instance=instance)
 
         spawn_start = time.time()
-
-        try:
-            # Create xCAT node for the instance and preset network
-            zvm_inst.create_xcat_node(zhcp)
-            self._preset_instance_network(zvm_inst._name, network_info)
-
-            tmp_file_fn = None
-            bundle_file_path = None
+        # Values set by the steps and used by the later ones
+        spawn = {'image_meta': image_meta,
+                 'transportfiles': None,
+                 'tmp_file_fn': None,
+                 'bundle_file_path': None}
+
+        def _create_config_drive():
+            if configdrive.required_by(instance):
+                spawn['transportfiles'] = self._create_config_drive(
+                    instance_path, instance, injected_files, admin_password,
+                    net_conf_cmds)
+
+        def _get_root_disk_units():
             if 'root_disk_units' not in image_meta['properties']:
-                (tmp_file_fn, image_file_path, bundle_file_path) = \
-                    self._import_image_to_nova(context, instance, image_meta)
-                image_meta = self._zvm_images.set_image_root_disk_units(
+                (spawn['tmp_file_fn'], image_file_path,
+                 spawn['bundle_file_path']) = self._import_image_to_nova(
+                                            context, instance, image_meta)
+                spawn['image_meta'] = \
+                    self._zvm_images.set_image_root_disk_units(
                                 context, image_meta, image_file_path)
+
+        def _import_image():
             image_in_xcat = self._zvm_images.image_exist_xcat(
                                 instance['image_ref'])
             if not image_in_xcat:
-                self._import_image_to_xcat(context, instance, image_meta,
-                                           tmp_file_fn)
-            elif bundle_file_path is not None:
-                self._pathutils.clean_temp_folder(bundle_file_path)
-
-            # Create z/VM userid and update node info for instance
-            zvm_inst.create_userid(block_device_info, image_meta)
-            zvm_inst.update_node_info(image_meta)
-
-            # Create nic for z/VM instance
+                self._import_image_to_xcat(context, instance,
+                                           spawn['image_meta'],
+                                           spawn['tmp_file_fn'])
+            elif spawn['bundle_file_path'] is not None:
+                self._pathutils.clean_temp_folder(spawn['bundle_file_path'])
+
+        @zvmutils.time_phase('nic_create')
+        def _create_nics():
             nic_vdev = base_nic_vdev
             zhcpnode = self._get_hcp_info()['nodename']
             for vif in network_info:
@@ -383,38 +711,59 @@ class ZVMDriver(driver.ComputeDriver):
                                            nic_vdev)
                 nic_vdev = str(hex(int(nic_vdev, 16) + 3))[2:]
 
-            # Call nodeset restapi to deploy image on node
-            deploy_image_name = self._zvm_images.get_imgname_xcat(
-                                    instance['image_ref'])
-            zvm_inst.deploy_node(deploy_image_name, transportfiles)
+        # The image is staged in xCAT while the z/VM userid and its NICs
+        # are created
+        steps = zvmutils.StepGraph()
+        steps.add('config_drive', _create_config_drive)
+        steps.add('xcat_node', lambda: zvm_inst.create_xcat_node(zhcp))
+        steps.add('network',
+                  lambda: self._preset_instance_network(zvm_inst._name,
+                                                        network_info),
+                  ['xcat_node'])
+        steps.add('root_disk_units', _get_root_disk_units)
+        steps.add('image', _import_image, ['root_disk_units'])
+        steps.add('userid',
+                  lambda: zvm_inst.create_userid(block_device_info,
+                                                 spawn['image_meta']),
+                  ['network', 'root_disk_units'])
+        steps.add('node_info',
+                  lambda: zvm_inst.update_node_info(spawn['image_meta']),
+                  ['userid'])
+        steps.add('nics', _create_nics, ['node_info'])
 
-            # Change vm's admin password during spawn
-            zvmutils.punch_adminpass_file(instance_path, zvm_inst._name,
-                                          admin_password)
-
-            # Unlock the instance
-            zvmutils.punch_xcat_auth_file(instance_path, zvm_inst._name)
-
-            # punch ephemeral disk info to the instance
-            if instance['ephemeral_gb'] != 0:
-                eph_disks = block_device_info.get('ephemerals', [])
-                if eph_disks == []:
-                    zvmutils.punch_eph_info_file(instance_path, zvm_inst._name)
-                else:
-                    for idx, eph in enumerate(eph_disks):
-                        vdev = zvmutils.generate_eph_vdev(idx)
-                        fmt = eph.get('guest_format')
-                        mount_dir = ''.join([CONF.zvm_default_ephemeral_mntdir,
-                                             str(idx)])
-                        zvmutils.punch_eph_info_file(instance_path,
-                            zvm_inst._name, vdev, fmt, mount_dir)
-
-            # Wait until network configuration finish
-            self._wait_for_addnic(zvm_inst._name)
-            if not self._is_nic_granted(zvm_inst._name):
-                msg = _("Failed to bound vswitch")
-                LOG.error(msg, instance=instance)
-                raise exception.ZVMNetworkError(msg=msg)
+        try:
+            # Wait until network configuration finish, the NICs are
+            # coupled by the neutron agent meanwhile
+            with self._wait_for_vif_plugged(instance, network_info):
+                steps.run()
+
+                # Call nodeset restapi to deploy image on node
+                deploy_image_name = self._zvm_images.get_imgname_xcat(
+                                        instance['image_ref'])
+                zvm_inst.deploy_node(deploy_image_name,
+                                     spawn['transportfiles'])
+
+                guest_init = zvmutils.GuestInitPunch(instance_path,
+                                                     zvm_inst._name)
+                # Change vm's admin password during spawn
+                guest_init.add_adminpass(admin_password)
+
+                # Unlock the instance
+                guest_init.add_xcat_auth()
+
+                # punch ephemeral disk info to the instance
+                if instance['ephemeral_gb'] != 0:
+                    eph_disks = block_device_info.get('ephemerals', [])
+                    if eph_disks == []:
+                        guest_init.add_eph_info()
+                    else:
+                        for idx, eph in enumerate(eph_disks):
+                            vdev = zvmutils.generate_eph_vdev(idx)
+                            fmt = eph.get('guest_format')
+                            mount_dir = ''.join(
+                                [CONF.zvm_default_ephemeral_mntdir, str(idx)])
+                            guest_init.add_eph_info(vdev, fmt, mount_dir)
+                guest_init.punch()
 
             # Attach persistent volume
             bdm = driver.block_device_info_get_mapping(block_device_info)
@@ -435,9 +784,16 @@ class ZVMDriver(driver.ComputeDriver):
         except (exception.ZVMXCATCreateNodeFailed,
                 exception.ZVMImageError):
             with excutils.save_and_reraise_exception():
-                zvm_inst.delete_xcat_node()
+                # The image is imported while the userid is created
+                if 'userid' in steps.completed:
+                    self.destroy(context, instance, network_info,
+                                 block_device_info)
+                else:
+                    zvm_inst.delete_xcat_node()
         except (exception.ZVMXCATCreateUserIdFailed,
                 exception.ZVMNetworkError,
+                exception.ZVMConfigDriveError,
+                nova_exception.VirtualInterfaceCreateException,
                 exception.ZVMVolumeError,
                 exception.ZVMXCATUpdateNodeFailed,
                 exception.ZVMXCATDeployNodeFailed):
@@ -451,12 +807,16 @@ class ZVMDriver(driver.ComputeDriver):
                             "failed with reason: %(err)s") %
                           {'instance': zvm_inst._name, 'err': err},
                           instance=instance)
+                if steps.failed and 'userid' in steps.completed:
+                    self.destroy(context, instance, network_info,
+                                 block_device_info)
         finally:
             self._pathutils.clean_temp_folder(instance_path)
 
         # Update image last deploy date in xCAT osimage table
         self._zvm_images.update_last_use_date(deploy_image_name)
 
+    @zvmutils.time_phase('config_drive')
     def _create_config_drive(self, instance_path, instance, injected_files,
                              admin_password, commands):
         if CONF.config_drive_format != 'tgz':
@@ -570,15 +930,18 @@ class ZVMDriver(driver.ComputeDriver):
             image_file_path = self._pathutils.get_img_path(
                 bundle_file_path, disk_file)
 
-        LOG.debug(_("Generating the manifest.xml as a part of bundle file for "
-                    "image %s") % image_meta['id'], instance=instance)
-        self._zvm_images.generate_manifest_file(image_meta, image_name,
-                                                 disk_file, bundle_file_path)
+        with zvmutils.timed_phase('bundle'):
+            LOG.debug(_("Generating the manifest.xml as a part of bundle "
+                        "file for image %s") % image_meta['id'],
+                      instance=instance)
+            self._zvm_images.generate_manifest_file(image_meta, image_name,
+                                                    disk_file,
+                                                    bundle_file_path)
 
-        LOG.debug(_("Generating bundle file for image %s") % image_meta['id'],
-                  instance=instance)
-        image_bundle_package = self._zvm_images.generate_image_bundle(
-                                    spawn_path, tmp_f_fn, image_name)
+            LOG.debug(_("Generating bundle file for image %s") %
+                      image_meta['id'], instance=instance)
+            image_bundle_package = self._zvm_images.generate_image_bundle(
+                                        spawn_path, tmp_f_fn, image_name)
 
         LOG.debug(_("Importing the image %s to xCAT") % image_meta['id'],
                   instance=instance)
@@ -594,6 +957,7 @@ class ZVMDriver(driver.ComputeDriver):
     def need_legacy_block_device_info(self):
         return False
 
+    @zvmutils.account_xcat_calls
     def destroy(self, context, instance, network_info=None,
                 block_device_info=None, destroy_disks=False):
         """Destroy (shutdown and delete) the specified instance.
@@ -611,6 +975,9 @@ class ZVMDriver(driver.ComputeDriver):
 
         """
         inst_name = instance['name']
+        self._invalidate_power_stat(inst_name)
+        self._last_power_stats.pop(inst_name, None)
+        self._instance_uuids.pop(inst_name, None)
 
         if self.instance_exists(inst_name):
             LOG.info(_("Destroying instance %s") % inst_name,
@@ -638,12 +1005,15 @@ class ZVMDriver(driver.ComputeDriver):
             LOG.warn(_('Instance %s does not exist') % inst_name,
                      instance=instance)
 
+    @zvmutils.account_xcat_calls
     def manage_image_cache(self, context, filtered_instances):
         """Clean the image cache in xCAT MN."""
         LOG.info(_("Check and clean image cache in xCAT"))
         clean_period = CONF.xcat_image_clean_period
-        self._zvm_images.clean_image_cache_xcat(clean_period)
+        with zvmutils.xcat_request_priority(const.XCAT_PRIORITY_BACKGROUND):
+            self._zvm_images.clean_image_cache_xcat(clean_period)
 
+    @zvmutils.account_xcat_calls
     def reboot(self, context, instance, network_info, reboot_type,
                block_device_info=None, bad_volumes_callback=None):
         """Reboot the specified instance.
@@ -664,6 +1034,7 @@ class ZVMDriver(driver.ComputeDriver):
 
         """
         zvm_inst = ZVMInstance(instance)
+        self._invalidate_power_stat(zvm_inst._name)
         if reboot_type == 'SOFT':
             zvm_inst.reboot()
         else:
@@ -673,6 +1044,7 @@ class ZVMDriver(driver.ComputeDriver):
             LOG.error(_("Failed to reboot instance %s: timeout") %
                       zvm_inst._name, instance=instance)
             raise nova_exception.InstanceRebootFailure(reason=_("timeout"))
+        self._set_instance_state(zvm_inst._name, power_state.RUNNING, True)
 
     def get_host_ip_addr(self):
         """Retrieves the IP address of the dom0."""
@@ -707,6 +1079,7 @@ class ZVMDriver(driver.ComputeDriver):
         mountpoint = mountpoint.replace('/dev/d', '/dev/sd')
         return mountpoint.replace('/dev/s', '/dev/v')
 
+    @zvmutils.account_xcat_calls
     def attach_volume(self, context, connection_info, instance, mountpoint,
                       disk_bus=None, device_type=None, encryption=None):
         """Attach the disk to the instance at mountpoint using info."""
@@ -719,6 +1092,7 @@ class ZVMDriver(driver.ComputeDriver):
             zvm_inst.attach_volume(self._volumeop, context, connection_info,
                                    instance, mountpoint, is_active)
 
+    @zvmutils.account_xcat_calls
     def detach_volume(self, connection_info, instance, mountpoint=None,
                       encryption=None):
         """Detach the disk attached to the instance."""
@@ -751,6 +1125,8 @@ class ZVMDriver(driver.ComputeDriver):
                     "please check manually. The error is: %(err)s") %
                     {'inst': instance['name'], 'err': err}, instance=instance)
 
+    @zvmutils.account_xcat_calls
+    @zvmutils.time_phases
     def snapshot(self, context, instance, image_href, update_task_state):
         """
         Snapshots the specified instance.
@@ -876,10 +1252,11 @@ class ZVMDriver(driver.ComputeDriver):
                           expected_state=task_states.IMAGE_PENDING_UPLOAD)
         try:
             with open(image_path, 'r') as image_file:
-                image_service.update(context,
-                                     image_href,
-                                     new_image_meta,
-                                     image_file)
+                with zvmutils.timed_phase('image_upload'):
+                    image_service.update(context,
+                                         image_href,
+                                         new_image_meta,
+                                         image_file)
         except Exception:
             with excutils.save_and_reraise_exception():
                 self._zvm_images.delete_image_glance(image_service, context,
@@ -895,33 +1272,49 @@ class ZVMDriver(driver.ComputeDriver):
         LOG.info(_("Snapshot complete successfully"),
                           instance=instance)
 
+    @zvmutils.account_xcat_calls
     def pause(self, instance):
         """Pause the specified instance."""
         LOG.debug(_('Pausing %s') % instance['name'], instance=instance)
         zvm_inst = ZVMInstance(instance)
+        self._invalidate_power_stat(zvm_inst._name)
         zvm_inst.pause()
+        # rpower reports a paused instance as on
+        self._set_instance_state(zvm_inst._name, power_state.RUNNING, False)
 
+    @zvmutils.account_xcat_calls
     def unpause(self, instance):
         """Unpause paused VM instance."""
         LOG.debug(_('Un-pausing %s') % instance['name'], instance=instance)
         zvm_inst = ZVMInstance(instance)
+        self._invalidate_power_stat(zvm_inst._name)
         zvm_inst.unpause()
+        self._set_instance_state(zvm_inst._name, power_state.RUNNING,
+                                 zvm_inst._reachable or None)
 
+    @zvmutils.account_xcat_calls
     def power_off(self, instance, timeout=0, retry_interval=0):
         """Power off the specified instance."""
         LOG.debug(_('Stopping z/VM instance %s') % instance['name'],
                   instance=instance)
         zvm_inst = ZVMInstance(instance)
+        self._invalidate_power_stat(zvm_inst._name)
         zvm_inst.power_off()
+        self._set_instance_state(zvm_inst._name, power_state.SHUTDOWN, False)
 
+    @zvmutils.account_xcat_calls
     def power_on(self, context, instance, network_info,
                  block_device_info=None):
         """Power on the specified instance."""
         LOG.debug(_('Starting z/VM instance %s') % instance['name'],
                   instance=instance)
         zvm_inst = ZVMInstance(instance)
+        self._invalidate_power_stat(zvm_inst._name)
         zvm_inst.power_on()
+        self._set_instance_state(zvm_inst._name, power_state.RUNNING,
+                                 zvm_inst._reachable or None)
 
+    @zvmutils.account_xcat_calls
     def get_available_resource(self, nodename=None):
         """Retrieve resource information.
 
@@ -935,7 +1328,20 @@ class ZVMDriver(driver.ComputeDriver):
 
         """
         LOG.debug(_("Getting available resource for %s") % CONF.zvm_host)
-        stats = self.update_host_status()[0]
+        stats = self._get_recent_host_stats()[0]
+
+        coalesce_stats = zvmutils.get_xcat_coalesce_stats()
+        LOG.debug(_("Coalesced %(coalesced)d of %(requests)d xCAT GET "
+                    "requests, coalesce rate %(rate).2f") % coalesce_stats)
+        LOG.debug(_("xCAT response cache: %(hits)d hits, %(misses)d misses, "
+                    "%(invalidations)d invalidations") %
+                  zvmutils.get_xcat_cache().get_stats())
+        limiter = zvmutils.get_xcat_rate_limiter(CONF.zvm_xcat_server)
+        for name, stat in limiter.get_stats().items():
+            LOG.debug(_("xCAT %(name)s requests: %(queued)d queued, "
+                        "max queued %(max_queued)d, %(admitted)d admitted, "
+                        "waited %(wait_time).2fs") %
+                      dict(stat, name=name))
 
         mem_used = stats['host_memory_total'] - stats['host_memory_free']
         supported_instances = stats['supported_instances']
@@ -1081,6 +1487,7 @@ class ZVMDriver(driver.ComputeDriver):
         # We don't support block_migration
         return
 
+    @zvmutils.account_xcat_calls
     def live_migration(self, ctxt, instance_ref, dest,
                        post_method, recover_method, block_migration=False,
                        migrate_data=None):
@@ -1123,6 +1530,7 @@ class ZVMDriver(driver.ComputeDriver):
             with excutils.save_and_reraise_exception():
                 recover_method(ctxt, instance_ref, dest,
                                block_migration, migrate_data)
+        zvmutils.get_instance_index().remove(inst_name)
 
         if not same_mn:
             # Delete node definition at source xCAT MN
@@ -1148,6 +1556,8 @@ class ZVMDriver(driver.ComputeDriver):
         inst_name = instance_ref['name']
         nic_vdev = const.ZVM_DEFAULT_NIC_VDEV
         zhcp = self._get_hcp_info()['hostname']
+        # The node was defined on this host by the source host
+        zvmutils.get_instance_index().add(inst_name, zhcp)
 
         for vif in network_info:
             LOG.debug(_('Create nic for instance: %(inst)s, MAC: '
@@ -1228,7 +1638,8 @@ class ZVMDriver(driver.ComputeDriver):
         caps = []
         host = CONF.zvm_host
 
-        info = self._get_host_inventory_info(host)
+        with zvmutils.xcat_request_priority(const.XCAT_PRIORITY_BACKGROUND):
+            info = self._get_host_inventory_info(host)
 
         data = {'host': CONF.host,
                 'allowed_vm_type': const.ALLOWED_VM_TYPE}
@@ -1270,8 +1681,48 @@ class ZVMDriver(driver.ComputeDriver):
         """Return currently known host stats."""
         if refresh:
             self._host_stats = self.update_host_status()
+            self._host_stats_time = time.time()
         return self._host_stats
 
+    def _get_recent_host_stats(self):
+        """Return the host stats, refresh them first if they are too old.
+
+        The stats are refreshed in the background by the host stats
+        refresher, so they are normally returned without xCAT requests.
+
+        """
+        age = time.time() - self._host_stats_time
+        if (CONF.zvm_host_stats_refresh_interval <= 0 or
+                not self._host_stats or age > CONF.zvm_host_stats_max_age):
+            return self.get_host_stats(refresh=True)
+
+        LOG.debug(_("Using host stats refreshed %ds ago") % age)
+        return self._host_stats
+
+    def _refresh_host_stats(self):
+        try:
+            self.get_host_stats(refresh=True)
+        except Exception as err:
+            # Keep the looping call running, the stats are refreshed on
+            # demand once they exceed the max age
+            LOG.warn(_("Failed to refresh host stats: %s") % err)
+
+        try:
+            zvmutils.check_mn_pub_key()
+        except Exception as err:
+            LOG.warn(_("Failed to check the restart of xCAT MN: %s") % err)
+
+    def _start_host_stats_refresher(self):
+        """Start the periodic background refresh of the host stats."""
+        interval = CONF.zvm_host_stats_refresh_interval
+        if interval <= 0 or self._host_stats_timer is not None:
+            return
+
+        initial_delay = interval if self._host_stats else 0
+        self._host_stats_timer = loopingcall.FixedIntervalLoopingCall(
+                                                self._refresh_host_stats)
+        self._host_stats_timer.start(interval, initial_delay=initial_delay)
+
     def get_volume_connector(self, instance):
         """Get connector information for the instance for attaching to volumes.
 
@@ -1292,11 +1743,21 @@ class ZVMDriver(driver.ComputeDriver):
         return res
 
     def _get_host_inventory_info(self, host):
-        url = self._xcat_url.rinv('/' + host)
-        inv_info_raw = zvmutils.xcat_request("GET", url)['info'][0]
+        ledger = zvmutils.get_diskpool_ledger()
+        if ledger.needs_inventory():
+            inventory = ledger.start_inventory()
+            # Host and disk pool inventory are queried concurrently
+            inv_res, dp_res = zvmutils.xcat_request_many([
+                    ("GET", self._xcat_url.rinv('/' + host)),
+                    ("GET", self._get_diskpool_url(host))])
+            ledger.update(self._parse_diskpool_info(dp_res), inventory)
+        else:
+            inv_res = zvmutils.xcat_request("GET",
+                                            self._xcat_url.rinv('/' + host))
+        inv_info_raw = inv_res['info'][0]
         inv_keys = const.XCAT_RINV_HOST_KEYWORDS
         inv_info = zvmutils.translate_xcat_resp(inv_info_raw[0], inv_keys)
-        dp_info = self._get_diskpool_info(host)
+        dp_info = ledger.get_info()
 
         host_info = {}
 
@@ -1323,11 +1784,11 @@ class ZVMDriver(driver.ComputeDriver):
 
         return host_info
 
-    def _get_diskpool_info(self, host):
+    def _get_diskpool_url(self, host):
         addp = '&field=--diskpoolspace&field=' + CONF.zvm_diskpool
-        url = self._xcat_url.rinv('/' + host, addp)
-        res_dict = zvmutils.xcat_request("GET", url)
+        return self._xcat_url.rinv('/' + host, addp)
 
+    def _parse_diskpool_info(self, res_dict):
         dp_info_raw = res_dict['info'][0]
         dp_keys = const.XCAT_DISKPOOL_KEYWORDS
         dp_info = zvmutils.translate_xcat_resp(dp_info_raw[0], dp_keys)
@@ -1356,6 +1817,8 @@ class ZVMDriver(driver.ComputeDriver):
 
         return dp_info
 
+    @zvmutils.account_xcat_calls
+    @zvmutils.time_phases
     def migrate_disk_and_power_off(self, context, instance, dest,
                                    instance_type, network_info,
                                    block_device_info=None,
@@ -1442,15 +1905,22 @@ class ZVMDriver(driver.ComputeDriver):
         return eph_disk_info
 
     def _detach_volume_from_instance(self, instance, block_device_mapping):
+        if not block_device_mapping:
+            return
+
+        # Query the instance once instead of for each volume
+        zvm_inst = None
+        if self.instance_exists(instance['name']):
+            zvm_inst = ZVMInstance(instance)
+            is_active = zvm_inst.is_reachable()
+
         for bd in block_device_mapping:
             connection_info = bd['connection_info']
             mountpoint = bd['mount_device']
             if mountpoint:
                 mountpoint = self._format_mountpoint(mountpoint)
 
-            if self.instance_exists(instance['name']):
-                zvm_inst = ZVMInstance(instance)
-                is_active = zvm_inst.is_reachable()
+            if zvm_inst is not None:
                 try:
                     zvm_inst.detach_volume(self._volumeop, connection_info,
                                            instance, mountpoint, is_active,
@@ -1504,6 +1974,8 @@ class ZVMDriver(driver.ComputeDriver):
             with excutils.save_and_reraise_exception():
                 self._zvm_images.delete_image_from_xcat(image_name_xcat)
 
+    @zvmutils.account_xcat_calls
+    @zvmutils.time_phases
     def finish_migration(self, context, migration, instance, disk_info,
                          network_info, image_meta, resize_instance,
                          block_device_info=None, power_on=True):
@@ -1516,6 +1988,7 @@ class ZVMDriver(driver.ComputeDriver):
                            was created
         """
         disk_info = jsonutils.loads(disk_info)
+        self._invalidate_power_stat(instance['name'])
 
         source_xcat_mn = disk_info['disk_source_mn'].encode('gbk')
         source_image = disk_info['disk_source_image'].encode('gbk')
@@ -1689,6 +2162,7 @@ class ZVMDriver(driver.ComputeDriver):
 
         return inst_copy
 
+    @zvmutils.time_phase('volume_attach')
     def _attach_volume_to_instance(self, context, instance,
                                    block_device_mapping):
         for bd in block_device_mapping:
@@ -1696,6 +2170,7 @@ class ZVMDriver(driver.ComputeDriver):
             mountpoint = bd['mount_device']
             self.attach_volume(context, connection_info, instance, mountpoint)
 
+    @zvmutils.time_phase('nic_create')
     def _add_nic_to_instance(self, inst_name, network_info, userid=None):
         nic_vdev = const.ZVM_DEFAULT_NIC_VDEV
         zhcpnode = self._get_hcp_info()['nodename']
@@ -1714,6 +2189,7 @@ class ZVMDriver(driver.ComputeDriver):
 
         self._zvm_images.update_last_use_date(image_name_xcat)
 
+    @zvmutils.account_xcat_calls
     def confirm_migration(self, migration, instance, network_info):
         """Confirms a resize, destroying the source VM."""
         # Point to old instance
@@ -1729,6 +2205,7 @@ class ZVMDriver(driver.ComputeDriver):
             self.destroy({}, instance)
             self._zvm_images.cleanup_image_after_migration(instance['name'])
 
+    @zvmutils.account_xcat_calls
     def finish_revert_migration(self, context, instance, network_info,
                                 block_device_info=None, power_on=True):
         """Finish reverting a resize, powering back on the instance."""
@@ -1758,6 +2235,62 @@ class ZVMDriver(driver.ComputeDriver):
         if power_on:
             self.power_on({}, instance, [])
 
+    def _get_neutron_events(self, network_info):
+        """Return the network-vif-plugged events of the inactive ports."""
+        return [('network-vif-plugged', vif['id'])
+                for vif in network_info if vif.get('active', True) is False]
+
+    @contextlib.contextmanager
+    def _wait_for_vif_plugged(self, instance, network_info):
+        """Wait for the NICs created in the block to be granted.
+
+        neutron sends a network-vif-plugged event once the zvm agent bound
+        the port of a NIC. The user directory is polled instead if no event
+        is expected, or if the events don't come in vif_plugging_timeout.
+
+        """
+        inst_name = instance['name']
+        events = []
+        if utils.is_neutron() and CONF.vif_plugging_timeout:
+            events = self._get_neutron_events(network_info)
+
+        failed = []
+
+        def _vif_plugging_failed(event_name, instance):
+            LOG.error(_("Neutron reported failure on event %s") % event_name,
+                      instance=instance)
+            if CONF.vif_plugging_is_fatal:
+                raise nova_exception.VirtualInterfaceCreateException()
+            failed.append(event_name)
+            return False
+
+        plugged = False
+        if events:
+            try:
+                with self.virtapi.wait_for_instance_event(
+                        instance, events,
+                        deadline=CONF.vif_plugging_timeout,
+                        error_callback=_vif_plugging_failed):
+                    yield
+                    wait_start = time.time()
+                plugged = not failed
+            except eventlet.timeout.Timeout:
+                LOG.warn(_("Timeout waiting for vif plugging events of "
+                           "instance %s") % inst_name, instance=instance)
+        else:
+            yield
+            wait_start = time.time()
+
+        timings = zvmutils.get_phase_timings()
+        if not plugged:
+            self._wait_for_addnic(inst_name)
+            if not self._is_nic_granted(inst_name):
+                msg = _("Failed to bound vswitch")
+                LOG.error(msg, instance=instance)
+                raise exception.ZVMNetworkError(msg=msg)
+        if timings is not None:
+            timings.record('nic_wait', wait_start)
+
     def _wait_for_addnic(self, inst_name):
         """Wait until quantum adding NIC done."""
 
@@ -1802,6 +2335,7 @@ class ZVMDriver(driver.ComputeDriver):
 
         return _all_granted
 
+    @zvmutils.account_xcat_calls
     def set_admin_password(self, instance, new_pass=None):
         """
         Set the root password on the specified instance.
@@ -1853,6 +2387,7 @@ class ZVMDriver(driver.ComputeDriver):
 
         return
 
+    @zvmutils.account_xcat_calls
     def get_console_output(self, context, instance):
         """Get console output for an instance"""
 
@@ -45,6 +45,7 @@ class ZVMImages(object):
         self._xcat_url = zvmutils.XCATUrl()
         self._pathutils = zvmutils.PathUtils()
 
+    @zvmutils.time_phase('capture')
     def create_zvm_image(self, instance, image_name, image_href):
         """Create z/VM image from z/VM instance by invoking xCAT REST API
         imgcapture.
@@ -99,6 +100,7 @@ class ZVMImages(object):
     def get_snapshot_time_path(self):
         return self._pathutils.get_snapshot_time_path()
 
+    @zvmutils.time_phase('image_export')
     def get_image_from_xcat(self, image_name_xcat, image_name,
                             snapshot_time_path):
         """Import image from xCAT to nova, by invoking the imgexport
@@ -216,6 +218,7 @@ class ZVMImages(object):
 
         return manifest
 
+    @zvmutils.time_phase('untar')
     def untar_image_bundle(self, snapshot_time_path, image_bundle):
         """Untar the image bundle *.tgz from xCAT and remove the *.tgz."""
         if os.path.exists(image_bundle):
@@ -259,6 +262,7 @@ class ZVMImages(object):
         else:
             return False
 
+    @zvmutils.time_phase('image_download')
     def fetch_image(self, context, image_id, target, user, project):
         LOG.debug(_("Downloading image %s from glance image server") %
                   image_id)
@@ -404,6 +408,7 @@ class ZVMImages(object):
             with excutils.save_and_reraise_exception():
                 os.remove(tar_file)
 
+    @zvmutils.time_phase('imgimport')
     def put_image_to_xcat(self, image_bundle_package, image_profile):
         """Import the image bundle from compute node to xCAT MN's image
         repository.
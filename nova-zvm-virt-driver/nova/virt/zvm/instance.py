@@ -20,6 +20,7 @@ from oslo.config import cfg
 
 from nova.compute import power_state
 from nova import exception as nova_exception
+from nova.openstack.common import excutils
 from nova.openstack.common.gettextutils import _
 from nova.openstack.common import log as logging
 from nova.openstack.common import loopingcall
@@ -41,6 +42,7 @@ class ZVMInstance(object):
         self._xcat_conn = zvmutils.XCATConnection()
         self._instance = instance
         self._name = instance['name']
+        self._reachable = None
 
     def power_off(self):
         """Power off z/VM instance."""
@@ -58,6 +60,7 @@ class ZVMInstance(object):
                 LOG.error(msg)
                 raise nova_exception.InstancePowerOffFailure(reason=msg)
 
+    @zvmutils.time_phase('power_on')
     def power_on(self):
         """"Power on z/VM instance."""
         try:
@@ -118,9 +121,15 @@ class ZVMInstance(object):
                                              instance, mountpoint,
                                              is_active, rollback)
 
-    def get_info(self):
+    def get_info(self, power_stat=None, reachable=None):
         """Get the current status of an z/VM instance.
 
+        :param power_stat: power state of the instance if it's already
+                           known, otherwise it's queried from xCAT
+        :param reachable:  whether the instance is reachable if it's
+                           already known, otherwise it's queried from xCAT
+                           unless the instance is not running
+
         Returns a dict containing:
 
         :state:           the running state, one of the power_state codes
@@ -130,8 +139,18 @@ class ZVMInstance(object):
         :cpu_time:        (int) the CPU time used in nanoseconds
 
         """
-        power_stat = self._get_power_stat()
-        is_reachable = self.is_reachable()
+        if power_stat is None:
+            power_res, status_res = zvmutils.xcat_request_many([
+                ("GET", self._xcat_url.rpower('/' + self._name), ['stat']),
+                ("GET", self._xcat_url.nodestat('/' + self._name))])
+            power_stat = self._parse_power_stat(power_res)
+            is_reachable = self._parse_reachable(status_res)
+        elif reachable is not None:
+            is_reachable = reachable
+        else:
+            # An instance that is not running can't be reachable
+            is_reachable = (power_stat == power_state.RUNNING and
+                            self.is_reachable())
 
         max_mem_kb = int(self._instance['memory_mb']) * 1024
         if is_reachable:
@@ -192,7 +211,9 @@ class ZVMInstance(object):
         with zvmutils.except_xcat_call_failed_and_reraise(
                 exception.ZVMXCATCreateNodeFailed, node=self._name):
             zvmutils.xcat_request("POST", url, body)
+        zvmutils.get_instance_index().add(self._name, zhcp)
 
+    @zvmutils.time_phase('mkvm')
     def create_userid(self, block_device_info, image_meta):
         """Create z/VM userid into user directory for a z/VM instance."""
         # We do not support boot from volume currently
@@ -300,6 +321,8 @@ class ZVMInstance(object):
 
         try:
             zvmutils.xcat_request("DELETE", url)
+            zvmutils.get_diskpool_ledger().free(self._name)
+            zvmutils.get_instance_index().remove(self._name)
         except exception.ZVMXCATInternalError as err:
             if (err.format_message().__contains__("Return Code: 400") and
                     err.format_message().__contains__("Reason Code: 4")):
@@ -311,6 +334,8 @@ class ZVMInstance(object):
                 # The vm or vm device was locked. Unlock before deleting
                 self._wait_for_unlock(zhcp_node)
                 zvmutils.xcat_request("DELETE", url)
+                zvmutils.get_diskpool_ledger().free(self._name)
+                zvmutils.get_instance_index().remove(self._name)
             else:
                 raise err
         except exception.ZVMXCATRequestFailed as err:
@@ -318,6 +343,7 @@ class ZVMInstance(object):
             if (emsg.__contains__("Invalid nodes and/or groups") and
                     emsg.__contains__("Forbidden")):
                 # Assume neither zVM userid nor xCAT node exist in this case
+                zvmutils.get_instance_index().remove(self._name)
                 return
             else:
                 raise err
@@ -328,12 +354,13 @@ class ZVMInstance(object):
         try:
             zvmutils.xcat_request("DELETE", url)
         except exception.ZVMXCATInternalError as err:
-            if err.format_message().__contains__("Could not find an object"):
-                # The xCAT node not exist
-                return
-            else:
+            if not err.format_message().__contains__(
+                    "Could not find an object"):
                 raise err
+            # The xCAT node not exist
+        zvmutils.get_instance_index().remove(self._name)
 
+    @zvmutils.time_phase('add_mdisk')
     def add_mdisk(self, diskpool, vdev, size, fmt=None):
         """Add a 3390 mdisk for a z/VM user.
 
@@ -357,7 +384,14 @@ class ZVMInstance(object):
         else:
             body = [" ".join([action, diskpool, vdev, size])]
         url = self._xcat_url.chvm('/' + self._name)
-        zvmutils.xcat_request("PUT", url, body)
+        ledger = zvmutils.get_diskpool_ledger()
+        try:
+            zvmutils.xcat_request("PUT", url, body)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                # The minidisk may have been added anyway
+                ledger.invalidate()
+        ledger.allocate(self._name, size)
 
     def _power_state(self, method, state):
         """Invoke xCAT REST API to set/get power state for a instance."""
@@ -368,8 +402,10 @@ class ZVMInstance(object):
     def _get_power_stat(self):
         """Get power status of a z/VM instance."""
         LOG.debug(_('Query power stat of %s') % self._name)
-        res_dict = self._power_state("GET", "stat")
+        return self._parse_power_stat(self._power_state("GET", "stat"))
 
+    def _parse_power_stat(self, res_dict):
+        """Get power status from the rpower stat response."""
         @zvmutils.wrap_invalid_xcat_resp_data_error
         def _get_power_string(d):
             tempstr = d['info'][0][0]
@@ -455,8 +491,10 @@ class ZVMInstance(object):
         """Return True is the instance is reachable."""
         url = self._xcat_url.nodestat('/' + self._name)
         LOG.debug(_('Get instance status of %s') % self._name)
-        res_dict = zvmutils.xcat_request("GET", url)
+        return self._parse_reachable(zvmutils.xcat_request("GET", url))
 
+    def _parse_reachable(self, res_dict):
+        """Return True if the nodestat response shows sshd is up."""
         with zvmutils.expect_invalid_xcat_resp_data():
             status = res_dict['node'][0][0]['data'][0]
 
@@ -467,26 +505,11 @@ class ZVMInstance(object):
         return False
 
     def _wait_for_reachable(self):
-        """Called at an interval until the instance is reachable."""
-        self._reachable = False
-
-        def _wait_reachable(expiration):
-            if (CONF.zvm_reachable_timeout and
-                    timeutils.utcnow() > expiration):
-                raise loopingcall.LoopingCallDone()
-
-            if self.is_reachable():
-                self._reachable = True
-                LOG.debug(_("Instance %s reachable now") %
-                         self._name)
-                raise loopingcall.LoopingCallDone()
-
-        expiration = timeutils.utcnow() + datetime.timedelta(
-                         seconds=CONF.zvm_reachable_timeout)
-
-        timer = loopingcall.FixedIntervalLoopingCall(_wait_reachable,
-                                                     expiration)
-        timer.start(interval=5).wait()
+        """Wait until the instance is reachable or the timeout expires."""
+        poller = zvmutils.get_reachability_poller()
+        self._reachable = poller.wait(self._name, CONF.zvm_reachable_timeout)
+        if self._reachable:
+            LOG.debug(_("Instance %s reachable now") % self._name)
 
     def update_node_info(self, image_meta):
         LOG.debug(_("Update the node info for instance %s") % self._name)
@@ -556,7 +579,9 @@ class ZVMInstance(object):
         with zvmutils.except_xcat_call_failed_and_reraise(
                 exception.ZVMXCATUpdateNodeFailed, node=self._name):
             zvmutils.xcat_request("PUT", url, body)
+        zvmutils.get_instance_index().add(self._name, hcp)
 
+    @zvmutils.time_phase('nodeset')
     def deploy_node(self, image_name, transportfiles=None, vdev=None):
         LOG.debug(_("Begin to deploy image on instance %s") % self._name)
         vdev = vdev or CONF.zvm_user_root_vdev
@@ -595,6 +620,14 @@ class ZVMInstance(object):
                 exception.ZVMXCATCreateNodeFailed, node=self._name):
             zvmutils.xcat_request("POST", url, body)
 
+        index = zvmutils.get_instance_index()
+        hcps = [info.partition('=')[2] for info in body
+                if info.startswith('hcp=')]
+        if hcps:
+            index.add(self._name, hcps[0])
+        else:
+            index.invalidate()
+
     def get_console_log(self, logsize):
         """get console log."""
         url = self._xcat_url.rinv('/' + self._name, '&field=console'
@@ -0,0 +1,163 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Summarize the phase timings logged by the z/VM driver.
+
+When zvm_phase_log_file is set, the driver appends one JSON line per timed
+phase of spawn, snapshot, migrate_disk_and_power_off and finish_migration,
+plus a 'total' line per operation, e.g.:
+
+    {"duration": 41.2, "instance": "os000001", "ok": true,
+     "operation": "spawn", "phase": "nodeset", "started": 1400000000.0,
+     "time": 1400000012.5, "uuid": "..."}
+
+This tool prints the p50/p95/p99 duration of every phase of every
+operation logged within a time window:
+
+    python -m nova.virt.zvm.phaselog /var/log/nova/zvm-phases.log --since 24h
+
+A phase run several times in one operation, like the punch of each file,
+is summed per operation. The spawn steps run concurrently, so the phases
+of a spawn may overlap and do not add up to its total.
+"""
+
+import argparse
+import collections
+import json
+import math
+import sys
+import time
+
+
+_WINDOW_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_window(value):
+    """Parse a window like '90s', '30m', '24h' or '7d' into seconds."""
+    value = value.strip().lower()
+    unit = _WINDOW_UNITS.get(value[-1:])
+    if unit is None:
+        unit = 1
+    else:
+        value = value[:-1]
+    try:
+        return float(value) * unit
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid time window: %r" % value)
+
+
+def read_records(lines, since=None, operation=None):
+    """Yield the phase records from lines, skipping malformed ones."""
+    for line in lines:
+        try:
+            rec = json.loads(line)
+            if since is not None and rec['time'] < since:
+                continue
+            if operation is not None and rec['operation'] != operation:
+                continue
+            rec['duration'] = float(rec['duration'])
+        except (ValueError, KeyError, TypeError):
+            continue
+        yield rec
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summarize(records):
+    """Return the duration percentiles of each phase of each operation.
+
+    The result maps (operation, phase) to a dict of count, failed, p50,
+    p95, p99 and max, where count is the number of operations that ran
+    the phase.
+
+    """
+    runs = collections.defaultdict(dict)
+    failed = collections.defaultdict(int)
+    for rec in records:
+        key = (rec['operation'], rec['phase'])
+        run = (rec.get('uuid') or rec.get('instance'), rec.get('started'))
+        runs[key][run] = runs[key].get(run, 0.0) + rec['duration']
+        if not rec.get('ok', True):
+            failed[key] += 1
+
+    summary = {}
+    for key, durations in runs.items():
+        values = sorted(durations.values())
+        summary[key] = {'count': len(values),
+                        'failed': failed[key],
+                        'p50': percentile(values, 50),
+                        'p95': percentile(values, 95),
+                        'p99': percentile(values, 99),
+                        'max': values[-1]}
+    return summary
+
+
+def format_summary(summary):
+    """Return the summary as a table, phases ordered by p95 per operation."""
+    header = ('operation', 'phase', 'count', 'failed',
+              'p50', 'p95', 'p99', 'max')
+    rows = []
+    for key in sorted(summary,
+                      key=lambda k: (k[0], k[1] != 'total',
+                                     -summary[k]['p95'])):
+        stat = summary[key]
+        rows.append((key[0], key[1], str(stat['count']), str(stat['failed']))
+                    + tuple('%.1f' % stat[f]
+                            for f in ('p50', 'p95', 'p99', 'max')))
+
+    widths = [max(len(row[i]) for row in [header] + rows)
+              for i in range(len(header))]
+    lines = []
+    for row in [header] + rows:
+        cells = [row[i].ljust(widths[i]) if i < 2 else row[i].rjust(widths[i])
+                 for i in range(len(row))]
+        lines.append('  '.join(cells).rstrip())
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Summarize the z/VM driver phase timing log.')
+    parser.add_argument('log_file', help='the zvm_phase_log_file to read')
+    parser.add_argument('--since', type=parse_window, default=None,
+                        help='only read phases of the last window, '
+                             'e.g. 30m, 24h or 7d')
+    parser.add_argument('--operation', default=None,
+                        help='only summarize this operation, e.g. spawn')
+    args = parser.parse_args(argv)
+
+    since = None
+    if args.since is not None:
+        since = time.time() - args.since
+
+    with open(args.log_file) as f:
+        summary = summarize(read_records(f, since, args.operation))
+
+    if not summary:
+        sys.stdout.write('No phase timings found.\n')
+        return 1
+    sys.stdout.write(format_summary(summary) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
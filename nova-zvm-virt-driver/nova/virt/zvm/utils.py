@@ -15,22 +15,36 @@
 #    under the License.
 
 
+import collections
 import contextlib
+import copy
 import functools
 import httplib
+import inspect
 import os
+import random
+import re
 import shutil
 import socket
 import time
 
+from eventlet import corolocal
+from eventlet import event
+from eventlet import greenpool
+from eventlet import greenthread
+from eventlet import queue
+from eventlet import semaphore
+from eventlet import timeout as eventlet_timeout
 from oslo.config import cfg
 
 from nova import block_device
 from nova.compute import power_state
 from nova.openstack.common import excutils
+from nova.openstack.common import fileutils
 from nova.openstack.common.gettextutils import _
 from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
+from nova.openstack.common import units
 from nova.virt import driver
 from nova.virt.zvm import const
 from nova.virt.zvm import exception
@@ -41,6 +55,8 @@ LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 CONF.import_opt('instances_path', 'nova.compute.manager')
 
+_WARNING_PATTERN = re.compile('warn', re.IGNORECASE)
+
 
 class XCATUrl(object):
     """To return xCAT url for invoking xCAT REST API."""
@@ -60,6 +76,7 @@ class XCATUrl(object):
         self.TABLES = '/tables'
         self.HV = '/hypervisor'
         self.NETWORK = '/networks'
+        self.VERSION = '/version'
 
         self.POWER = '/power'
         self.INVENTORY = '/inventory'
@@ -176,15 +193,429 @@ class XCATUrl(object):
         else:
             return rurl
 
+    def version(self):
+        return self.PREFIX + self.VERSION + self.SUFFIX
+
+
+class XCATConnectionPool(object):
+    """Bounded pool of persistent https connections to one xCAT server.
+
+    Connections are kept alive between requests and handed out LIFO, idle
+    connections older than the idle timeout are closed on the next access.
+
+    """
+
+    def __init__(self, host, max_size, idle_timeout, timeout):
+        self.host = host
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._idle = []
+        self._lock = semaphore.Semaphore()
+        self._max_size = max_size
+        self._slots = semaphore.Semaphore(max_size)
+
+    @property
+    def load(self):
+        """Number of connections in use and requests waiting for one."""
+        return self._max_size - self._slots.balance
+
+    def _evict_idle(self, now):
+        """Close connections that have been idle for too long."""
+        fresh = []
+        with self._lock:
+            for conn, last_used in self._idle:
+                if now - last_used < self._idle_timeout:
+                    fresh.append((conn, last_used))
+                else:
+                    conn.close()
+            self._idle = fresh
+
+    def get(self, new=False):
+        """Get a connection from the pool, wait if the pool is exhausted.
+
+        Returns a tuple of (connection, reused), reused is True if the
+        connection has been used by an earlier request. If new is True, a
+        new connection is always created.
+
+        """
+        self._slots.acquire()
+        self._evict_idle(time.time())
+        if not new:
+            with self._lock:
+                if self._idle:
+                    return self._idle.pop()[0], True
+
+        try:
+            return self._connect(), False
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._slots.release()
+
+    def _connect(self):
+        return httplib.HTTPSConnection(self.host, timeout=self._timeout)
+
+    def put(self, conn):
+        """Return a healthy connection to the pool for reuse."""
+        with self._lock:
+            self._idle.append((conn, time.time()))
+        self._slots.release()
+
+    def discard(self, conn):
+        """Close a broken connection and free its slot."""
+        try:
+            conn.close()
+        finally:
+            self._slots.release()
+
+
+_XCAT_CONN_POOLS = {}
+
+
+def get_xcat_conn_pool(host):
+    """Return the connection pool of xCAT server host, create if needed."""
+    pool = _XCAT_CONN_POOLS.get(host)
+    if pool is None:
+        pool = XCATConnectionPool(host,
+                                  CONF.zvm_xcat_connection_pool_size,
+                                  CONF.zvm_xcat_connection_idle_timeout,
+                                  CONF.zvm_xcat_connection_timeout)
+        _XCAT_CONN_POOLS[host] = pool
+    return pool
+
+
+class XCATCircuitBreaker(object):
+    """Circuit breaker of the requests to one xCAT server.
+
+    The breaker opens after a number of consecutive communication failures
+    and requests fail fast while it is open. Once the reset timeout expires
+    the next request sends a health probe first, the breaker is closed if
+    the probe succeeds and stays open for another reset timeout otherwise.
+
+    """
+
+    def __init__(self, host, threshold, reset_timeout):
+        self.host = host
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def _fail_fast(self):
+        msg = _("xCAT server is unavailable, retry after %ds") % \
+                self._reset_timeout
+        return exception.ZVMXCATRequestFailed(xcatserver=self.host, msg=msg)
+
+    def _probe(self):
+        """Check whether xCAT server can respond to a trivial request."""
+        conn = httplib.HTTPSConnection(self.host,
+                                       timeout=const.XCAT_HEALTH_PROBE_TIMEOUT)
+        try:
+            conn.request("GET", XCATUrl().version())
+            res = conn.getresponse()
+            res.read()
+            return res.status == 200
+        except Exception as err:
+            LOG.debug(_("Health probe to xCAT server %(host)s failed: "
+                        "%(err)s") % {'host': self.host, 'err': err})
+            return False
+        finally:
+            conn.close()
+
+    def check(self):
+        """Raise ZVMXCATRequestFailed if the request should fail fast."""
+        if self._opened_at is None:
+            return
+
+        if (self._probing or
+                time.time() - self._opened_at < self._reset_timeout):
+            raise self._fail_fast()
+
+        # Only one request probes xCAT, others keep failing fast meanwhile
+        self._probing = True
+        try:
+            healthy = self._probe()
+        finally:
+            self._probing = False
+
+        if healthy:
+            LOG.info(_("xCAT server %s is available again") % self.host)
+            self.record_success()
+        else:
+            self._opened_at = time.time()
+            raise self._fail_fast()
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self, trip=False):
+        """Count a failed request, open the breaker at once if trip."""
+        self._failures += 1
+        if (self._threshold > 0 and self._opened_at is None and
+                (trip or self._failures >= self._threshold)):
+            LOG.warn(_("xCAT server %(host)s failed %(num)d requests in a "
+                       "row, requests will fail fast for %(timeout)ds") %
+                     {'host': self.host, 'num': self._failures,
+                      'timeout': self._reset_timeout})
+            self._opened_at = time.time()
+
+
+_XCAT_BREAKERS = {}
+
+
+def get_xcat_breaker(host):
+    """Return the circuit breaker of xCAT server host, create if needed."""
+    breaker = _XCAT_BREAKERS.get(host)
+    if breaker is None:
+        breaker = XCATCircuitBreaker(host,
+                                     CONF.zvm_xcat_breaker_threshold,
+                                     CONF.zvm_xcat_breaker_reset_timeout)
+        _XCAT_BREAKERS[host] = breaker
+    return breaker
+
+
+class XCATRateLimiter(object):
+    """Token bucket limiting the rate of requests to one xCAT server.
+
+    Requests over the rate wait in one queue per priority class, a request
+    is only admitted when no request of a higher priority is waiting, so
+    background traffic can't starve the interactive operations.
+
+    """
+
+    def __init__(self, host, rate, burst):
+        self.host = host
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._tokens = float(self._burst)
+        self._updated_at = time.time()
+        self._waiters = [collections.deque()
+                         for name in const.XCAT_PRIORITY_NAMES]
+        self._stats = [{'max_queued': 0, 'admitted': 0, 'wait_time': 0.0}
+                       for name in const.XCAT_PRIORITY_NAMES]
+
+    def _refill(self):
+        now = time.time()
+        elapsed = now - self._updated_at
+        self._tokens = min(self._burst, self._tokens + elapsed * self._rate)
+        self._updated_at = now
+
+    def _is_next(self, priority, waiter):
+        for waiters in self._waiters[:priority]:
+            if waiters:
+                return False
+        return self._waiters[priority][0] is waiter
+
+    def acquire(self, priority):
+        """Wait until a request of the priority class can be sent."""
+        if self._rate <= 0:
+            return
+
+        start = time.time()
+        waiter = object()
+        waiters = self._waiters[priority]
+        stat = self._stats[priority]
+        waiters.append(waiter)
+        stat['max_queued'] = max(stat['max_queued'], len(waiters))
+        try:
+            while True:
+                self._refill()
+                if self._tokens >= 1 and self._is_next(priority, waiter):
+                    self._tokens -= 1
+                    break
+                greenthread.sleep(max(1 - self._tokens, 0.1) / self._rate)
+        finally:
+            waiters.remove(waiter)
+
+        stat['admitted'] += 1
+        stat['wait_time'] += time.time() - start
+
+    def get_stats(self):
+        """Return the queue depth and wait time of each priority class."""
+        stats = {}
+        for priority, name in enumerate(const.XCAT_PRIORITY_NAMES):
+            stats[name] = dict(self._stats[priority],
+                               queued=len(self._waiters[priority]))
+        return stats
+
+
+def _get_xcat_servers():
+    """Return the primary and the standby xCAT servers."""
+    return [CONF.zvm_xcat_server] + [host for host in
+                                     CONF.zvm_xcat_standby_servers if host]
+
+
+def select_xcat_server(method):
+    """Return the xCAT server a request is sent to.
+
+    Writes are sent to the primary server and GETs to the server with the
+    least loaded connection pool. A server whose circuit breaker is open is
+    skipped in favor of the next one, so requests fail over to a standby
+    server after consecutive failures and fail back once the primary
+    server passes the health probe again. ZVMXCATRequestFailed is raised
+    if no server is available.
+
+    """
+    servers = _get_xcat_servers()
+    if method == "GET" and len(servers) > 1:
+        # The sort is stable, the primary server wins a tie
+        servers.sort(key=lambda host: get_xcat_conn_pool(host).load)
+
+    for host in servers[:-1]:
+        try:
+            get_xcat_breaker(host).check()
+            return host
+        except exception.ZVMXCATRequestFailed:
+            continue
+
+    get_xcat_breaker(servers[-1]).check()
+    return servers[-1]
+
+
+_XCAT_RATE_LIMITERS = {}
+
+
+def get_xcat_rate_limiter(host):
+    """Return the rate limiter of xCAT server host, create if needed."""
+    limiter = _XCAT_RATE_LIMITERS.get(host)
+    if limiter is None:
+        limiter = XCATRateLimiter(host, CONF.zvm_xcat_request_rate,
+                                  CONF.zvm_xcat_request_burst)
+        _XCAT_RATE_LIMITERS[host] = limiter
+    return limiter
+
+
+_XCAT_PRIORITY = corolocal.local()
+
+
+@contextlib.contextmanager
+def xcat_request_priority(priority):
+    """Send the xCAT requests issued in the block with the priority."""
+    saved = getattr(_XCAT_PRIORITY, 'value', None)
+    _XCAT_PRIORITY.value = priority
+    try:
+        yield
+    finally:
+        _XCAT_PRIORITY.value = saved
+
+
+def _get_request_priority(method, url, body=None):
+    """Return the priority class of an xCAT request.
+
+    The priority set by xcat_request_priority takes precedence, otherwise
+    power, status and device attach operations are interactive. Others,
+    e.g. mkvm, rmvm, disk and punch requests of /vms, are provisioning.
+
+    """
+    priority = getattr(_XCAT_PRIORITY, 'value', None)
+    if priority is not None:
+        return priority
+
+    endpoint = _get_endpoint_class(url)
+    if endpoint in const.XCAT_INTERACTIVE_ENDPOINTS:
+        return const.XCAT_PRIORITY_INTERACTIVE
+    elif endpoint == 'vms' and method == "PUT" and body:
+        option = body[0].split(' ', 1)[0]
+        if option in const.XCAT_INTERACTIVE_CHVM_OPTIONS:
+            return const.XCAT_PRIORITY_INTERACTIVE
+    return const.XCAT_PRIORITY_PROVISIONING
+
+
+def _get_retry_interval(attempt):
+    """Exponential backoff interval with jitter of the attempt-th retry."""
+    ceiling = min(CONF.zvm_xcat_retry_interval * 2 ** (attempt - 1),
+                  const.XCAT_RETRY_MAX_INTERVAL)
+    return ceiling / 2.0 + random.uniform(0, ceiling / 2.0)
+
 
 class XCATConnection():
     """Https requests to xCAT web service."""
 
     def __init__(self):
-        """Initialize https connection to xCAT service."""
+        """Initialize https connection to xCAT service.
+
+        The underlying connections are shared through the connection pool
+        of the xCAT server. Each request is sent to the server picked by
+        select_xcat_server.
+
+        """
         self.host = CONF.zvm_xcat_server
-        self.conn = httplib.HTTPSConnection(self.host,
-                        timeout=CONF.zvm_xcat_connection_timeout)
+
+    def _send(self, pool, conn, method, url, body, headers):
+        """Send the request on a pooled connection, discard it on failure."""
+        try:
+            conn.request(method, url, body, headers)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                pool.discard(conn)
+
+    def _receive(self, pool, conn):
+        """Read the response of a sent request and release the connection.
+
+        Returns a tuple of (response, response body).
+
+        """
+        try:
+            res = conn.getresponse()
+            msg = res.read()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                pool.discard(conn)
+
+        if res.will_close:
+            pool.discard(conn)
+        else:
+            pool.put(conn)
+
+        return res, msg
+
+    def _request_with_reconnect(self, method, url, body, headers):
+        """Send the request, reconnect once if a kept-alive socket is stale.
+
+        The request is sent again on a new connection if it could not be
+        sent on the stale socket. Once it's sent, xCAT may have run it
+        already, so only an idempotent request is sent again.
+
+        Returns a tuple of (response, response body).
+
+        """
+        pool = get_xcat_conn_pool(self.host)
+        conn, reused = pool.get()
+        sent = False
+        try:
+            self._send(pool, conn, method, url, body, headers)
+            sent = True
+            return self._receive(pool, conn)
+        except (httplib.HTTPException, socket.error) as err:
+            if (not reused or not self._is_retriable(err) or
+                    (sent and method not in const.XCAT_IDEMPOTENT_METHODS)):
+                raise
+            # The kept-alive socket was closed by xCAT, reconnect once
+            LOG.debug(_("Reconnecting to xCAT server %(host)s: %(err)s") %
+                      {'host': self.host, 'err': err})
+            conn, reused = pool.get(new=True)
+            self._send(pool, conn, method, url, body, headers)
+            return self._receive(pool, conn)
+
+    def _is_retriable(self, err):
+        """Whether the request may succeed if it's sent again."""
+        if isinstance(err, (socket.gaierror, socket.timeout)):
+            return False
+        return isinstance(err, (httplib.HTTPException, socket.error))
+
+    def _request_failed(self, err):
+        if isinstance(err, socket.gaierror):
+            msg = _("Failed to find address: %s") % err
+        elif isinstance(err, socket.error):
+            msg = _("Communication error: %s") % err
+        else:
+            msg = _("Failed to get response from xCAT: %s") % err
+        return exception.ZVMXCATRequestFailed(xcatserver=self.host, msg=msg)
 
     def request(self, method, url, body=None, headers={}):
         """Send https request to xCAT server.
@@ -195,27 +626,48 @@ class XCATConnection():
          'message': response message}
 
         """
+        priority = _get_request_priority(method, url, body)
         if body is not None:
             body = jsonutils.dumps(body)
             headers = {'content-type': 'text/plain',
                        'content-length': len(body)}
 
-        try:
-            self.conn.request(method, url, body, headers)
-        except socket.gaierror as err:
-            msg = _("Failed to find address: %s") % err
-            raise exception.ZVMXCATRequestFailed(xcatserver=self.host, msg=msg)
-        except (socket.error, socket.timeout) as err:
-            msg = _("Communication error: %s") % err
-            raise exception.ZVMXCATRequestFailed(xcatserver=self.host, msg=msg)
-
-        try:
-            res = self.conn.getresponse()
-        except Exception as err:
-            msg = _("Failed to get response from xCAT: %s") % err
-            raise exception.ZVMXCATRequestFailed(xcatserver=self.host, msg=msg)
+        retries = CONF.zvm_xcat_request_retries if method == "GET" else 0
+        # xCAT answers a GET quickly unless it's degraded, don't wait for
+        # it as long as for a provisioning request
+        read_timeout = None
+        if method in const.XCAT_IDEMPOTENT_METHODS:
+            read_timeout = CONF.zvm_xcat_read_timeout or None
+        attempt = 0
+        while True:
+            self.host = select_xcat_server(method)
+            breaker = get_xcat_breaker(self.host)
+            # Each xCAT server is limited to its own request rate
+            get_xcat_rate_limiter(self.host).acquire(priority)
+            try:
+                timed_out = socket.timeout(_("timed out after %ss") %
+                                           read_timeout)
+                with eventlet_timeout.Timeout(read_timeout, timed_out):
+                    res, msg = self._request_with_reconnect(method, url,
+                                                            body, headers)
+            except Exception as err:
+                timeout = isinstance(err, socket.timeout)
+                breaker.record_failure(trip=timeout)
+                if attempt >= retries or not (timeout or
+                                              self._is_retriable(err)):
+                    raise self._request_failed(err)
+
+                attempt += 1
+                interval = _get_retry_interval(attempt)
+                LOG.warn(_("Request to xCAT server %(host)s failed: %(err)s, "
+                           "retry in %(interval).1fs") %
+                         {'host': self.host, 'err': err,
+                          'interval': interval})
+                time.sleep(interval)
+            else:
+                breaker.record_success()
+                break
 
-        msg = res.read()
         resp = {
             'status': res.status,
             'reason': res.reason,
@@ -238,10 +690,637 @@ class XCATConnection():
         return resp
 
 
-def xcat_request(method, url, body=None, headers={}):
+class XCATRequestCoalescer(object):
+    """Share one in-flight xCAT GET among identical concurrent requests.
+
+    The first request of a key is sent to xCAT, identical requests issued
+    before it completes wait for it and get a copy of its parsed result
+    or its exception.
+
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._stats = {'requests': 0, 'coalesced': 0}
+
+    def request(self, key, func):
+        self._stats['requests'] += 1
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._stats['coalesced'] += 1
+            inflight['waiters'] += 1
+            return copy.deepcopy(inflight['event'].wait())
+
+        inflight = {'event': event.Event(), 'waiters': 0}
+        self._inflight[key] = inflight
+        try:
+            result = func()
+        except Exception as err:
+            with excutils.save_and_reraise_exception():
+                del self._inflight[key]
+                inflight['event'].send_exception(err)
+
+        del self._inflight[key]
+        inflight['event'].send(result)
+        if inflight['waiters'] > 0:
+            # The waiters copy the result when they are resumed
+            return copy.deepcopy(result)
+        return result
+
+    def get_stats(self):
+        """Return the request counters and the coalesce rate."""
+        stats = dict(self._stats)
+        if stats['requests'] > 0:
+            stats['rate'] = float(stats['coalesced']) / stats['requests']
+        else:
+            stats['rate'] = 0.0
+        return stats
+
+
+_XCAT_COALESCER = XCATRequestCoalescer()
+
+
+def get_xcat_coalesce_stats():
+    """Return the statistics of coalesced xCAT GET requests."""
+    return _XCAT_COALESCER.get_stats()
+
+
+def _parse_xcat_url(url):
+    """Split xCAT url into the path segments after /xcatws and the query."""
+    path, sep, query = url.partition('?')
+    return path.split('/')[2:], query
+
+
+def _get_cacheable_endpoint(url):
+    """Return (endpoint, resources) of a cacheable GET url, None otherwise.
+
+    The resources are the nodes and tables the response is read from, a
+    node definition is read from any of the node tables.
+
+    """
+    segs, query = _parse_xcat_url(url)
+    if not segs:
+        return None
+    elif segs[0] == 'nodes' and len(segs) == 2:
+        return 'lsdef_node', set([('node', segs[1]), ('table', '*')])
+    elif segs[:2] == ['tables', 'nodetype']:
+        return 'gettab_nodetype', set([('table', 'nodetype')])
+    elif (segs[0] == 'nodes' and segs[2:] == ['inventory'] and
+            '--diskpoolspace' in query):
+        return 'diskpoolspace', set([('node', segs[1]), ('diskpool',)])
+    return None
+
+
+def _get_written_resources(url):
+    """Return the nodes and tables that may be changed by a write to url."""
+    segs, query = _parse_xcat_url(url)
+    if len(segs) < 2:
+        return set()
+
+    if segs[0] == 'nodes':
+        # Only the node definition, boot state and migration change the
+        # node tables, power and xdsh requests leave them alone.
+        if segs[2:] not in ([], ['bootstate'], ['migrate']):
+            return set()
+        written = set(('node', n) for n in segs[1].split(','))
+        written.add(('table', '*'))
+        return written
+    elif segs[0] == 'tables':
+        return set([('table', segs[1])])
+    elif segs[0] in ('vms', 'hypervisor'):
+        return set([('node', segs[1]), ('diskpool',)])
+    return set()
+
+
+class XCATResponseCache(object):
+    """LRU cache of the parsed responses of read-only xCAT requests.
+
+    Entries expire after the TTL of their endpoint, and the least recently
+    used entry is dropped when the cache is full. A write request drops the
+    entries read from the nodes or tables it changes.
+
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        # Increased on each invalidation, so that a response read before a
+        # write is not cached after it
+        self.generation = 0
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry['expires'] <= time.time():
+            self._stats['misses'] += 1
+            return None
+
+        self._entries[key] = entry
+        self._stats['hits'] += 1
+        return copy.deepcopy(entry['result'])
+
+    def put(self, key, endpoint, resources, result, generation):
+        if self._max_size <= 0 or generation != self.generation:
+            return
+
+        self._entries.pop(key, None)
+        self._entries[key] = {
+            'expires': time.time() + const.XCAT_CACHE_TTL[endpoint],
+            'resources': resources,
+            'result': copy.deepcopy(result)}
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, written):
+        if not written:
+            return
+
+        self.generation += 1
+        all_tables = ('table', '*') in written
+        # Node definitions, tagged ('table', '*'), are read from the node
+        # tables, so a write to any of them drops the definitions
+        table_write = any(res[0] == 'table' and res[1] != '*'
+                          for res in written)
+
+        def _is_written(res):
+            if res == ('table', '*'):
+                return table_write
+            return res in written or (all_tables and res[0] == 'table')
+
+        for key, entry in self._entries.items():
+            if any(_is_written(res) for res in entry['resources']):
+                del self._entries[key]
+                self._stats['invalidations'] += 1
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['size'] = len(self._entries)
+        return stats
+
+
+_XCAT_CACHE = None
+
+
+def get_xcat_cache():
+    """Return the xCAT response cache, create if needed."""
+    global _XCAT_CACHE
+    if _XCAT_CACHE is None:
+        _XCAT_CACHE = XCATResponseCache(CONF.zvm_xcat_cache_size)
+    return _XCAT_CACHE
+
+
+def _get_endpoint_class(url):
+    """Return the endpoint class of an xCAT url for the request metrics.
+
+    Node names and the query string, which contains the credentials, are
+    dropped, e.g. "/xcatws/nodes/os000001/power?userName=.." is classified
+    as "nodes/power".
+
+    """
+    segs, query = _parse_xcat_url(url)
+    if not segs or not segs[0]:
+        return 'unknown'
+    elif segs[0] in ('nodes', 'vms', 'hypervisor'):
+        return '/'.join([segs[0]] + segs[2:])
+    elif segs[0] in ('tables', 'objects'):
+        return '/'.join(segs[:2])
+    elif segs[0] == 'images':
+        actions = ('capture', 'export', 'import')
+        return '/'.join([segs[0]] + [a for a in segs[1:] if a in actions])
+    return segs[0]
+
+
+class XCATRequestStats(object):
+    """Call counters and latency histograms of xCAT requests.
+
+    The requests are grouped by method and endpoint class. The metrics are
+    written to a file in Prometheus text format and summarized in the log
+    every zvm_xcat_metrics_interval seconds.
+
+    """
+
+    def __init__(self, prefix):
+        self._prefix = prefix
+        self._stats = {}
+        self._flushed_at = time.time()
+
+    def record(self, method, url, latency, nbytes, failed):
+        key = (method, _get_endpoint_class(url))
+        stat = self._stats.get(key)
+        if stat is None:
+            stat = {'count': 0, 'errors': 0, 'bytes': 0,
+                    'latency_sum': 0.0, 'latency_max': 0.0,
+                    'buckets': [0] * len(const.XCAT_LATENCY_BUCKETS)}
+            self._stats[key] = stat
+
+        stat['count'] += 1
+        stat['errors'] += 1 if failed else 0
+        stat['bytes'] += nbytes
+        stat['latency_sum'] += latency
+        stat['latency_max'] = max(stat['latency_max'], latency)
+        for i, bound in enumerate(const.XCAT_LATENCY_BUCKETS):
+            if latency <= bound:
+                stat['buckets'][i] += 1
+
+    def get_summary(self):
+        """Return the metrics as a dict keyed by "method endpoint"."""
+        summary = {}
+        for (method, endpoint), stat in self._stats.iteritems():
+            summary[' '.join((method, endpoint))] = {
+                'count': stat['count'],
+                'errors': stat['errors'],
+                'bytes': stat['bytes'],
+                'latency_avg': round(stat['latency_sum'] / stat['count'], 3),
+                'latency_max': round(stat['latency_max'], 3)}
+        return summary
+
+    def to_prometheus(self):
+        """Return the metrics in Prometheus text exposition format."""
+        counters = (('requests_total', 'count',
+                     'Number of xCAT REST requests.'),
+                    ('request_errors_total', 'errors',
+                     'Number of failed xCAT REST requests.'),
+                    ('response_bytes_total', 'bytes',
+                     'Bytes of xCAT REST response bodies.'))
+        keys = sorted(self._stats.keys())
+        lines = []
+        for name, field, doc in counters:
+            metric = '%s_%s' % (self._prefix, name)
+            lines.append('# HELP %s %s' % (metric, doc))
+            lines.append('# TYPE %s counter' % metric)
+            for key in keys:
+                lines.append('%s{%s} %d' % (metric, self._labels(key),
+                                            self._stats[key][field]))
+
+        metric = '%s_request_duration_seconds' % self._prefix
+        lines.append('# HELP %s Latency of xCAT REST requests.' % metric)
+        lines.append('# TYPE %s histogram' % metric)
+        for key in keys:
+            stat = self._stats[key]
+            labels = self._labels(key)
+            for bound, num in zip(const.XCAT_LATENCY_BUCKETS,
+                                  stat['buckets']):
+                lines.append('%s_bucket{%s,le="%s"} %d' %
+                             (metric, labels, bound, num))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' %
+                         (metric, labels, stat['count']))
+            lines.append('%s_sum{%s} %.6f' %
+                         (metric, labels, stat['latency_sum']))
+            lines.append('%s_count{%s} %d' % (metric, labels, stat['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def _labels(self, key):
+        return 'method="%s",endpoint="%s"' % key
+
+    def maybe_flush(self):
+        """Write the metrics file and log a summary if the interval expired."""
+        now = time.time()
+        if now - self._flushed_at < CONF.zvm_xcat_metrics_interval:
+            return
+        self._flushed_at = now
+
+        path = CONF.zvm_xcat_metrics_file
+        if path:
+            tmp_path = path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(self.to_prometheus())
+                os.rename(tmp_path, path)
+            except (IOError, OSError) as err:
+                LOG.warn(_("Failed to write xCAT metrics file %(path)s: "
+                           "%(err)s") % {'path': path, 'err': err})
+
+        LOG.info(_("xCAT request summary: %s") %
+                 jsonutils.dumps(self.get_summary(), sort_keys=True))
+
+
+_XCAT_REQUEST_STATS = XCATRequestStats('nova_zvm_xcat')
+
+
+def get_xcat_request_stats():
+    """Return the metrics of the xCAT requests sent by this process."""
+    return _XCAT_REQUEST_STATS
+
+
+class XCATCallAccounting(object):
+    """xCAT requests made by one driver operation."""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.calls = 0
+        self.time = 0.0
+        self.endpoints = collections.defaultdict(int)
+
+    def record(self, method, url, latency):
+        self.calls += 1
+        self.time += latency
+        self.endpoints[' '.join((method, _get_endpoint_class(url)))] += 1
+
+
+_XCAT_ACCOUNTING = corolocal.local()
+
+
+def get_xcat_call_accounting():
+    """Return the call accounting of the running operation, if any."""
+    return getattr(_XCAT_ACCOUNTING, 'value', None)
+
+
+@contextlib.contextmanager
+def xcat_call_accounting(operation):
+    """Account the xCAT requests issued in the block to operation.
+
+    Requests are accounted to the outermost operation, e.g. the requests
+    of destroy called by a failed spawn are accounted to spawn. The call
+    count and the time spent in xCAT are logged when the block exits.
+
+    """
+    accounting = get_xcat_call_accounting()
+    if accounting is not None:
+        yield accounting
+        return
+
+    accounting = XCATCallAccounting(operation)
+    _XCAT_ACCOUNTING.value = accounting
+    try:
+        yield accounting
+    finally:
+        _XCAT_ACCOUNTING.value = None
+        LOG.debug(_("%(operation)s made %(calls)d xCAT requests in "
+                    "%(time).2fs: %(endpoints)s") %
+                  {'operation': operation, 'calls': accounting.calls,
+                   'time': accounting.time,
+                   'endpoints': dict(accounting.endpoints)})
+
+
+def account_xcat_calls(function):
+    """Decorator accounting the xCAT requests of a driver operation."""
+    @functools.wraps(function)
+    def decorated_function(*args, **kwargs):
+        with xcat_call_accounting(function.__name__):
+            return function(*args, **kwargs)
+
+    return decorated_function
+
+
+class PhaseTimings(object):
+    """Phase timings of an operation on an instance."""
+
+    def __init__(self, operation, instance):
+        self.operation = operation
+        self.instance = instance['name']
+        self.uuid = instance['uuid']
+        self.started = time.time()
+        self.records = []
+
+    def record(self, phase, start, ok=True):
+        self.records.append({'time': round(start, 3),
+                             'started': round(self.started, 3),
+                             'instance': self.instance,
+                             'uuid': self.uuid,
+                             'operation': self.operation,
+                             'phase': phase,
+                             'duration': round(time.time() - start, 3),
+                             'ok': ok})
+
+
+_PHASE_TIMINGS = corolocal.local()
+
+
+def get_phase_timings():
+    """Return the phase timings of the running operation, if any."""
+    return getattr(_PHASE_TIMINGS, 'value', None)
+
+
+@contextlib.contextmanager
+def phase_timings(operation, instance):
+    """Time the phases of operation run in the block.
+
+    The phases are appended to the zvm_phase_log_file as JSON lines when
+    the block exits, with a 'total' phase of the whole operation. Phases
+    of nested operations are timed as part of the outermost one.
+
+    """
+    if not CONF.zvm_phase_log_file or get_phase_timings() is not None:
+        yield
+        return
+
+    timings = PhaseTimings(operation, instance)
+    _PHASE_TIMINGS.value = timings
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        _PHASE_TIMINGS.value = None
+        timings.record('total', timings.started, ok)
+        _append_phase_log(timings.records)
+
+
+def _append_phase_log(records):
+    path = CONF.zvm_phase_log_file
+    try:
+        with open(path, 'a') as f:
+            for rec in records:
+                f.write(jsonutils.dumps(rec, sort_keys=True) + '\n')
+    except (IOError, OSError) as err:
+        LOG.warn(_("Failed to write phase log file %(path)s: %(err)s") %
+                 {'path': path, 'err': err})
+
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    """Time the block as a phase of the running operation."""
+    timings = get_phase_timings()
+    if timings is None:
+        yield
+        return
+
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        timings.record(phase, start, ok)
+
+
+def time_phase(phase):
+    """Decorator timing a function as a phase of the running operation."""
+    def decorator(function):
+        @functools.wraps(function)
+        def decorated_function(*args, **kwargs):
+            with timed_phase(phase):
+                return function(*args, **kwargs)
+
+        return decorated_function
+    return decorator
+
+
+def time_phases(function):
+    """Decorator timing the phases of a driver operation on an instance."""
+    @functools.wraps(function)
+    def decorated_function(*args, **kwargs):
+        instance = inspect.getcallargs(function, *args, **kwargs)['instance']
+        with phase_timings(function.__name__, instance):
+            return function(*args, **kwargs)
+
+    return decorated_function
+
+
+def _xcat_request(method, url, body=None, headers={}):
     conn = XCATConnection()
-    resp = conn.request(method, url, body, headers)
-    return load_xcat_resp(resp['message'])
+    start = time.time()
+    nbytes = 0
+    failed = True
+    try:
+        resp = conn.request(method, url, body, headers)
+        nbytes = len(resp['message'])
+        result = load_xcat_resp(resp['message'])
+        failed = False
+        return result
+    finally:
+        latency = time.time() - start
+        stats = get_xcat_request_stats()
+        stats.record(method, url, latency, nbytes, failed)
+        stats.maybe_flush()
+        accounting = get_xcat_call_accounting()
+        if accounting is not None:
+            accounting.record(method, url, latency)
+
+
+def xcat_request(method, url, body=None, headers={}):
+    cache = get_xcat_cache()
+    if method != "GET":
+        try:
+            return _xcat_request(method, url, body, headers)
+        finally:
+            cache.invalidate(_get_written_resources(url))
+
+    key = (url, jsonutils.dumps(body))
+    endpoint = _get_cacheable_endpoint(url)
+    if endpoint is not None:
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    # A request doesn't join a flight started before the last write that
+    # invalidated the cache, which may have read the data before the write
+    generation = cache.generation
+    result = _XCAT_COALESCER.request(key + (generation,), functools.partial(
+                _xcat_request, method, url, body, headers))
+    if endpoint is not None:
+        cache.put(key, endpoint[0], endpoint[1], result, generation)
+    return result
+
+
+def xcat_request_many(requests, concurrency=None):
+    """Send independent xCAT requests concurrently.
+
+    :param requests: list of (method, url) or (method, url, body) tuples
+    :param concurrency: max number of requests in flight, defaults to the
+                        size of the xCAT connection pool
+
+    Returns the parsed responses in the order of requests. If any request
+    failed, the exception of the first failed one is raised once all of
+    them have completed.
+
+    """
+    if concurrency is None:
+        concurrency = CONF.zvm_xcat_connection_pool_size
+    concurrency = min(concurrency, len(requests))
+
+    priority = getattr(_XCAT_PRIORITY, 'value', None)
+    accounting = get_xcat_call_accounting()
+
+    def _request(req):
+        # The green threads of the pool don't inherit the priority and
+        # the call accounting
+        _XCAT_ACCOUNTING.value = accounting
+        try:
+            with xcat_request_priority(priority):
+                return xcat_request(*req), None
+        except Exception as err:
+            return None, err
+
+    if concurrency <= 1:
+        results = [_request(req) for req in requests]
+    else:
+        pool = greenpool.GreenPool(concurrency)
+        results = list(pool.imap(_request, requests))
+    for res, err in results:
+        if err is not None:
+            raise err
+    return [res for res, err in results]
+
+
+class StepGraph(object):
+    """Steps run in the order of their dependencies.
+
+    A step is started in a green thread as soon as the steps it requires
+    have finished, so the steps that don't depend on each other run
+    concurrently. Once a step fails no more steps are started, the running
+    steps are waited for and the error of the first failed step is raised.
+    The names of the completed and the failed steps are kept, for the
+    caller to clean up after a failure.
+
+    """
+
+    def __init__(self):
+        self._steps = collections.OrderedDict()
+        self.completed = set()
+        self.failed = set()
+
+    def add(self, name, func, requires=()):
+        self._steps[name] = (func, tuple(requires))
+
+    def run(self):
+        priority = getattr(_XCAT_PRIORITY, 'value', None)
+        accounting = get_xcat_call_accounting()
+        timings = get_phase_timings()
+        finished = queue.LightQueue()
+
+        def _run_step(name, func):
+            # The green threads don't inherit the priority, the call
+            # accounting and the phase timings
+            _XCAT_ACCOUNTING.value = accounting
+            _PHASE_TIMINGS.value = timings
+            try:
+                with xcat_request_priority(priority):
+                    func()
+            except Exception as err:
+                finished.put((name, err))
+            else:
+                finished.put((name, None))
+
+        pending = list(self._steps)
+        done = self.completed
+        running = 0
+        error = None
+        while True:
+            if error is None:
+                for name in list(pending):
+                    func, requires = self._steps[name]
+                    if done.issuperset(requires):
+                        pending.remove(name)
+                        greenthread.spawn_n(_run_step, name, func)
+                        running += 1
+
+            if running == 0:
+                break
+            name, err = finished.get()
+            running -= 1
+            if err is None:
+                done.add(name)
+            else:
+                self.failed.add(name)
+                error = error or err
+
+        if error is not None:
+            raise error
+        if pending:
+            msg = _("Steps %s have unknown requirements") % pending
+            raise exception.ZVMDriverError(msg=msg)
 
 
 def jsonloads(jsonstr):
@@ -372,26 +1451,21 @@ def load_xcat_resp(message):
 
     """
     resp_list = jsonloads(message)['data']
-    keys = const.XCAT_RESPONSE_KEYS
-
-    resp = {}
 
-    for k in keys:
-        resp[k] = []
+    resp = dict((k, []) for k in const.XCAT_RESPONSE_KEYS)
 
+    # Bucket the entries in one pass, the values are not copied
     for d in resp_list:
-        for k in keys:
-            if d.get(k) is not None:
-                resp[k].append(d.get(k))
-
-    err = resp.get('error')
-    if err != []:
-        for e in err:
-            if _is_warning(str(e)):
-                # ignore known warnings
-                continue
-            else:
-                raise exception.ZVMXCATInternalError(msg=message)
+        for k, v in d.iteritems():
+            if v is not None and k in resp:
+                resp[k].append(v)
+
+    for e in resp['error']:
+        if _is_warning(str(e)):
+            # ignore known warnings
+            continue
+        else:
+            raise exception.ZVMXCATInternalError(msg=message)
 
     _log_warnings(resp)
 
@@ -400,9 +1474,26 @@ def load_xcat_resp(message):
 
 def _log_warnings(resp):
     for msg in (resp['info'], resp['node'], resp['data']):
-        msgstr = str(msg)
-        if 'warn' in msgstr.lower():
-            LOG.warn(_("Warning from xCAT: %s") % msgstr)
+        if _has_warning(msg):
+            LOG.warn(_("Warning from xCAT: %s") % str(msg))
+
+
+def _has_warning(msg):
+    """Check whether a string nested in msg contains a warning.
+
+    The nested lists and dicts are walked instead of being converted
+    to one string, which can be large for table dumps.
+
+    """
+    if isinstance(msg, basestring):
+        return _WARNING_PATTERN.search(msg) is not None
+    elif isinstance(msg, dict):
+        return any(_has_warning(k) or _has_warning(v)
+                   for k, v in msg.iteritems())
+    elif isinstance(msg, (list, tuple)):
+        return any(_has_warning(m) for m in msg)
+    else:
+        return False
 
 
 def _is_warning(err_str):
@@ -452,6 +1543,330 @@ def get_userid(node_name):
                 return s.strip().rpartition('=')[2]
 
 
+def get_disk_size_gb(size):
+    """Return the size in GB of a minidisk size given to add_mdisk.
+
+    The size is either a number with a 'G' or 'M' suffix or a number of
+    cylinders or blocks of the disk pool type.
+
+    """
+    s = str(size).strip().upper()
+    try:
+        if s.endswith('G'):
+            return float(s[:-1])
+        elif s.endswith('M'):
+            return float(s[:-1]) / 1024
+        unit = const.ZVM_DISK_UNIT_BYTES[CONF.zvm_diskpool_type]
+        return float(s) * unit / units.Gi
+    except (KeyError, ValueError) as err:
+        errmsg = _("Invalid disk size %(size)s: %(err)s") % {'size': size,
+                                                              'err': err}
+        raise exception.ZVMDriverError(msg=errmsg)
+
+
+class DiskPoolLedger(object):
+    """Disk pool space accounted from the minidisks the driver manages.
+
+    The used and free space of the last disk pool inventory are adjusted
+    by the minidisks added and removed by the driver since, so the space
+    is only queried from xCAT every inventory interval. It's queried
+    sooner when the ledger can't account a change, e.g. a userid created
+    before the driver started is deleted or adding a minidisk failed, and
+    when the space of an inventory drifted from the space accounted by
+    the ledger.
+
+    """
+
+    def __init__(self, inventory_interval):
+        self._inventory_interval = inventory_interval
+        self._inventory = None
+        self._inventory_time = 0
+        self._stale = False
+        # Space(GB) used by the minidisks of each node and the space used
+        # since the last inventory
+        self._disks = collections.defaultdict(float)
+        self._used = 0.0
+        # Increased when an inventory starts
+        self._generation = 0
+
+    def needs_inventory(self):
+        return (self._inventory is None or self._stale or
+                time.time() - self._inventory_time >=
+                self._inventory_interval)
+
+    def start_inventory(self):
+        """Return the inventory token of a disk pool inventory that starts.
+
+        It's passed to update with the inventory, so the space allocated
+        while the inventory is queried is kept. Only the inventory started
+        last is reconciled, so the space accounted before overlapping
+        inventories is not subtracted twice.
+
+        """
+        self._generation += 1
+        return self._generation, self._used
+
+    def update(self, dp_info, inventory=None):
+        """Reconcile the ledger with a disk pool inventory.
+
+        :param inventory: the token returned by start_inventory, by default
+                          the inventory is taken as started now
+
+        """
+        if inventory is None:
+            inventory = self.start_inventory()
+        generation, used_at_start = inventory
+        if generation != self._generation:
+            LOG.debug(_("Ignore the disk pool inventory overlapped by a "
+                        "later one"))
+            return
+
+        stale = False
+        if self._inventory is not None and not self._stale:
+            drift = (dp_info['disk_used'] - self._inventory['disk_used'] -
+                     used_at_start)
+            if abs(drift) >= const.ZVM_DISKPOOL_DRIFT_THRESHOLD:
+                LOG.info(_("Disk pool usage drifted %.1fG from the space "
+                           "accounted by the driver, query it again with "
+                           "the next host stats refresh") % drift)
+                stale = True
+        self._inventory = dict(dp_info)
+        self._inventory_time = time.time()
+        self._stale = stale
+        self._used -= used_at_start
+
+    def get_info(self):
+        """Return the disk pool space, in GB as the inventory."""
+        used = int(round(self._used))
+        info = dict(self._inventory)
+        info['disk_used'] = max(info['disk_used'] + used, 0)
+        info['disk_available'] = max(info['disk_available'] - used, 0)
+        return info
+
+    def allocate(self, node, size):
+        gb = get_disk_size_gb(size)
+        self._disks[node] += gb
+        self._used += gb
+
+    def free(self, node):
+        """Account the removal of all minidisks of node."""
+        if node in self._disks:
+            self._used -= self._disks.pop(node)
+        else:
+            self.invalidate()
+
+    def invalidate(self):
+        """Query the disk pool space with the next host stats refresh."""
+        self._stale = True
+
+
+_DISKPOOL_LEDGER = None
+
+
+def get_diskpool_ledger():
+    """Return the disk pool ledger, create it if needed."""
+    global _DISKPOOL_LEDGER
+    if _DISKPOOL_LEDGER is None:
+        _DISKPOOL_LEDGER = DiskPoolLedger(
+                                CONF.zvm_diskpool_inventory_interval)
+    return _DISKPOOL_LEDGER
+
+
+class InstanceIndex(object):
+    """Names of the xCAT nodes managed by the zHCP of the host.
+
+    The index is read from the zvm table every reconcile interval and kept
+    up to date in between by the driver, which adds and removes the nodes
+    it creates and deletes. Those changes are replayed on a reconcile that
+    runs concurrently, so they are not lost to its older table read.
+
+    """
+
+    def __init__(self, reconcile_interval):
+        self._reconcile_interval = reconcile_interval
+        self._hcp = None
+        self._nodes = set()
+        self._reconciled_at = 0
+        self._changes = {}
+
+    def needs_reconcile(self, hcp):
+        return (self._hcp is None or self._hcp.upper() != hcp.upper() or
+                time.time() - self._reconciled_at >=
+                self._reconcile_interval)
+
+    def reconcile(self, hcp, nodes, started_at):
+        """Replace the nodes by the nodes read at started_at."""
+        nodes = set(nodes)
+        for node, (node_hcp, changed_at) in self._changes.items():
+            if changed_at < started_at:
+                del self._changes[node]
+            elif node_hcp is not None and node_hcp.upper() == hcp.upper():
+                nodes.add(node)
+            else:
+                nodes.discard(node)
+
+        self._hcp = hcp
+        self._nodes = nodes
+        self._reconciled_at = time.time()
+
+    def add(self, node, hcp):
+        """Add node if it's managed by the zHCP of the index."""
+        if self._hcp is not None and self._hcp.upper() == hcp.upper():
+            self._nodes.add(node)
+        else:
+            self._nodes.discard(node)
+        self._changes[node] = (hcp, time.time())
+
+    def remove(self, node):
+        self._nodes.discard(node)
+        self._changes[node] = (None, time.time())
+
+    def invalidate(self):
+        """Reconcile the index on its next use."""
+        self._reconciled_at = 0
+
+    def get_nodes(self):
+        return sorted(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+
+_INSTANCE_INDEX = None
+
+
+def get_instance_index():
+    """Return the instance index, create it if needed."""
+    global _INSTANCE_INDEX
+    if _INSTANCE_INDEX is None:
+        _INSTANCE_INDEX = InstanceIndex(
+                                CONF.zvm_instance_index_reconcile_interval)
+    return _INSTANCE_INDEX
+
+
+class ReachabilityPoller(object):
+    """Wait for instances to be reachable, polling them together.
+
+    The nodes of all waiting instances are polled by one green thread,
+    which queries the nodes due to be polled by bulk nodestat requests.
+    A node is polled often right after it's registered, and less often
+    the longer it takes to come up.
+
+    """
+
+    def __init__(self, intervals=const.ZVM_REACHABLE_POLL_INTERVALS):
+        self._intervals = intervals
+        self._xcat_url = XCATUrl()
+        self._waiters = []
+        self._poller = None
+
+    def wait(self, node, timeout):
+        """Wait until node is reachable, return False if it timed out.
+
+        :param timeout: max time(seconds) to wait, 0 to wait without limit
+
+        """
+        now = time.time()
+        waiter = {'node': node,
+                  'event': event.Event(),
+                  'registered': now,
+                  'next_poll': now,
+                  'expiration': now + timeout if timeout else None}
+        self._waiters.append(waiter)
+        if self._poller is None:
+            self._poller = greenthread.spawn(self._poll)
+        return waiter['event'].wait()
+
+    def _get_interval(self, waited):
+        for limit, interval in self._intervals:
+            if limit is None or waited < limit:
+                return interval
+
+    def _poll(self):
+        try:
+            while self._waiters:
+                try:
+                    self._poll_due_nodes()
+                except Exception as err:
+                    # The due nodes are polled again on the next tick
+                    LOG.warn(_("Failed to poll the reachability of the "
+                               "instances: %s") % err)
+                self._expire_waiters()
+                greenthread.sleep(const.ZVM_REACHABLE_POLL_TICK)
+        finally:
+            self._poller = None
+            # Nothing polls the nodes of the waiters left by an error
+            for waiter in list(self._waiters):
+                self._wake(waiter, False)
+
+    def _poll_due_nodes(self):
+        now = time.time()
+        due = [w for w in self._waiters if w['next_poll'] <= now]
+        if due:
+            reachable = self._get_reachable(
+                            sorted(set(w['node'] for w in due)))
+            now = time.time()
+            for waiter in due:
+                if waiter['node'] in reachable:
+                    self._wake(waiter, True)
+                else:
+                    waiter['next_poll'] = now + self._get_interval(
+                                                now - waiter['registered'])
+
+    def _expire_waiters(self):
+        now = time.time()
+        for waiter in list(self._waiters):
+            if (waiter['expiration'] is not None and
+                    now > waiter['expiration']):
+                self._wake(waiter, False)
+
+    def _wake(self, waiter, reachable):
+        self._waiters.remove(waiter)
+        waiter['event'].send(reachable)
+
+    def _get_reachable(self, nodes):
+        """Return the set of the nodes whose nodestat shows sshd is up."""
+        reachable = set()
+        chunk_size = const.XCAT_BULK_NODERANGE_SIZE
+        for i in range(0, len(nodes), chunk_size):
+            chunk = nodes[i:i + chunk_size]
+            try:
+                reachable.update(self._query_reachable(chunk))
+            except Exception as err:
+                if len(chunk) == 1:
+                    LOG.warn(_("Failed to get status of %(node)s: %(err)s") %
+                             {'node': chunk[0], 'err': err})
+                    continue
+                # A node deleted meanwhile fails the whole noderange
+                for node in chunk:
+                    reachable.update(self._get_reachable([node]))
+        return reachable
+
+    def _query_reachable(self, nodes):
+        url = self._xcat_url.nodestat('/' + ','.join(nodes))
+        res_dict = xcat_request("GET", url)
+
+        reachable = set()
+        with expect_invalid_xcat_resp_data():
+            for node_list in res_dict['node']:
+                for node in node_list:
+                    status = node['data'][0]
+                    if status is not None and 'sshd' in status:
+                        reachable.add(node['name'][0])
+        return reachable
+
+
+_REACHABILITY_POLLER = None
+
+
+def get_reachability_poller():
+    """Return the host-wide reachability poller, create it if needed."""
+    global _REACHABILITY_POLLER
+    if _REACHABILITY_POLLER is None:
+        _REACHABILITY_POLLER = ReachabilityPoller()
+    return _REACHABILITY_POLLER
+
+
 def xdsh(node, commands):
     """"Run command on xCAT node."""
     LOG.debug(_('Run command %(cmd)s on xCAT node %(node)s') %
@@ -464,13 +1879,20 @@ def xdsh(node, commands):
         url = XCATUrl().xdsh('/' + node)
         return xcat_request("PUT", url, body)
 
-    with except_xcat_call_failed_and_reraise(
-            exception.ZVMXCATXdshFailed):
-        res_dict = xdsh_execute(node, commands)
+    try:
+        with except_xcat_call_failed_and_reraise(
+                exception.ZVMXCATXdshFailed):
+            res_dict = xdsh_execute(node, commands)
+    except exception.ZVMXCATXdshFailed as err:
+        with excutils.save_and_reraise_exception():
+            if const.XCAT_SSH_KEY_REJECTED in str(err):
+                # The node may have been given an outdated MN key
+                invalidate_mn_pub_key()
 
     return res_dict
 
 
+@time_phase('punch')
 def punch_file(node, fn, fclass):
     body = [" ".join(['--punchfile', fn, fclass, get_host()])]
     url = XCATUrl().chvm('/' + node)
@@ -508,6 +1930,80 @@ def punch_eph_info_file(instance_path, instance_name, vdev=None, fmt=None,
     punch_file(instance_name, eph_fn, 'X')
 
 
+class GuestInitPunch(object):
+    """Guest init actions punched to an instance.
+
+    With zvm_image_batched_punch set, all the actions are written to one
+    '# xCAT Init' file and punched by one xCAT request, one action per
+    blank line separated block of key=value lines:
+
+        # xCAT Init
+        action=setPassword
+        password=<root password>
+
+        action=addAuthKey
+        key=<xCAT MN public key>
+
+        action=addMdisk
+        vaddr=<vdev>
+        filesys=<format>
+        mntdir=<mount directory>
+
+    Otherwise each action is punched in its own file.
+    """
+
+    def __init__(self, instance_path, instance_name):
+        self._instance_path = instance_path
+        self._instance_name = instance_name
+        self._actions = []
+
+    def add_adminpass(self, admin_password):
+        """Change the root password of the instance."""
+        self._actions.append(('setPassword', (admin_password,)))
+
+    def add_xcat_auth(self):
+        """Make xCAT MN authorized by the instance."""
+        self._actions.append(('addAuthKey', ()))
+
+    def add_eph_info(self, vdev=None, fmt=None, mntdir=None):
+        """Format and mount an ephemeral disk of the instance."""
+        self._actions.append(('addMdisk', (vdev, fmt, mntdir)))
+
+    def punch(self):
+        """Punch the actions added so far to the instance."""
+        actions, self._actions = self._actions, []
+        if not actions:
+            return
+
+        if not CONF.zvm_image_batched_punch:
+            punches = {'setPassword': punch_adminpass_file,
+                       'addAuthKey': punch_xcat_auth_file,
+                       'addMdisk': punch_eph_info_file}
+            for action, args in actions:
+                punches[action](self._instance_path, self._instance_name,
+                                *args)
+            return
+
+        init_fn = ''.join([self._instance_path, '/xcatinit.disk'])
+        _generate_init_file(init_fn,
+                            [self._get_params(action, *args)
+                             for action, args in actions])
+        punch_file(self._instance_name, init_fn, 'X')
+
+    def _get_params(self, action, *args):
+        if action == 'setPassword':
+            params = [('password', args[0])]
+        elif action == 'addAuthKey':
+            params = [('key', get_mn_pub_key())]
+        else:
+            vdev, fmt, mntdir = args
+            params = [('vaddr', vdev or CONF.zvm_user_adde_vdev),
+                      ('filesys', fmt or CONF.default_ephemeral_format or
+                                  const.DEFAULT_EPH_DISK_FMT),
+                      ('mntdir', mntdir or CONF.zvm_default_ephemeral_mntdir)]
+        return action, params
+
+
 def generate_vdev(base, offset=1):
     """Generate virtual device number base on base vdev.
 
@@ -556,6 +2052,23 @@ def _generate_ephinfo_file(fname, vdev, fmt, mntdir):
                 LOG.error(_('Generate ephemeral info file failed: %s') % err)
 
 
+def _generate_init_file(fname, actions):
+    lines = ['# xCAT Init\n']
+    for idx, (action, params) in enumerate(actions):
+        if idx:
+            lines.append('\n')
+        lines.append('action=' + action + '\n')
+        lines.extend(''.join([key, '=', value, '\n'])
+                     for key, value in params)
+
+    with open(fname, 'w') as genfile:
+        try:
+            genfile.writelines(lines)
+        except Exception as err:
+            with excutils.save_and_reraise_exception():
+                LOG.error(_('Generate guest init file failed: %s') % err)
+
+
 def _generate_auth_file(fn, pub_key):
     lines = ['#!/bin/bash\n',
     'echo "%s" >> /root/.ssh/authorized_keys' % pub_key]
@@ -570,8 +2083,133 @@ def _generate_adminpass_file(fn, admin_password):
         f.writelines(lines)
 
 
-@wrap_invalid_xcat_resp_data_error
+class MNPubKeyCache(object):
+    """Public keys of the xCAT MNs, cached in memory and in a file.
+
+    A key is queried from the MN by xdsh when it isn't cached or when it
+    was queried more than the check interval ago. It's queried again once
+    the boot id of the MN changed, as the MN may have been restarted with
+    a new key, and after xCAT failed to ssh to a node with the key. The
+    file keeps the keys across restarts of the compute service.
+
+    """
+
+    def __init__(self, path, check_interval):
+        self._path = path
+        self._check_interval = check_interval
+        self._keys = None
+        self._lock = semaphore.Semaphore()
+
+    def _load(self):
+        self._keys = {}
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as f:
+                for mn, entry in jsonutils.loads(f.read()).items():
+                    self._keys[mn] = (entry['key'], entry['time'],
+                                      entry.get('boot_id'))
+        except (IOError, OSError, ValueError, KeyError,
+                AttributeError) as err:
+            LOG.warn(_("Failed to load xCAT MN public keys from %(path)s: "
+                       "%(err)s") % {'path': self._path, 'err': err})
+
+    def _save(self):
+        keys = dict((mn, {'key': key, 'time': queried_at,
+                          'boot_id': boot_id})
+                    for mn, (key, queried_at, boot_id) in self._keys.items())
+        tmp_path = self._path + '.tmp'
+        try:
+            fileutils.ensure_tree(os.path.dirname(self._path))
+            with open(tmp_path, 'w') as f:
+                f.write(jsonutils.dumps(keys, sort_keys=True))
+            os.rename(tmp_path, self._path)
+        except (IOError, OSError) as err:
+            LOG.warn(_("Failed to save xCAT MN public keys to %(path)s: "
+                       "%(err)s") % {'path': self._path, 'err': err})
+
+    def _get_mn(self):
+        return '/'.join([CONF.zvm_xcat_server, CONF.zvm_xcat_master])
+
+    def _is_valid(self, mn):
+        if mn not in self._keys:
+            return False
+        queried_at = self._keys[mn][1]
+        return time.time() - queried_at < self._check_interval
+
+    def get(self):
+        """Return the public key of the MN, query it if needed."""
+        mn = self._get_mn()
+        # Concurrent spawns wait for one query of the key
+        with self._lock:
+            if self._keys is None:
+                self._load()
+            if not self._is_valid(mn):
+                # Read before the key, so a restart in between is found
+                # by the next check
+                boot_id = _query_mn_boot_id()
+                key = _query_mn_pub_key()
+                if mn in self._keys and self._keys[mn][0] != key:
+                    LOG.info(_("The public key of xCAT MN %s changed") %
+                             CONF.zvm_xcat_master)
+                self._keys[mn] = (key, time.time(), boot_id)
+                self._save()
+            return self._keys[mn][0]
+
+    def check_restart(self):
+        """Drop the key of the MN if the MN was restarted since its query."""
+        mn = self._get_mn()
+        with self._lock:
+            if self._keys is None:
+                self._load()
+            if mn not in self._keys:
+                return
+            boot_id = _query_mn_boot_id()
+            if boot_id != self._keys[mn][2]:
+                LOG.info(_("xCAT MN %s was restarted, query its public key "
+                           "again") % CONF.zvm_xcat_master)
+                self.invalidate()
+
+    def invalidate(self):
+        """Query the key of the MN again on the next use."""
+        if self._keys is not None:
+            self._keys.pop(self._get_mn(), None)
+
+
+_MN_PUB_KEY_CACHE = None
+
+
+def _get_mn_pub_key_cache():
+    global _MN_PUB_KEY_CACHE
+    if _MN_PUB_KEY_CACHE is None:
+        _MN_PUB_KEY_CACHE = MNPubKeyCache(
+                                os.path.join(CONF.zvm_image_tmp_path,
+                                             const.XCAT_MN_KEYS_FILE),
+                                CONF.zvm_xcat_mn_key_check_interval)
+    return _MN_PUB_KEY_CACHE
+
+
 def get_mn_pub_key():
+    """Return the public key of xCAT MN."""
+    if CONF.zvm_xcat_mn_key_check_interval <= 0:
+        return _query_mn_pub_key()
+    return _get_mn_pub_key_cache().get()
+
+
+def check_mn_pub_key():
+    """Drop the cached public key of xCAT MN if the MN was restarted."""
+    if CONF.zvm_xcat_mn_key_check_interval > 0:
+        _get_mn_pub_key_cache().check_restart()
+
+
+def invalidate_mn_pub_key():
+    """Query the public key of xCAT MN again on the next use."""
+    if _MN_PUB_KEY_CACHE is not None:
+        _MN_PUB_KEY_CACHE.invalidate()
+
+
+@wrap_invalid_xcat_resp_data_error
+def _query_mn_pub_key():
     cmd = 'cat /root/.ssh/id_rsa.pub'
     resp = xdsh(CONF.zvm_xcat_master, cmd)
     key = resp['data'][0][0]
@@ -580,6 +2218,14 @@ def get_mn_pub_key():
     return key
 
 
+@wrap_invalid_xcat_resp_data_error
+def _query_mn_boot_id():
+    cmd = 'cat /proc/sys/kernel/random/boot_id'
+    resp = xdsh(CONF.zvm_xcat_master, cmd)
+    # The output is prefixed by the node name
+    return resp['data'][0][0].split(':')[-1].strip()
+
+
 def parse_os_version(os_version):
     """Separate os and version from os_version.
     Possible return value are only:
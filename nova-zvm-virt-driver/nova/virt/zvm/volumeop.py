@@ -370,17 +370,30 @@ class SVCDriver(DriverAPI):
 
     def _get_wwpn(self, fcp):
         states = ['active', 'free']
-        for _state in states:
-            fcps_info = self._list_fcp_details(_state)
+        for fcps_info in self._list_fcp_details_many(states):
             if not fcps_info:
                 continue
             wwpn = self._extract_wwpn_from_fcp_info(fcp, fcps_info)
             if wwpn:
                 return wwpn
 
+    def _get_fcp_details_fields(self, state):
+        return '&field=--fcpdevices&field=' + state + '&field=details'
+
     def _list_fcp_details(self, state):
-        fields = '&field=--fcpdevices&field=' + state + '&field=details'
-        rsp = self._xcat_rinv(fields)
+        rsp = self._xcat_rinv(self._get_fcp_details_fields(state))
+        return self._parse_fcp_details(rsp)
+
+    def _list_fcp_details_many(self, states):
+        """Query FCP details of several states concurrently."""
+        url = self._xcat_url.rinv
+        requests = [("GET", url('/' + self._host,
+                                self._get_fcp_details_fields(s)))
+                    for s in states]
+        return [self._parse_fcp_details(rsp)
+                for rsp in zvmutils.xcat_request_many(requests)]
+
+    def _parse_fcp_details(self, rsp):
         try:
             fcp_details = rsp['info'][0][0].splitlines()
             return fcp_details